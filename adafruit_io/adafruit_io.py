@@ -53,6 +53,15 @@ class IO_MQTT:
     Client for interacting with Adafruit IO MQTT API.
     https://io.adafruit.com/api/docs/mqtt.html#adafruit-io-mqtt-api
 
+    Adafruit IO limits how often data may be published. Set ``rate_limiter``
+    to an ``adafruit_minimqtt_ratelimit.MQTTRateLimiter`` for the client, and
+    publishing queues data instead, which the client's ``loop()`` sends as
+    the limit allows, also when an ``MQTTSupervisor`` runs it.
+
+    ..code-block:: python
+
+        io.rate_limiter = MQTTRateLimiter(mqtt_client, per_minute=30)
+
     :param MiniMQTT mqtt_client: MiniMQTT Client object.
     """
 
@@ -114,6 +123,16 @@ class IO_MQTT:
         if self._connected:
             self._client.disconnect()
 
+    @property
+    def rate_limiter(self):
+        """The ``rate_limiter`` of the MiniMQTT client, which its ``loop()``
+        flushes."""
+        return self._client.rate_limiter
+
+    @rate_limiter.setter
+    def rate_limiter(self, limiter):
+        self._client.rate_limiter = limiter
+
     @property
     def is_connected(self):
         """Returns if connected to Adafruit IO MQTT Broker."""
@@ -154,6 +173,8 @@ class IO_MQTT:
                 feeds = []
                 messages = []
                 # Conversion of incoming group to a json response
+                if not isinstance(payload, str):
+                    payload = str(payload, "utf-8")
                 payload = json.loads(payload)
                 for feed in payload["feeds"]:
                     feeds.append(feed)
@@ -190,7 +211,7 @@ class IO_MQTT:
         if self.on_unsubscribe is not None:
             self.on_unsubscribe(self, user_data, topic, pid)
 
-    def add_feed_callback(self, feed_key, callback_method):
+    def add_feed_callback(self, feed_key, callback_method, raw=None):
         """Attaches a callback_method to an Adafruit IO feed.
         The callback_method function is called when a
         new value is written to the feed.
@@ -199,11 +220,13 @@ class IO_MQTT:
         will only execute during loop().
         :param str feed_key: Adafruit IO feed key.
         :param str callback_method: Name of callback method.
+        :param bool raw: Pass the value to callback_method as a memoryview
+            instead of a str, see `MQTT.add_topic_callback`.
 
         """
         validate_feed_key(feed_key)
         self._client.add_topic_callback(
-            "{0}/f/{1}".format(self._user, feed_key), callback_method
+            "{0}/f/{1}".format(self._user, feed_key), callback_method, raw
         )
 
     def remove_feed_callback(self, feed_key):
@@ -218,9 +241,33 @@ class IO_MQTT:
         validate_feed_key(feed_key)
         self._client.remove_topic_callback("{0}/f/{1}".format(self._user, feed_key))
 
-    def loop(self):
+    def add_feed_codec(self, feed_key, codec):
+        """Encodes the values published to a feed, and decodes the values
+        received from it, with a payload codec from `adafruit_minimqtt_codecs`.
+        Only for brokers which accept binary payloads: Adafruit IO does not.
+        :param str feed_key: Adafruit IO feed key.
+        :param codec: Payload codec, see `MQTT.add_topic_codec`.
+
+        """
+        validate_feed_key(feed_key)
+        self._client.add_topic_codec("{0}/f/{1}".format(self._user, feed_key), codec)
+
+    def remove_feed_codec(self, feed_key):
+        """Removes a codec added with `add_feed_codec`.
+        :param str feed_key: Adafruit IO feed key.
+
+        """
+        validate_feed_key(feed_key)
+        self._client.remove_topic_codec("{0}/f/{1}".format(self._user, feed_key))
+
+    def loop(self, timeout=1, max_messages=None, budget_ms=None):
         """Manually process messages from Adafruit IO.
         Call this method to check incoming subscription messages.
+        Returns the response codes of the messages processed.
+        :param int timeout: Socket timeout, in seconds. With 0, loop() returns
+            at once when no messages are waiting.
+        :param int max_messages: Process up to this many waiting messages per call.
+        :param int budget_ms: Time limit for processing waiting messages, in ms.
 
         Example usage of polling the message queue using loop.
 
@@ -228,8 +275,22 @@ class IO_MQTT:
 
             while True:
                 io.loop()
+
+        Example of handling a burst of group feed or retained messages without
+        holding up the display for more than 50 ms, and without waiting at all
+        when no messages have arrived.
+
+        ..code-block:: python
+
+            while True:
+                io.loop(timeout=0, max_messages=20, budget_ms=50)
+
+        With a ``rate_limiter``, queued data is sent first, as far as the
+        rate limit allows.
         """
-        self._client.loop()
+        return self._client.loop(
+            timeout, max_messages=max_messages, budget_ms=budget_ms
+        )
 
     # Subscriptions
     def subscribe(self, feed_key=None, group_key=None, shared_user=None):
@@ -349,6 +410,9 @@ class IO_MQTT:
 
         :param str feeds_and_data: List of tuples containing topic strings and data values.
         :param int timeout: Delay between publishing data points to Adafruit IO, in seconds.
+            Not used with a ``rate_limiter``, which queues the data points and
+            returns at once. With a timeout of zero, the data points are sent
+            together with `adafruit_minimqtt.MQTT.publish_many`.
         :param bool is_group: Set to True if you're publishing to a group.
 
         Example of publishing multiple data points on different feeds to Adafruit IO:
@@ -363,12 +427,23 @@ class IO_MQTT:
                 feed_data.append((topic, data))
         else:
             raise AdafruitIO_MQTTError("This method accepts a list of tuples.")
+        if self.rate_limiter is None and not timeout:
+            messages = []
+            for topic, data in feed_data:
+                validate_feed_key(topic)
+                # the same topics as publish()
+                if is_group:
+                    messages.append(("{0}/g/{1}".format(self._user, topic), data))
+                messages.append(("{0}/f/{1}".format(self._user, topic), data))
+            self._client.publish_many(messages)
+            return
         for topic, data in feed_data:
             if is_group:
                 self.publish(topic, data, is_group=True)
             else:
                 self.publish(topic, data)
-            time.sleep(timeout)
+            if self.rate_limiter is None:
+                time.sleep(timeout)
 
     # pylint: disable=too-many-arguments
     def publish(self, feed_key, data, metadata=None, shared_user=None, is_group=False):
@@ -419,18 +494,23 @@ class IO_MQTT:
         """
         validate_feed_key(feed_key)
         if is_group:
-            self._client.publish("{0}/g/{1}".format(self._user, feed_key), data)
+            self._publish("{0}/g/{1}".format(self._user, feed_key), data)
         if shared_user is not None:
-            self._client.publish("{0}/f/{1}".format(shared_user, feed_key), data)
+            self._publish("{0}/f/{1}".format(shared_user, feed_key), data)
         if metadata is not None:
             if isinstance(data, int or float):
                 data = str(data)
             csv_string = data + "," + metadata
-            self._client.publish(
-                "{0}/f/{1}/csv".format(self._user, feed_key), csv_string
-            )
+            self._publish("{0}/f/{1}/csv".format(self._user, feed_key), csv_string)
+        else:
+            self._publish("{0}/f/{1}".format(self._user, feed_key), data)
+
+    def _publish(self, topic, data):
+        """Publishes through the rate limiter, if there is one."""
+        if self.rate_limiter is not None:
+            self.rate_limiter.publish(topic, data)
         else:
-            self._client.publish("{0}/f/{1}".format(self._user, feed_key), data)
+            self._client.publish(topic, data)
 
     def get(self, feed_key):
         """Calling this method will make Adafruit IO publish the most recent
@@ -455,18 +535,61 @@ class IO_HTTP:
         :param str adafruit_io_username: Adafruit IO Username
         :param str adafruit_io_key: Adafruit IO Key
         :param requests: A passed adafruit_requests module.
+        :param SocketBudget socket_budget: Optional
+            `adafruit_minimqtt_sockets.SocketBudget`. Requests then run on a
+            session whose sockets come from the budget, and the idle sockets
+            it keeps open are closed when another pool needs a socket, by
+            closing the sockets of the pool and starting a new session.
+            Requires requests to be the adafruit_requests module.
+        :param ssl_context: SSL context for the HTTPS requests of a session
+            using socket_budget. Defaults to the ``ssl_context`` of the
+            budget, which needs the budget to have an ESP32SPI interface.
     """
 
-    def __init__(self, adafruit_io_username, adafruit_io_key, requests):
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        adafruit_io_username,
+        adafruit_io_key,
+        requests,
+        socket_budget=None,
+        ssl_context=None,
+    ):
         self.username = adafruit_io_username
         self.key = adafruit_io_key
         self._http = requests
+        self._requests = requests
+        self._ssl_context = ssl_context
+        self._pool = None
+        # True while a request uses the session
+        self._requesting = False
+        if socket_budget is not None:
+            if ssl_context is None:
+                ssl_context = socket_budget.ssl_context
+            if ssl_context is None:
+                raise ValueError(
+                    "An ssl_context, or a SocketBudget with an iface, is needed "
+                    "for HTTPS requests to Adafruit IO."
+                )
+            self._ssl_context = ssl_context
+            self._pool = socket_budget.pool("http")
+            self._http = requests.Session(self._pool, ssl_context)
+            self._pool.reclaim = self._free_sockets
 
         self._aio_headers = [
             {"X-AIO-KEY": self.key, "Content-Type": "application/json"},
             {"X-AIO-KEY": self.key},
         ]
 
+    def _free_sockets(self):
+        """Closes the sockets the HTTP session keeps open for reuse."""
+        if self._requesting:
+            return
+        # adafruit_requests has no public way to close the idle sockets of a
+        # session, so the session is replaced, along with the sockets it kept
+        if self._pool.close_all():
+            self._http = self._requests.Session(self._pool, self._ssl_context)
+
     @staticmethod
     def _create_headers(io_headers):
         """Creates http request headers."""
@@ -512,38 +635,44 @@ class IO_HTTP:
         :param str path: Formatted Adafruit IO URL from _compose_path
         :param json payload: JSON data to send to Adafruit IO
         """
-        response = self._http.post(
-            path, json=payload, headers=self._create_headers(self._aio_headers[0])
+        return self._request(
+            self._http.post,
+            path,
+            json=payload,
+            headers=self._create_headers(self._aio_headers[0]),
         )
-        self._handle_error(response)
-        json_data = response.json()
-        response.close()
-        return json_data
 
     def _get(self, path):
         """
         GET data from Adafruit IO
         :param str path: Formatted Adafruit IO URL from _compose_path
         """
-        response = self._http.get(
-            path, headers=self._create_headers(self._aio_headers[1])
+        return self._request(
+            self._http.get, path, headers=self._create_headers(self._aio_headers[1])
         )
-        self._handle_error(response)
-        json_data = response.json()
-        response.close()
-        return json_data
 
     def _delete(self, path):
         """
         DELETE data from Adafruit IO.
         :param str path: Formatted Adafruit IO URL from _compose_path
         """
-        response = self._http.delete(
-            path, headers=self._create_headers(self._aio_headers[0])
+        return self._request(
+            self._http.delete, path, headers=self._create_headers(self._aio_headers[0])
         )
-        self._handle_error(response)
-        json_data = response.json()
-        response.close()
+
+    def _request(self, method, path, **kwargs):
+        """Sends a request and returns the JSON data of the response.
+        :param method: ``get``, ``post`` or ``delete`` method of the session.
+        :param str path: Formatted Adafruit IO URL from _compose_path
+        """
+        self._requesting = True
+        try:
+            response = method(path, **kwargs)
+            self._handle_error(response)
+            json_data = response.json()
+            response.close()
+        finally:
+            self._requesting = False
         return json_data
 
     # Data
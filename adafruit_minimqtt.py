@@ -26,12 +26,18 @@ Adapted from https://github.com/micropython/micropython-lib/tree/master/umqtt.si
 
 """
 import errno
+import json
 import struct
 import time
 from random import randint
 from micropython import const
 from matcher import MQTTMatcher
 
+try:
+    import select
+except ImportError:
+    select = None
+
 __version__ = "0.0.0-auto.0"
 __repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_MiniMQTT.git"
 
@@ -41,10 +47,27 @@ MQTT_MSG_SZ_LIM = const(10000000)
 MQTT_TOPIC_LENGTH_LIMIT = const(65535)
 MQTT_TCP_PORT = const(1883)
 MQTT_TLS_PORT = const(8883)
+# Size of the reusable PUBLISH packet buffer, in bytes
+MQTT_PUB_BUF_SZ = const(256)
+# Number of encoded publish topics kept in the topic cache
+MQTT_TOPIC_CACHE_SZ = const(16)
+# Initial size of the receive buffer, in bytes
+MQTT_RECV_BUF_SZ = const(512)
+# Socket timeout while draining packets which have already arrived, in seconds
+MQTT_DRAIN_TIMEOUT = 0.001
+# Time a resolved broker address is reused before it is looked up again, in seconds
+MQTT_ADDR_CACHE_TTL = const(300)
+# Number of topic aliases the broker may assign in MQTT 5 mode
+MQTT_TOPIC_ALIAS_MAX = const(16)
+
+# Protocol versions
+MQTT_V311 = const(4)
+MQTT_V5 = const(5)
 
 # MQTT Commands
 MQTT_PINGREQ = b"\xc0\0"
 MQTT_PINGRESP = const(0xD0)
+MQTT_PUBACK = const(0x40)
 MQTT_SUB = b"\x82"
 MQTT_UNSUB = b"\xA2"
 MQTT_DISCONNECT = b"\xe0\0"
@@ -59,8 +82,38 @@ CONNACK_ERRORS = {
     const(0x03): "Connection Refused - Server unavailable",
     const(0x04): "Connection Refused - Incorrect username/password",
     const(0x05): "Connection Refused - Unauthorized",
+    # MQTT 5 reason codes [MQTT5 3.2.2.2]
+    const(0x80): "Connection Refused - Unspecified error",
+    const(0x84): "Connection Refused - Unsupported Protocol Version",
+    const(0x85): "Connection Refused - Client Identifier not valid",
+    const(0x86): "Connection Refused - Bad User Name or Password",
+    const(0x87): "Connection Refused - Not authorized",
+    const(0x88): "Connection Refused - Server unavailable",
+    const(0x89): "Connection Refused - Server busy",
+    const(0x8A): "Connection Refused - Banned",
+    const(0x95): "Connection Refused - Packet too large",
+    const(0x97): "Connection Refused - Quota exceeded",
+    const(0x9F): "Connection Refused - Connection rate exceeded",
 }
 
+# MQTT 5 property identifiers [MQTT5 2.2.2.2]
+_PROP_SUBSCRIPTION_ID = const(0x0B)
+_PROP_SESSION_EXPIRY = const(0x11)
+_PROP_ASSIGNED_CLIENT_ID = const(0x12)
+_PROP_SERVER_KEEP_ALIVE = const(0x13)
+_PROP_RECEIVE_MAXIMUM = const(0x21)
+_PROP_TOPIC_ALIAS_MAXIMUM = const(0x22)
+_PROP_TOPIC_ALIAS = const(0x23)
+_PROP_MAXIMUM_QOS = const(0x24)
+_PROP_USER_PROPERTY = const(0x26)
+_PROP_MAXIMUM_PACKET_SIZE = const(0x27)
+# MQTT 5 property identifiers by the type of their value
+_PROP_BYTE = (0x01, 0x17, 0x19, 0x24, 0x25, 0x28, 0x29, 0x2A)
+_PROP_INT16 = (0x13, 0x21, 0x22, 0x23)
+_PROP_INT32 = (0x02, 0x11, 0x18, 0x27)
+_PROP_STRING = (0x03, 0x08, 0x12, 0x15, 0x1A, 0x1C, 0x1F)
+_PROP_BINARY = (0x09, 0x16)
+
 _default_sock = None  # pylint: disable=invalid-name
 _fake_context = None  # pylint: disable=invalid-name
 
@@ -95,6 +148,8 @@ class _FakeSSLSocket:
         self.send = socket.send
         self.recv = socket.recv
         self.close = socket.close
+        if hasattr(socket, "available"):
+            self.available = socket.available
 
     def connect(self, address):
         """connect wrapper to add non-standard mode parameter"""
@@ -114,6 +169,275 @@ class _FakeSSLContext:
         return _FakeSSLSocket(socket, self._iface.TLS_MODE)
 
 
+class MQTTDecoder:
+    """Incremental MQTT packet decoder.
+
+    The decoder does no I/O of its own: received bytes are written into its
+    reusable buffer, either with `feed()` or by receiving straight into the
+    view returned by `free()` and calling `commit()`. `next_packet()` then
+    returns one complete packet at a time, so a single large read may yield
+    several packets. Packet headers are decoded in place, without allocation.
+
+    Packets larger than ``max_size`` are not buffered whole. `next_packet()`
+    returns them as soon as the start of the packet is buffered, with
+    `remaining` set to the number of bytes still to come, which are then read
+    in pieces with `stream()`.
+
+    :param int size: Initial size of the receive buffer, in bytes. The buffer
+        grows when a packet does not fit.
+    :param int max_size: Size of the largest packet buffered whole, in bytes.
+    """
+
+    def __init__(self, size=MQTT_RECV_BUF_SZ, max_size=MQTT_MSG_MAX_SZ):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+        # size of the packet at the start of the buffer, once known
+        self._need = 0
+        # bytes buffered before the start of a streamed packet is returned
+        self._stream_head = size
+        self.max_size = max_size
+        self.body = None
+        self.remaining = 0
+
+    def __len__(self):
+        """Number of received bytes which have not been decoded yet."""
+        return self._end - self._start
+
+    def reset(self):
+        """Discards any buffered bytes, such as when a new socket is connected."""
+        self._start = self._end = self._need = self.remaining = 0
+        self.body = None
+
+    def free(self):
+        """Returns a memoryview of the free space at the end of the buffer.
+        Buffered bytes are moved to the start of the buffer first, and the
+        buffer grows if the next packet can not fit in it.
+        """
+        buffered = self._end - self._start
+        if self._start and (buffered == 0 or self._end == len(self._buf)):
+            self._view[:buffered] = self._view[self._start : self._end]
+            self._start, self._end = 0, buffered
+        if self._end == len(self._buf) or self._need > len(self._buf):
+            buf = bytearray(max(self._need, 2 * len(self._buf)))
+            buf[:buffered] = self._view[self._start : self._end]
+            self._buf, self._view = buf, memoryview(buf)
+            self._start, self._end = 0, buffered
+        return self._view[self._end :]
+
+    def commit(self, size):
+        """Marks size bytes written into the view from `free()` as received.
+        :param int size: Number of bytes received.
+        """
+        self._end += size
+
+    def feed(self, data):
+        """Copies received bytes into the buffer.
+        :param bytes data: Bytes received from the broker.
+        """
+        offset = 0
+        while offset < len(data):
+            view = self.free()
+            size = min(len(view), len(data) - offset)
+            view[:size] = data[offset : offset + size]
+            self.commit(size)
+            offset += size
+
+    def next_packet(self):
+        """Decodes the next complete packet in the buffer.
+        Returns the first byte of its fixed header, or None when no complete
+        packet is buffered. The packet's variable header and payload are then
+        available as the memoryview `body`, which stays valid until more bytes
+        are written to the decoder. For a packet larger than ``max_size``,
+        `body` only holds its start and `remaining` is not zero.
+        Returns None until the rest of a streamed packet has been read.
+        """
+        if self.remaining:
+            return None
+        start, end = self._start, self._end
+        buf = self._buf
+        pos = start + 1
+        length = 0
+        shift = 0
+        while True:
+            if pos >= end:
+                return None
+            byte = buf[pos]
+            pos += 1
+            length |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                break
+            shift += 7
+            if shift > 21:
+                raise MMQTTException("Malformed remaining length.")
+        if end - pos < length:
+            if pos - start + length <= self.max_size:
+                self._need = pos - start + length
+                return None
+            if end - start < self._stream_head:
+                # wait for enough of the packet to hold its variable header
+                return None
+            self._need = 0
+            self.remaining = length - (end - pos)
+            self._start = end
+            self.body = self._view[pos:end]
+            return buf[start]
+        self._need = 0
+        self._start = pos + length
+        self.body = self._view[pos : self._start]
+        return buf[start]
+
+    def stream(self):
+        """Returns the next buffered piece of a packet returned by
+        `next_packet()` before it was complete, as a memoryview which stays
+        valid until more bytes are written to the decoder. The piece is empty
+        when more bytes have to be received first.
+        """
+        size = min(self._end - self._start, self.remaining)
+        piece = self._view[self._start : self._start + size]
+        self._start += size
+        self.remaining -= size
+        return piece
+
+
+# Control packet names, indexed by packet type [MQTT 2.2.1]
+_PACKET_NAMES = (
+    "RESERVED",
+    "CONNECT",
+    "CONNACK",
+    "PUBLISH",
+    "PUBACK",
+    "PUBREC",
+    "PUBREL",
+    "PUBCOMP",
+    "SUBSCRIBE",
+    "SUBACK",
+    "UNSUBSCRIBE",
+    "UNSUBACK",
+    "PINGREQ",
+    "PINGRESP",
+    "DISCONNECT",
+    "AUTH",
+)
+
+
+class MQTTStats:
+    """Traffic and timing counters of an `MQTT` client, available as its
+    ``stats`` attribute. Counters are plain integers updated as packets are
+    sent and received, so they are cheap enough to stay on all the time.
+    Durations are kept in nanoseconds.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Sets every counter back to zero."""
+        # packets and bytes, indexed by packet type
+        self.packets_in = [0] * 16
+        self.bytes_in = [0] * 16
+        self.packets_out = [0] * 16
+        self.bytes_out = [0] * 16
+        # time from sending a QoS 1 PUBLISH to its PUBACK
+        self.pubacks = 0
+        self.puback_ns = 0
+        self.puback_max_ns = 0
+        self.rtt = None
+        self.rtt_jitter = None
+        self.reconnects = 0
+        self.reconnect_ns = 0
+        self.callbacks = 0
+        self.callback_ns = 0
+        self.callback_max_ns = 0
+        # most bytes waiting in the receive buffer at once
+        self.recv_buffer_high = 0
+        # messages dropped for being too large
+        self.skipped = 0
+        # secure connections: TCP connect and TLS handshake time, and how
+        # many resumed an earlier TLS session
+        self.tls_handshakes = 0
+        self.tls_handshake_ns = 0
+        self.tls_handshake_max_ns = 0
+        self.tls_resumed = 0
+
+    def sent(self, header, size):
+        """Counts a packet sent to the broker.
+        :param int header: First byte of the fixed header.
+        :param int size: Size of the packet, in bytes.
+
+        """
+        self.packets_out[header >> 4] += 1
+        self.bytes_out[header >> 4] += size
+
+    def received(self, header, length):
+        """Counts a packet received from the broker.
+        :param int header: First byte of the fixed header.
+        :param int length: Remaining Length of the packet, in bytes.
+
+        """
+        self.packets_in[header >> 4] += 1
+        # type byte, Remaining Length bytes and the rest of the packet
+        self.bytes_in[header >> 4] += (
+            length + 2 + (length > 0x7F) + (length > 0x3FFF) + (length > 0x1FFFFF)
+        )
+
+    def tls_handshake(self, duration_ns, resumed=False):
+        """Counts a secure connection to the broker.
+        :param int duration_ns: Time taken to connect and complete the TLS
+            handshake, in nanoseconds.
+        :param bool resumed: Whether an earlier TLS session was resumed.
+
+        """
+        self.tls_handshakes += 1
+        self.tls_handshake_ns += duration_ns
+        self.tls_handshake_max_ns = max(self.tls_handshake_max_ns, duration_ns)
+        self.tls_resumed += bool(resumed)
+
+    def as_dict(self):
+        """Returns the counters as a dict. Packet and byte counts are keyed
+        by packet name and durations are in milliseconds."""
+        return {
+            "packets_in": self._by_name(self.packets_in),
+            "bytes_in": self._by_name(self.bytes_in),
+            "packets_out": self._by_name(self.packets_out),
+            "bytes_out": self._by_name(self.bytes_out),
+            "pubacks": self.pubacks,
+            "puback_avg_ms": self._average_ms(self.puback_ns, self.pubacks),
+            "puback_max_ms": self.puback_max_ns / 1000000,
+            "rtt_ms": None if self.rtt is None else self.rtt * 1000,
+            "rtt_jitter_ms": None
+            if self.rtt_jitter is None
+            else self.rtt_jitter * 1000,
+            "reconnects": self.reconnects,
+            "reconnect_avg_ms": self._average_ms(self.reconnect_ns, self.reconnects),
+            "callbacks": self.callbacks,
+            "callback_avg_ms": self._average_ms(self.callback_ns, self.callbacks),
+            "callback_max_ms": self.callback_max_ns / 1000000,
+            "recv_buffer_high": self.recv_buffer_high,
+            "skipped": self.skipped,
+            "tls_handshakes": self.tls_handshakes,
+            "tls_handshake_avg_ms": self._average_ms(
+                self.tls_handshake_ns, self.tls_handshakes
+            ),
+            "tls_handshake_max_ms": self.tls_handshake_max_ns / 1000000,
+            "tls_resumed": self.tls_resumed,
+        }
+
+    @staticmethod
+    def _by_name(counts):
+        return {
+            _PACKET_NAMES[packet_type]: count
+            for packet_type, count in enumerate(counts)
+            if count
+        }
+
+    @staticmethod
+    def _average_ms(total_ns, count):
+        return total_ns / count / 1000000 if count else None
+
+
 class MQTT:
     """MQTT Client for CircuitPython.
     :param str broker: MQTT Broker URL or IP Address.
@@ -125,7 +449,33 @@ class MQTT:
     :param bool is_ssl: Sets a secure or insecure connection with the broker.
     :param int keep_alive: KeepAlive interval between the broker and the MiniMQTT client.
     :param socket socket_pool: A pool of socket resources available for the given radio.
-    :param ssl_context: SSL context for long-lived SSL connections.
+    :param ssl_context: SSL context for long-lived SSL connections. With an
+        `ssl.SSLContext` on CPython, reconnects resume the TLS session of the
+        last connection instead of repeating the full handshake.
+    :param int max_inflight: Number of QoS 1 messages which may await a PUBACK
+        at once. Defaults to zero, where `publish()` blocks until each PUBACK.
+    :param MQTTSpool spool: Optional `adafruit_minimqtt_spool.MQTTSpool` which
+        stores messages published while disconnected, and sends them on connect.
+    :param bool raw_payloads: Pass received payloads to callbacks as a
+        memoryview instead of decoding them to a str.
+    :param bool clean_session: Start a new session on every connection. Set to
+        False, with a fixed ``client_id``, to resume the session the broker kept,
+        so that reconnects skip resubscribing and pending QoS 1 messages resume.
+    :param bool adaptive_keep_alive: Wait for a PINGRESP only as long as the
+        measured round trip time suggests, instead of a whole keep alive
+        period, so that a dead link is noticed sooner.
+    :param int protocol_version: `MQTT_V311`, or `MQTT_V5` to use MQTT 5.0.
+        In MQTT 5 mode, topics published repeatedly are replaced by topic
+        aliases, and the in-flight window and packet sizes follow the limits
+        the broker sends in its CONNACK.
+    :param MQTTMessageQueue message_queue: Optional
+        `adafruit_minimqtt_queue.MQTTMessageQueue`. Received messages are then
+        acknowledged at once and queued, and their callbacks run from
+        `process_messages()` or the queue's executor.
+    :param bool fast_reconnect: Send the resubscribe requests of `reconnect()`
+        right behind CONNECT, without waiting for the CONNACK, to save a round
+        trip. Only used with ``clean_session``, as a resumed session keeps its
+        subscriptions.
 
     """
 
@@ -141,6 +491,14 @@ class MQTT:
         keep_alive=60,
         socket_pool=None,
         ssl_context=None,
+        max_inflight=0,
+        spool=None,
+        raw_payloads=False,
+        clean_session=True,
+        adaptive_keep_alive=False,
+        protocol_version=MQTT_V311,
+        message_queue=None,
+        fast_reconnect=False,
     ):
 
         self._socket_pool = socket_pool
@@ -153,9 +511,61 @@ class MQTT:
         self._is_connected = False
         self._msg_size_lim = MQTT_MSG_SZ_LIM
         self._pid = 0
-        self._timestamp = 0
+        # Time the last packet was sent, and the outstanding PINGREQ was sent
+        self._last_send = 0
+        self._ping_sent = 0
+        # Smoothed round trip time and its mean deviation, in seconds
+        self._srtt = None
+        self._rttvar = None
+        self.adaptive_keep_alive = adaptive_keep_alive
+        if protocol_version not in (MQTT_V311, MQTT_V5):
+            raise MMQTTException("Unsupported MQTT protocol version.")
+        self.protocol_version = protocol_version
+        # Limits from the CONNACK, which MQTT 5 brokers may lower
+        self.connack_properties = {}
+        self._receive_maximum = 0xFFFF
+        self._maximum_qos = 1
+        # Outbound topic aliases keyed by encoded topic, and inbound aliases
+        self._topic_alias_limit = 0
+        self._topic_aliases = {}
+        self._inbound_aliases = {}
+        # QoS 1 messages awaiting a PUBACK, keyed by packet identifier
+        self.max_inflight = max_inflight
+        self._inflight = {}
+        self._spool = spool
+        self._message_queue = message_queue
+        self.fast_reconnect = fast_reconnect
+        self.raw_payloads = raw_payloads
+        self.clean_session = clean_session
+        # Set from the CONNACK, True when the broker resumed a kept session
+        self.session_present = False
+        self.stats = MQTTStats()
+        # Topic of the periodic stats messages, their interval in seconds,
+        # and when the last one was published
+        self._stats_topic = None
+        self._stats_interval = 0
+        self._stats_published = 0
+        # Optional adafruit_minimqtt_ratelimit.MQTTRateLimiter, which loop()
+        # flushes
+        self.rate_limiter = None
         self.logger = None
 
+        # Reusable PUBLISH packet buffer and length-prefixed topic cache
+        self._pub_buf = bytearray(MQTT_PUB_BUF_SZ)
+        self._pub_view = memoryview(self._pub_buf)
+        # view of the last packet sent from the buffer, reused while the
+        # packet size stays the same
+        self._pub_packet = self._pub_view[:0]
+        self._topic_cache = {}
+        self._decoder = MQTTDecoder(max_size=self._msg_size_lim)
+        self._poller = None
+        # Resolved broker address, as (host, port, address info, timestamp)
+        self._addr_cache = None
+        self.addr_cache_ttl = MQTT_ADDR_CACHE_TTL
+        # TLS session of the last secure connection, as (host, port, session),
+        # offered to the broker when reconnecting to skip a full handshake
+        self._tls_session = None
+
         self.broker = broker
         self._username = username
         self._password = password
@@ -191,9 +601,19 @@ class MQTT:
         self._lw_msg = None
         self._lw_retain = False
 
-        # List of subscribed topics, used for tracking
-        self._subscribed_topics = []
+        # Subscribed topics and their QoS, used for resubscribing
+        self._subscribed_topics = {}
+        # Topics of the SUBSCRIBE packets awaiting a SUBACK, by packet id
+        self._subacks = {}
+        # Payload codecs by topic filter, None until one is added
+        self._codecs = None
+        # Largest packet the broker accepts
+        self._max_packet_size = MQTT_MSG_MAX_SZ
         self._on_message_filtered = MQTTMatcher()
+        # (callback, buffer) tuples from add_topic_stream()
+        self._on_message_streams = MQTTMatcher()
+        # header, topic, packet id, target, offset and size of a streamed message
+        self._stream = None
 
         # Default topic callback methods
         self._on_message = None
@@ -204,6 +624,37 @@ class MQTT:
         self.on_unsubscribe = None
 
     # pylint: disable=too-many-branches
+    def _wrap_socket(self, sock, host, port, **kwargs):
+        """Wraps a socket with the SSL context, offering the TLS session of
+        the last secure connection to the same broker when there is one.
+        :param sock: Socket which is not connected yet.
+        :param str host: Broker hostname.
+        :param int port: Broker port.
+
+        Other keyword arguments are passed on to ``wrap_socket``.
+
+        """
+        if self._tls_session is not None:
+            session_host, session_port, session = self._tls_session
+            if session_host == host and session_port == port:
+                try:
+                    return self._ssl_context.wrap_socket(
+                        sock, server_hostname=host, session=session, **kwargs
+                    )
+                except ValueError:
+                    # the session belongs to an earlier SSL context
+                    self._tls_session = None
+        return self._ssl_context.wrap_socket(sock, server_hostname=host, **kwargs)
+
+    def _save_tls_session(self, host, port):
+        """Keeps the TLS session of the current connection for reconnects.
+        Only sockets from CPython's ssl module have sessions. With TLS 1.3 the
+        session ticket follows the handshake, so this is called once the
+        CONNACK was received."""
+        session = getattr(self._sock, "session", None)
+        if session is not None:
+            self._tls_session = (host, port, session)
+
     def _get_connect_socket(self, host, port, *, timeout=1):
         """Obtains a new socket and connects to a broker.
         :param str host: Desired broker hostname
@@ -240,9 +691,7 @@ class MQTT:
                 "Establishing an INSECURE connection to {0}:{1}".format(host, port)
             )
 
-        addr_info = self._socket_pool.getaddrinfo(
-            host, port, 0, self._socket_pool.SOCK_STREAM
-        )[0]
+        addr_info = self._get_addr_info(host, port)
 
         sock = None
         retry_count = 0
@@ -258,10 +707,11 @@ class MQTT:
 
             connect_host = addr_info[-1][0]
             if port == 8883:
-                sock = self._ssl_context.wrap_socket(sock, server_hostname=host)
+                sock = self._wrap_socket(sock, host, port)
                 connect_host = host
             sock.settimeout(timeout)
 
+            stamp = time.monotonic_ns()
             try:
                 sock.connect((connect_host, port))
             except MemoryError:
@@ -270,48 +720,59 @@ class MQTT:
             except OSError:
                 sock.close()
                 sock = None
+                # the broker may have refused to resume the session
+                self._tls_session = None
+            else:
+                if port == 8883:
+                    self.stats.tls_handshake(
+                        time.monotonic_ns() - stamp,
+                        getattr(sock, "session_reused", False),
+                    )
 
         if sock is None:
+            # look the broker up again next time, in case its address changed
+            self._addr_cache = None
             raise RuntimeError("Repeated socket failures")
 
+        # small packets, such as a PUBACK followed by a PUBLISH, should not
+        # wait for the previous one to be acknowledged (Nagle's algorithm)
+        nodelay = getattr(self._socket_pool, "TCP_NODELAY", None)
+        if nodelay is not None and hasattr(sock, "setsockopt"):
+            try:
+                sock.setsockopt(self._socket_pool.IPPROTO_TCP, nodelay, 1)
+            except (OSError, AttributeError):
+                pass
+
         self._backwards_compatible_sock = not hasattr(sock, "recv_into")
         return sock
 
+    def _get_addr_info(self, host, port):
+        """Returns the address information of a broker. The result is cached
+        for ``addr_cache_ttl`` seconds, so reconnects skip the DNS lookup.
+        :param str host: Desired broker hostname
+        :param int port: Desired broker port
+        """
+        now = time.monotonic()
+        cached = self._addr_cache
+        if (
+            cached is not None
+            and cached[0] == host
+            and cached[1] == port
+            and now - cached[3] < self.addr_cache_ttl
+        ):
+            return cached[2]
+        addr_info = self._socket_pool.getaddrinfo(
+            host, port, 0, self._socket_pool.SOCK_STREAM
+        )[0]
+        self._addr_cache = (host, port, addr_info, now)
+        return addr_info
+
     def __enter__(self):
         return self
 
     def __exit__(self, exception_type, exception_value, traceback):
         self.deinit()
 
-    def _sock_exact_recv(self, bufsize):
-        """Reads _exact_ number of bytes from the connected socket. Will only return
-        string with the exact number of bytes requested.
-
-        The semantics of native socket receive is that it returns no more than the
-        specified number of bytes (i.e. max size). However, it makes no guarantees in
-        terms of the minimum size of the buffer, which could be 1 byte. This is a
-        wrapper for socket recv() to ensure that no less than the expected number of
-        bytes is returned or trigger a timeout exception.
-
-        :param int bufsize: number of bytes to receive
-        """
-        stamp = time.monotonic()
-        rc = self._sock.recv(bufsize)
-        to_read = bufsize - len(rc)
-        assert to_read >= 0
-        read_timeout = self.keep_alive
-        while to_read > 0:
-            recv = self._sock.recv(to_read)
-            to_read -= len(recv)
-            rc += recv
-            if time.monotonic() - stamp > read_timeout:
-                raise MMQTTException(
-                    "Unable to receive {} bytes within {} seconds.".format(
-                        to_read, read_timeout
-                    )
-                )
-        return rc
-
     def deinit(self):
         """De-initializes the MQTT client and disconnects from the mqtt broker."""
         self.disconnect()
@@ -324,17 +785,20 @@ class MQTT:
     @mqtt_msg.setter
     def mqtt_msg(self, msg_size):
         """Sets the maximum MQTT message payload size.
+        Larger messages are not buffered: they are passed in pieces to the
+        callbacks added with `add_topic_stream()`, or skipped.
 
         :param int msg_size: Maximum MQTT payload size.
         """
         if msg_size < MQTT_MSG_MAX_SZ:
             self._msg_size_lim = msg_size
+            self._decoder.max_size = msg_size
 
     def will_set(self, topic=None, payload=None, qos=0, retain=False):
         """Sets the last will and testament properties. MUST be called before `connect()`.
 
         :param str topic: MQTT Broker topic.
-        :param int,float,str payload: Last will disconnection payload.
+        :param int,float,str,bytes payload: Last will disconnection payload.
             payloads of type int & float are converted to a string.
         :param int qos: Quality of Service level, defaults to
             zero. Conventional options are ``0`` (send at most once), ``1``
@@ -353,6 +817,8 @@ class MQTT:
             payload = ""
         if isinstance(payload, (int, float, str)):
             payload = str(payload).encode()
+        elif isinstance(payload, (bytes, bytearray, memoryview)):
+            payload = bytes(payload)
         else:
             raise MMQTTException("Invalid message data type.")
         self._lw_qos = qos
@@ -360,15 +826,17 @@ class MQTT:
         self._lw_msg = payload
         self._lw_retain = retain
 
-    def add_topic_callback(self, mqtt_topic, callback_method):
+    def add_topic_callback(self, mqtt_topic, callback_method, raw=None):
         """Registers a callback_method for a specific MQTT topic.
 
         :param str mqtt_topic: MQTT topic identifier.
         :param str callback_method: Name of callback method.
+        :param bool raw: Pass the payload to callback_method as a memoryview
+            instead of a str. Defaults to the client's ``raw_payloads``.
         """
         if mqtt_topic is None or callback_method is None:
             raise ValueError("MQTT topic and callback method must both be defined.")
-        self._on_message_filtered[mqtt_topic] = callback_method
+        self._on_message_filtered[mqtt_topic] = (callback_method, raw)
 
     def remove_topic_callback(self, mqtt_topic):
         """Removes a registered callback method.
@@ -384,11 +852,93 @@ class MQTT:
                 "MQTT topic callback not added with add_topic_callback."
             ) from None
 
+    def add_topic_stream(self, mqtt_topic, callback_method, buffer=None):
+        """Registers a callback_method which receives the messages on a
+        topic without buffering them in the client, for payloads larger
+        than the ``mqtt_msg`` limit such as images or firmware.
+
+        Without a buffer, the payload is passed on in pieces as it arrives,
+        with ``callback_method(client, topic, piece, offset, size)``, where
+        piece is a memoryview which is only valid until the callback returns,
+        offset its position in the payload and size the size of the whole
+        payload. With a buffer, the payload is received into the buffer and
+        ``callback_method(client, topic, payload)`` is called with a
+        memoryview of it. Messages larger than the buffer are skipped.
+
+        :param str mqtt_topic: MQTT topic identifier.
+        :param callback_method: Function receiving the payload.
+        :param bytearray buffer: Preallocated buffer to receive payloads into.
+        """
+        if mqtt_topic is None or callback_method is None:
+            raise ValueError("MQTT topic and callback method must both be defined.")
+        self._on_message_streams[mqtt_topic] = (callback_method, buffer)
+
+    def remove_topic_stream(self, mqtt_topic):
+        """Removes a callback method registered with `add_topic_stream()`.
+
+        :param str mqtt_topic: MQTT topic identifier string.
+        """
+        if mqtt_topic is None:
+            raise ValueError("MQTT Topic must be defined.")
+        try:
+            del self._on_message_streams[mqtt_topic]
+        except KeyError:
+            raise KeyError(
+                "MQTT topic stream not added with add_topic_stream."
+            ) from None
+
+    def add_topic_codec(self, mqtt_topic, codec):
+        """Registers a payload codec, such as one from
+        `adafruit_minimqtt_codecs`, for the topics matching a topic filter.
+        Values published to those topics are encoded with the codec, unless
+        they are already bytes, bytearray or memoryview. Callbacks which
+        would get a str payload get the decoded value instead.
+
+        :param str mqtt_topic: MQTT topic filter, which may have wildcards.
+            Filters of different codecs should not overlap.
+        :param codec: Object with ``encode(value)`` and ``decode(payload)``
+            methods.
+        """
+        if mqtt_topic is None or codec is None:
+            raise ValueError("MQTT topic and codec must both be defined.")
+        if self._codecs is None:
+            self._codecs = MQTTMatcher()
+        self._codecs[mqtt_topic] = codec
+
+    def remove_topic_codec(self, mqtt_topic):
+        """Removes a codec registered with `add_topic_codec()`.
+
+        :param str mqtt_topic: MQTT topic filter.
+        """
+        if mqtt_topic is None:
+            raise ValueError("MQTT Topic must be defined.")
+        try:
+            del self._codecs[mqtt_topic]
+        except (KeyError, TypeError):
+            raise KeyError("MQTT topic codec not added with add_topic_codec.") from None
+
+    def _topic_codec(self, topic):
+        """Returns the codec for a topic, or None."""
+        if self._codecs is not None and topic is not None:
+            for codec in self._codecs.iter_match(topic):
+                return codec
+        return None
+
+    def _encode_message(self, topic, msg):
+        """Encodes a message with the codec of its topic, if there is one."""
+        if self._codecs is None or isinstance(msg, (bytes, bytearray, memoryview)):
+            return msg
+        codec = self._topic_codec(topic)
+        return msg if codec is None else codec.encode(msg)
+
     @property
     def on_message(self):
         """Called when a new message has been received on a subscribed topic.
 
         Expected method signature is ``on_message(client, topic, message)``
+
+        With ``raw_payloads`` set, message is a memoryview of the received
+        payload, which is only valid until the callback returns.
         """
         return self._on_message
 
@@ -396,15 +946,37 @@ class MQTT:
     def on_message(self, method):
         self._on_message = method
 
-    def _handle_on_message(self, client, topic, message):
+    def _handle_on_message(self, client, topic, payload):
+        """Dispatches a received message to the matching callbacks.
+        The payload is decoded to a str, or by the codec of the topic, once,
+        for the callbacks which want it.
+        :param memoryview payload: Received payload.
+
+        """
         matched = False
+        message = None
         if topic is not None:
-            for callback in self._on_message_filtered.iter_match(topic):
-                callback(client, topic, message)  # on_msg with callback
+            for callback, raw in self._on_message_filtered.iter_match(topic):
+                if raw if raw is not None else self.raw_payloads:
+                    callback(client, topic, payload)
+                else:
+                    if message is None:
+                        message = self._decode_message(topic, payload)
+                    callback(client, topic, message)  # on_msg with callback
                 matched = True
 
         if not matched and self.on_message:  # regular on_message
-            self.on_message(client, topic, message)
+            if self.raw_payloads:
+                self.on_message(client, topic, payload)
+            else:
+                self.on_message(client, topic, self._decode_message(topic, payload))
+
+    def _decode_message(self, topic, payload):
+        """Decodes a payload with the codec of its topic, or to a str."""
+        codec = self._topic_codec(topic)
+        if codec is None:
+            return str(payload, "utf-8")
+        return codec.decode(payload)
 
     def username_pw_set(self, username, password=None):
         """Set client's username and an optional password.
@@ -419,9 +991,12 @@ class MQTT:
             self._password = password
 
     # pylint: disable=too-many-branches, too-many-statements, too-many-locals
-    def connect(self, clean_session=True, host=None, port=None, keep_alive=None):
+    def connect(self, clean_session=None, host=None, port=None, keep_alive=None):
         """Initiates connection with the MQTT Broker.
-        :param bool clean_session: Establishes a persistent session.
+        Returns the session present flag of the CONNACK.
+        :param bool clean_session: Start a new session instead of resuming the
+            one kept by the broker. Defaults to the ``clean_session`` given to
+            the constructor, and is kept for later reconnects.
         :param str host: Hostname or IP address of the remote broker.
         :param int port: Network port of the remote broker.
         :param int keep_alive: Maximum period allowed for communication, in seconds.
@@ -433,36 +1008,104 @@ class MQTT:
             self.port = port
         if keep_alive:
             self.keep_alive = keep_alive
+        if clean_session is not None:
+            self.clean_session = clean_session
 
+        return self._connect()
+
+    def _connect(self, topics=None):
+        """Opens a connection, sends CONNECT and waits for the CONNACK.
+        Returns the session present flag.
+        :param list topics: (topic, qos) tuples subscribed to right behind
+            CONNECT, before the CONNACK arrives. Their SUBACKs are waited
+            for once the connection is accepted.
+
+        """
         if self.logger:
             self.logger.debug("Attempting to establish MQTT connection...")
 
         # Get a new socket
         self._sock = self._get_connect_socket(self.broker, self.port)
+        pids = self._start_connect(topics)
+        if self.logger:
+            self.logger.debug("Receiving CONNACK packet from broker")
+        while True:
+            op = self._wait_for_msg()
+            if op == 32:
+                return self._connack_received(pids)
+
+    def _start_connect(self, topics=None):
+        """Sends CONNECT, and the SUBSCRIBE packets of topics, on the new
+        socket in ``_sock``. Returns the packet identifiers of the SUBSCRIBE
+        packets.
+        :param list topics: (topic, qos) tuples to subscribe to.
+
+        """
+        self._decoder.reset()
+        self._poller = self._get_poller(self._sock)
+        self._subacks = {}
+        self._send_connect(self.clean_session)
+        pids = []
+        if topics:
+            # the broker handles packets in order, so it only reads the
+            # SUBSCRIBE once it accepted the connection
+            for pid, batch in self._send_subscribe(topics):
+                self._subacks[pid] = batch
+                pids.append(pid)
+        return pids
+
+    def _connack_received(self, pids):
+        """Processes the CONNACK in the decoder, sends the spooled messages
+        and waits for the SUBACKs of pids. Returns the session present flag.
+        :param list pids: Packet identifiers from `_start_connect()`.
 
+        """
+        result = self._handle_connack(self._decoder.body)
+        self._save_tls_session(self.broker, self.port)
+        self._flush_spool()
+        self._wait_subacks(pids)
+        return result
+
+    def _send_connect(self, clean_session):
+        """Sends a CONNECT packet to the broker.
+        :param bool clean_session: Establishes a persistent session.
+
+        """
         # Fixed Header
         fixed_header = bytearray([0x10])
 
         # NOTE: Variable header is
         # MQTT_HDR_CONNECT = bytearray(b"\x04MQTT\x04\x02\0\0")
         # because final 4 bytes are 4, 2, 0, 0
-        var_header = MQTT_HDR_CONNECT
+        # copied, as clients in other threads may connect at the same time
+        var_header = bytearray(MQTT_HDR_CONNECT)
+        var_header[5] = self.protocol_version
         var_header[6] = clean_session << 1
+        properties = b""
+        if self.protocol_version == MQTT_V5:
+            properties = self._connect_properties(clean_session)
+            # topic aliases only last for one connection
+            self._topic_aliases = {}
+            self._inbound_aliases = {}
 
         # Set up variable header and remaining_length
-        remaining_length = 12 + len(self.client_id)
+        remaining_length = 12 + len(self.client_id) + len(properties)
         if self._username:
             remaining_length += 2 + len(self._username) + 2 + len(self._password)
             var_header[6] |= 0xC0
-        if self.keep_alive:
-            assert self.keep_alive < MQTT_TOPIC_LENGTH_LIMIT
-            var_header[7] |= self.keep_alive >> 8
-            var_header[8] |= self.keep_alive & 0x00FF
+        # zero disables keep alive
+        assert self.keep_alive < MQTT_TOPIC_LENGTH_LIMIT
+        var_header[7] = self.keep_alive >> 8
+        var_header[8] = self.keep_alive & 0x00FF
         if self._lw_topic:
             remaining_length += 2 + len(self._lw_topic) + 2 + len(self._lw_msg)
+            if properties:
+                # empty will properties
+                remaining_length += 1
             var_header[6] |= 0x4 | (self._lw_qos & 0x1) << 3 | (self._lw_qos & 0x2) << 3
             var_header[6] |= self._lw_retain << 5
 
+        packet_length = remaining_length
         # Remaining length calculation
         large_rel_length = False
         if remaining_length > 0x7F:
@@ -480,39 +1123,79 @@ class MQTT:
         else:
             fixed_header.append(remaining_length)
             fixed_header.append(0x00)
+        # the last byte of fixed_header starts the variable header
+        self.stats.sent(0x10, len(fixed_header) - 1 + packet_length)
 
         if self.logger:
             self.logger.debug("Sending CONNECT to broker...")
             self.logger.debug(
                 "Fixed Header: %s\nVariable Header: %s", fixed_header, var_header
             )
-        self._sock.send(fixed_header)
-        self._sock.send(var_header)
+        # the whole packet goes out with one send
+        packet = fixed_header + var_header + properties
         # [MQTT-3.1.3-4]
-        self._send_str(self.client_id)
+        packet += self._encode_str(self.client_id)
         if self._lw_topic:
+            if properties:
+                packet.append(0x00)
             # [MQTT-3.1.3-11]
-            self._send_str(self._lw_topic)
-            self._send_str(self._lw_msg)
-        if self._username is None:
-            self._username = None
+            packet += self._encode_str(self._lw_topic)
+            packet += self._encode_str(self._lw_msg)
+        if self._username is not None:
+            packet += self._encode_str(self._username)
+            packet += self._encode_str(self._password)
+        self._sock_sendall(packet)
+        self._ping_sent = 0
+
+    def _connect_properties(self, clean_session):
+        """Returns the length-prefixed properties of an MQTT 5 CONNECT packet.
+        :param bool clean_session: Whether the session ends with the connection.
+
+        """
+        properties = struct.pack("!BH", _PROP_TOPIC_ALIAS_MAXIMUM, MQTT_TOPIC_ALIAS_MAX)
+        if not clean_session:
+            # the session ends with the connection unless it has an expiry
+            properties += struct.pack("!BI", _PROP_SESSION_EXPIRY, 0xFFFFFFFF)
+        return bytes((len(properties),)) + properties
+
+    def _handle_connack(self, rc):
+        """Processes the variable header of a CONNACK packet.
+        :param memoryview rc: Acknowledge flags, return code and, with MQTT 5,
+            properties.
+
+        """
+        properties = {}
+        if self.protocol_version == MQTT_V5 and len(rc) > 2:
+            properties = self._decode_properties(rc, 2)[0]
         else:
-            self._send_str(self._username)
-            self._send_str(self._password)
+            assert len(rc) == 0x02
+        if rc[1] != 0x00:
+            raise MMQTTException(
+                CONNACK_ERRORS.get(
+                    rc[1], "Connection Refused - Reason Code 0x{:02X}".format(rc[1])
+                )
+            )
+        # broker limits, which default to none [MQTT5 3.2.2.3]
+        self.connack_properties = properties
+        self._receive_maximum = properties.get(_PROP_RECEIVE_MAXIMUM, 0xFFFF)
+        self._max_packet_size = properties.get(
+            _PROP_MAXIMUM_PACKET_SIZE, MQTT_MSG_MAX_SZ
+        )
+        self._topic_alias_limit = properties.get(_PROP_TOPIC_ALIAS_MAXIMUM, 0)
+        self._maximum_qos = properties.get(_PROP_MAXIMUM_QOS, 1)
+        if _PROP_SERVER_KEEP_ALIVE in properties:
+            self.keep_alive = properties[_PROP_SERVER_KEEP_ALIVE]
+        if _PROP_ASSIGNED_CLIENT_ID in properties:
+            self.client_id = properties[_PROP_ASSIGNED_CLIENT_ID]
+        self._is_connected = True
+        # Session Present flag [MQTT-3.2.2-2]
+        result = rc[0] & 1
+        self.session_present = bool(result)
         if self.logger:
-            self.logger.debug("Receiving CONNACK packet from broker")
-        while True:
-            op = self._wait_for_msg()
-            if op == 32:
-                rc = self._sock_exact_recv(3)
-                assert rc[0] == 0x02
-                if rc[2] != 0x00:
-                    raise MMQTTException(CONNACK_ERRORS[rc[2]])
-                self._is_connected = True
-                result = rc[0] & 1
-                if self.on_connect is not None:
-                    self.on_connect(self, self._user_data, result, rc[2])
-                return result
+            self.logger.debug("Session present: %s", self.session_present)
+        if self.on_connect is not None:
+            self.on_connect(self, self._user_data, result, rc[1])
+        return result
 
     def disconnect(self):
         """Disconnects the MiniMQTT client from the MQTT broker."""
@@ -521,6 +1204,7 @@ class MQTT:
             self.logger.debug("Sending DISCONNECT packet to broker")
         try:
             self._sock.send(MQTT_DISCONNECT)
+            self.stats.sent(0xE0, 2)
         except RuntimeError as e:
             if self.logger:
                 self.logger.warning("Unable to send DISCONNECT packet: {}".format(e))
@@ -528,7 +1212,8 @@ class MQTT:
             self.logger.debug("Closing socket")
         self._sock.close()
         self._is_connected = False
-        self._subscribed_topics = []
+        if self.clean_session:
+            self._subscribed_topics = {}
         if self.on_disconnect is not None:
             self.on_disconnect(self, self._user_data, 0)
 
@@ -538,104 +1223,626 @@ class MQTT:
         Returns response codes of any messages received while waiting for PINGRESP.
         """
         self.is_connected()
-        if self.logger:
-            self.logger.debug("Sending PINGREQ")
-        self._sock.send(MQTT_PINGREQ)
-        ping_timeout = self.keep_alive
-        stamp = time.monotonic()
-        rc, rcs = None, []
-        while rc != MQTT_PINGRESP:
+        self._send_ping()
+        stamp = self._ping_sent
+        rcs = []
+        while self._ping_sent:
             rc = self._wait_for_msg()
             if rc:
                 rcs.append(rc)
-            if time.monotonic() - stamp > ping_timeout:
+            if time.monotonic() - stamp > self._ping_timeout():
                 raise MMQTTException("PINGRESP not returned from broker.")
         return rcs
 
+    def _send_ping(self):
+        """Sends a PINGREQ without waiting for the PINGRESP. The PINGRESP is
+        matched when it arrives, and its round trip time recorded."""
+        if self.logger:
+            self.logger.debug("Sending PINGREQ")
+        self._sock_sendall(MQTT_PINGREQ)
+        self.stats.sent(0xC0, 2)
+        self._ping_sent = self._last_send
+
+    def _ping_timeout(self):
+        """Returns how long to wait for a PINGRESP, in seconds."""
+        if self.adaptive_keep_alive and self._srtt is not None:
+            # retransmission timeout of RFC 6298, at least one second
+            return min(self.keep_alive, max(1, self._srtt + 4 * self._rttvar))
+        return self.keep_alive
+
+    def _update_rtt(self, rtt):
+        """Adds a round trip time sample to the smoothed RTT and jitter.
+        :param float rtt: Round trip time of a PINGREQ, in seconds.
+
+        """
+        if self._srtt is None:
+            self._srtt = rtt
+            self._rttvar = rtt / 2
+        else:
+            self._rttvar += (abs(self._srtt - rtt) - self._rttvar) / 4
+            self._srtt += (rtt - self._srtt) / 8
+        self.stats.rtt = self._srtt
+        self.stats.rtt_jitter = self._rttvar
+
+    @property
+    def rtt(self):
+        """Smoothed round trip time to the broker, in seconds, measured by
+        keep alive pings. It includes any delay before `loop()` reads the
+        PINGRESP. None until the first PINGRESP."""
+        return self._srtt
+
+    @property
+    def rtt_jitter(self):
+        """Mean deviation of the round trip time, in seconds.
+        None until the first PINGRESP."""
+        return self._rttvar
+
     # pylint: disable=too-many-branches, too-many-statements
     def publish(self, topic, msg, retain=False, qos=0):
         """Publishes a message to a topic provided.
         :param str topic: Unique topic identifier.
-        :param str,int,float msg: Data to send to the broker.
+        :param str,int,float,bytes,bytearray,memoryview msg: Data to send to
+            the broker. Binary payloads are sent unchanged. Other values are
+            encoded by the codec of the topic, if one was added with
+            `add_topic_codec()`, and can then be of any type it encodes.
         :param bool retain: Whether the message is saved by the broker.
         :param int qos: Quality of Service level for the message, defaults to zero.
 
+        With ``max_inflight`` set, a QoS 1 publish returns as soon as it is sent
+        and only waits while ``max_inflight`` messages are already unacknowledged.
+        PUBACKs are then handled by `loop()`, which calls `on_publish` per message.
+
+        With a ``spool``, messages published while disconnected are written to
+        the spool instead of raising, and are sent once `connect()` succeeds.
+        QoS 0 messages which fail to send are spooled before the error is raised.
+
+        """
+        if qos > 0 and self._is_connected:
+            # wait for a free slot in the in-flight window
+            while self._window_full():
+                self._wait_for_msg()
+        pid = self._send_publish_msg(topic, msg, retain, qos)
+        if qos == 1 and not self.max_inflight:
+            while pid in self._inflight:
+                self._wait_for_msg()
+
+    def publish_many(self, messages, wait=True):
+        """Publishes several messages, encoded into one buffer and written
+        to the socket together instead of one message at a time.
+        Returns the number of messages sent or spooled.
+        :param list messages: ``(topic, msg, qos, retain)`` tuples, where qos
+            and retain may be left out. Messages are checked as by `publish()`
+            before any of them is sent.
+        :param bool wait: Set to False to send only the messages which fit in
+            the in-flight window now, and return without waiting for PUBACKs,
+            which `loop()` then handles.
+
+        QoS 1 messages are sent in one go while the broker's Receive Maximum
+        and ``max_inflight`` allow, then their PUBACKs are handled together:
+        without ``max_inflight``, this waits until every PUBACK has arrived.
+        Messages published while disconnected go to the ``spool``, if set.
+
+        .. code-block:: python
+
+            mqtt_client.publish_many([("sensors/temp", 21.5), ("sensors/rh", 40, 1)])
+
+        """
+        entries = self._publish_entries(messages)
+        if self._spool is not None and (self._sock is None or not self._is_connected):
+            for _, topic_bytes, msg, qos, retain in entries:
+                self._spool_publish(topic_bytes, msg, retain, qos)
+            return len(entries)
+        if not wait:
+            end = self._batch_end(entries, 0)
+            if end:
+                self._send_publish_batch(entries[:end])
+            return end
+        pids = []
+        start = 0
+        while start < len(entries):
+            end = self._batch_end(entries, start)
+            if end == start:
+                # wait for a free slot in the in-flight window, and handle
+                # the PUBACKs which arrived with it, to send larger batches
+                self._wait_for_msg()
+                while self._sock_has_data():
+                    self._wait_for_msg()
+                continue
+            pids.extend(self._send_publish_batch(entries[start:end]))
+            start = end
+        if not self.max_inflight:
+            for pid in pids:
+                while pid in self._inflight:
+                    self._wait_for_msg()
+        return len(entries)
+
+    def _send_publish_msg(self, topic, msg, retain, qos):
+        """Validates and sends a PUBLISH packet without waiting for a PUBACK.
+        QoS 1 messages are added to the in-flight messages.
+        Returns the packet identifier of the message, or zero if it was spooled.
+
+        """
+        if self._spool is None:
+            self.is_connected()
+        topic_bytes = self._topic_bytes(topic)
+        msg = self._publish_payload(self._encode_message(topic, msg), qos)
+        self._check_publish_size(topic_bytes, msg, qos)
+
+        if self._sock is None or not self._is_connected:
+            if self.logger:
+                self.logger.debug("Not connected, spooling PUBLISH to %s", topic)
+            # the packet identifier is assigned when the spool is sent
+            self._spool_publish(topic_bytes, msg, retain, qos)
+            return 0
+
+        if qos > 0:
+            # packet identifier where QoS level is 1 or 2. [3.3.2.2]
+            self._next_pid()
+            # keep a copy of mutable payloads for retransmission
+            if not isinstance(msg, bytes):
+                msg = bytes(msg)
+            self._inflight[self._pid] = (
+                topic,
+                topic_bytes,
+                msg,
+                retain,
+                time.monotonic_ns(),
+            )
+
+        if self.logger:
+            self.logger.debug(
+                "Sending PUBLISH\nTopic: %s\nMsg: %s\
+                                \nQoS: %d\nRetain? %r",
+                topic,
+                msg,
+                qos,
+                retain,
+            )
+        try:
+            self._send_publish(topic_bytes, msg, retain, qos, self._pid)
+        except (OSError, RuntimeError):
+            # QoS 1 messages stay in flight and are resent by reconnect()
+            if self._spool is not None and qos == 0:
+                self._spool_publish(topic_bytes, msg, retain, qos)
+            raise
+        if qos == 0 and self.on_publish is not None:
+            self.on_publish(self, self._user_data, topic, self._pid)
+        return self._pid
+
+    def _publish_payload(self, msg, qos):
+        """Checks a message and its QoS level, and returns the payload to send.
+        :param str,int,float,bytes,bytearray,memoryview msg: Message to publish.
+        :param int qos: Quality of Service level for the message.
+
         """
-        self.is_connected()
-        self._valid_topic(topic)
-        if "+" in topic or "#" in topic:
-            raise MMQTTException("Publish topic can not contain wildcards.")
-        # check msg/qos kwargs
         if msg is None:
             raise MMQTTException("Message can not be None.")
         if isinstance(msg, (int, float)):
             msg = str(msg).encode("ascii")
         elif isinstance(msg, str):
             msg = str(msg).encode("utf-8")
-        else:
+        elif not isinstance(msg, (bytes, bytearray, memoryview)):
             raise MMQTTException("Invalid message data type.")
         if len(msg) > MQTT_MSG_MAX_SZ:
             raise MMQTTException("Message size larger than %d bytes." % MQTT_MSG_MAX_SZ)
         assert (
             0 <= qos <= 1
         ), "Quality of Service Level 2 is unsupported by this library."
+        if qos > self._maximum_qos:
+            raise MMQTTException("QoS %d is not supported by the broker." % qos)
+        return msg
+
+    def _check_publish_size(self, topic_bytes, msg, qos):
+        """Raises MMQTTException when a PUBLISH packet, without a topic alias,
+        would be larger than the broker's Maximum Packet Size. Checked before
+        a packet identifier or a topic alias is assigned to the message.
+        """
+        length = len(topic_bytes) + len(msg) + 2 * (qos > 0)
+        length += self.protocol_version == MQTT_V5
+        size = length + 2 + (length > 0x7F) + (length > 0x3FFF)
+        size += length > 0x1FFFFF
+        if size > self._max_packet_size:
+            raise MMQTTException(
+                "Packet size %d larger than the broker's maximum of %d bytes."
+                % (size, self._max_packet_size)
+            )
 
-        # fixed header. [3.3.1.2], [3.3.1.3]
-        pub_hdr_fixed = bytearray([0x30 | retain | qos << 1])
+    def _window_full(self):
+        """Returns True when no more QoS 1 messages may await a PUBACK, either
+        because of ``max_inflight`` or the broker's Receive Maximum."""
+        limit = self._receive_maximum
+        if self.max_inflight:
+            limit = min(self.max_inflight, limit)
+        return len(self._inflight) >= limit
+
+    def _publish_entries(self, messages):
+        """Checks the messages given to `publish_many()` and returns them as
+        (topic, topic_bytes, msg, qos, retain) tuples."""
+        if self._spool is None:
+            self.is_connected()
+        entries = []
+        for message in messages:
+            topic, msg = message[0], message[1]
+            qos = message[2] if len(message) > 2 else 0
+            retain = message[3] if len(message) > 3 else False
+            topic_bytes = self._topic_bytes(topic)
+            encoded = self._encode_message(topic, msg)
+            if encoded is not msg:
+                # codecs reuse their buffer for the next message
+                encoded = bytes(encoded)
+            msg = self._publish_payload(encoded, qos)
+            # checked here so that a message which is too large can not
+            # stop a batch half way
+            self._check_publish_size(topic_bytes, msg, qos)
+            entries.append((topic, topic_bytes, msg, qos, retain))
+        return entries
+
+    def _batch_end(self, entries, start):
+        """Returns the end of the next batch of entries which can be sent
+        without exceeding the in-flight window."""
+        limit = self._receive_maximum
+        if self.max_inflight:
+            limit = min(self.max_inflight, limit)
+        free = limit - len(self._inflight)
+        end = start
+        while end < len(entries):
+            if entries[end][3] > 0:
+                if free == 0:
+                    break
+                free -= 1
+            end += 1
+        return end
+
+    def _send_publish_batch(self, entries):
+        """Encodes PUBLISH packets into one buffer and sends it with a single
+        socket send. QoS 1 messages are added to the in-flight messages.
+        Returns the packet identifiers of the QoS 1 messages.
+        :param list entries: Tuples from `_publish_entries()`.
+
+        """
+        # packet headers take at most 11 bytes besides the topic
+        buf = bytearray(sum(len(entry[1]) + len(entry[2]) + 11 for entry in entries))
+        now = time.monotonic_ns()
+        pids = []
+        offset = 0
+        for topic, topic_bytes, msg, qos, retain in entries:
+            pid = 0
+            if qos > 0:
+                pid = self._next_pid()
+                if not isinstance(msg, bytes):
+                    msg = bytes(msg)
+                self._inflight[pid] = (topic, topic_bytes, msg, retain, now)
+                pids.append(pid)
+            alias = 0
+            send_topic = topic_bytes
+            if self._topic_alias_limit:
+                alias, send_topic = self._topic_alias(topic_bytes)
+            start = offset
+            offset = self._encode_publish_header(
+                buf, offset, send_topic, len(msg), retain, qos, pid, alias=alias
+            )
+            buf[offset : offset + len(msg)] = msg
+            offset += len(msg)
+            self.stats.sent(buf[start], offset - start)
+        if self.logger:
+            self.logger.debug(
+                "Sending %d PUBLISH packets, %d bytes", len(entries), offset
+            )
+        try:
+            self._sock_sendall(memoryview(buf)[:offset])
+        except (OSError, RuntimeError):
+            # QoS 1 messages stay in flight and are resent by reconnect()
+            if self._spool is not None:
+                for _, topic_bytes, msg, qos, retain in entries:
+                    if qos == 0:
+                        self._spool_publish(topic_bytes, msg, retain, 0)
+            raise
+        if self.on_publish is not None:
+            for topic, _, _, qos, _ in entries:
+                if qos == 0:
+                    self.on_publish(self, self._user_data, topic, self._pid)
+        return pids
+
+    def _next_pid(self):
+        """Advances to the next packet identifier not awaiting a PUBACK."""
+        self._pid = self._pid + 1 if self._pid < 0xFFFF else 1
+        while self._pid in self._inflight:
+            self._pid = self._pid + 1 if self._pid < 0xFFFF else 1
+        return self._pid
 
-        # variable header = 2-byte Topic length (big endian)
-        pub_hdr_var = bytearray(struct.pack(">H", len(topic)))
-        pub_hdr_var.extend(topic.encode("utf-8"))  # Topic name
+    def _handle_puback(self, pid, reason_code=0):
+        """Resolves an in-flight QoS 1 message once its PUBACK arrives.
+        :param int pid: Packet identifier of the acknowledged message.
+        :param int reason_code: MQTT 5 reason code, 0x80 or more when the
+            broker did not accept the message.
 
-        remaining_length = 2 + len(msg) + len(topic)
+        """
+        pending = self._inflight.pop(pid, None)
+        if pending is None:
+            if self.logger:
+                self.logger.debug("Got PUBACK for unknown packet id %d", pid)
+            return
+        if self._spool is not None and self._is_connected:
+            # the window has room for another spooled message
+            self._flush_spool()
+        if reason_code >= 0x80:
+            if self.logger:
+                self.logger.warning(
+                    "PUBLISH to %s rejected, reason code 0x%02X",
+                    pending[0],
+                    reason_code,
+                )
+            return
+        elapsed = time.monotonic_ns() - pending[4]
+        self.stats.pubacks += 1
+        self.stats.puback_ns += elapsed
+        self.stats.puback_max_ns = max(self.stats.puback_max_ns, elapsed)
+        if self.on_publish is not None:
+            self.on_publish(self, self._user_data, pending[0], pid)
+
+    def _resend_inflight(self):
+        """Retransmits unacknowledged QoS 1 messages with the DUP flag set."""
+        for pid, (_, topic_bytes, msg, retain, _) in self._inflight.items():
+            if self.logger:
+                self.logger.debug("Resending PUBLISH with packet id %d", pid)
+            self._send_publish(topic_bytes, msg, retain, 1, pid, dup=True)
+
+    def _topic_bytes(self, topic):
+        """Returns the length-prefixed UTF-8 encoding of a publish topic.
+        Encoded topics are cached, so topics which are published often are
+        validated and encoded only once.
+        :param str topic: Unique topic identifier.
+
+        """
+        encoded = self._topic_cache.get(topic)
+        if encoded is not None:
+            return encoded
+        self._valid_topic(topic)
+        if "+" in topic or "#" in topic:
+            raise MMQTTException("Publish topic can not contain wildcards.")
+        encoded = topic.encode("utf-8")
+        encoded = struct.pack("!H", len(encoded)) + encoded
+        if len(self._topic_cache) >= MQTT_TOPIC_CACHE_SZ:
+            # evict one entry to bound the cache size
+            del self._topic_cache[next(iter(self._topic_cache))]
+        self._topic_cache[topic] = encoded
+        return encoded
+
+    @staticmethod
+    def _encode_remaining_length(buf, offset, length):
+        """Writes a variable length Remaining Length [2.2.3] into a buffer.
+        Returns the offset of the byte after the encoded length.
+        :param bytearray buf: Destination buffer.
+        :param int offset: Position of the first length byte in buf.
+        :param int length: Remaining length to encode.
+
+        """
+        while True:
+            encoded_byte = length & 0x7F
+            length >>= 7
+            if length > 0:
+                encoded_byte |= 0x80
+            buf[offset] = encoded_byte
+            offset += 1
+            if length == 0:
+                return offset
+
+    # pylint: disable=too-many-arguments
+    def _encode_publish_header(
+        self, buf, offset, topic_bytes, msg_len, retain, qos, pid, dup=False, alias=0
+    ):
+        """Writes the fixed and variable headers of a PUBLISH packet into a buffer.
+        Returns the offset at which the payload starts.
+        :param bytearray buf: Destination buffer, large enough for the headers.
+        :param int offset: Position of the first header byte in buf.
+        :param bytes topic_bytes: Length-prefixed topic from `_topic_bytes`.
+        :param int msg_len: Length of the payload, in bytes.
+        :param bool retain: Whether the message is saved by the broker.
+        :param int qos: Quality of Service level for the message.
+        :param int pid: Packet identifier, used when qos is 1.
+        :param bool dup: Marks the packet as a redelivery. [3.3.1.1]
+        :param int alias: MQTT 5 topic alias, or zero for none.
+
+        """
+        v5 = self.protocol_version == MQTT_V5
+        # fixed header. [3.3.1.1], [3.3.1.2], [3.3.1.3]
+        buf[offset] = 0x30 | dup << 3 | qos << 1 | retain
+        remaining_length = len(topic_bytes) + msg_len
         if qos > 0:
-            # packet identifier where QoS level is 1 or 2. [3.3.2.2]
             remaining_length += 2
-            self._pid = self._pid + 1 if self._pid < 0xFFFF else 1
-            pub_hdr_var.append(self._pid >> 8)
-            pub_hdr_var.append(self._pid & 0xFF)
+        if v5:
+            # property length, and the topic alias property
+            remaining_length += 4 if alias else 1
+        offset = self._encode_remaining_length(buf, offset + 1, remaining_length)
+        # variable header = 2-byte topic length, topic name [3.3.2]
+        end = offset + len(topic_bytes)
+        buf[offset:end] = topic_bytes
+        if qos > 0:
+            buf[end] = pid >> 8
+            buf[end + 1] = pid & 0xFF
+            end += 2
+        if v5:
+            if alias:
+                buf[end : end + 4] = struct.pack("!BBH", 3, _PROP_TOPIC_ALIAS, alias)
+                end += 4
+            else:
+                buf[end] = 0
+                end += 1
+        return end
+
+    # pylint: disable=too-many-arguments
+    def _send_publish(self, topic_bytes, msg, retain, qos, pid, dup=False):
+        """Encodes a PUBLISH packet into the reusable publish buffer and sends it.
+        Packets which fit the buffer are sent with a single socket send,
+        larger payloads are sent straight from msg after the headers.
+
+        In MQTT 5 mode the topic is replaced by a topic alias once the alias
+        has been sent, while the broker allows more aliases.
 
-        # Calculate remaining length [2.2.3]
-        if remaining_length > 0x7F:
-            while remaining_length > 0:
-                encoded_byte = remaining_length % 0x80
-                remaining_length = remaining_length // 0x80
-                if remaining_length > 0:
-                    encoded_byte |= 0x80
-                pub_hdr_fixed.append(encoded_byte)
+        """
+        alias = 0
+        send_topic = topic_bytes
+        if self._topic_alias_limit:
+            alias, send_topic = self._topic_alias(topic_bytes)
+        try:
+            offset = self._encode_publish(send_topic, msg, retain, qos, pid, dup, alias)
+        except MMQTTException:
+            if alias and send_topic is topic_bytes:
+                # the broker never learns an alias which was not sent
+                del self._topic_aliases[topic_bytes]
+            raise
+        end = offset + len(msg)
+        if end <= len(self._pub_buf):
+            self._sock_sendall(self._pub_slice(end))
         else:
-            pub_hdr_fixed.append(remaining_length)
+            self._sock_sendall(self._pub_slice(offset))
+            self._sock_sendall(msg)
+        self.stats.sent(self._pub_buf[0], end)
 
-        if self.logger:
-            self.logger.debug(
-                "Sending PUBLISH\nTopic: %s\nMsg: %s\
-                                \nQoS: %d\nRetain? %r",
-                topic,
-                msg,
-                qos,
-                retain,
+    def _topic_alias(self, topic_bytes):
+        """Returns the MQTT 5 topic alias for a topic, or zero once the
+        broker's Topic Alias Maximum is used up, and the topic to send with it:
+        the full topic when the alias is new, otherwise an empty topic.
+        :param bytes topic_bytes: Length-prefixed topic from `_topic_bytes`.
+
+        """
+        alias = self._topic_aliases.get(topic_bytes)
+        if alias is not None:
+            return alias, b"\x00\x00"
+        if len(self._topic_aliases) < self._topic_alias_limit:
+            alias = len(self._topic_aliases) + 1
+            self._topic_aliases[topic_bytes] = alias
+            return alias, topic_bytes
+        return 0, topic_bytes
+
+    # pylint: disable=too-many-arguments
+    def _encode_publish(self, topic_bytes, msg, retain, qos, pid, dup=False, alias=0):
+        """Encodes a PUBLISH packet into the reusable publish buffer.
+        Returns the size of the headers. The payload follows them in the
+        buffer when the whole packet fits, otherwise msg is sent after them.
+        Nothing is allocated once the buffer is large enough.
+
+        """
+        buf = self._pub_buf
+        # 1 fixed header byte, up to 4 remaining length bytes, 2 pid bytes,
+        # and up to 4 property bytes
+        header_len = len(topic_bytes) + 11
+        if header_len > len(buf):
+            buf = self._pub_buf = bytearray(header_len)
+            self._pub_view = memoryview(buf)
+            self._pub_packet = self._pub_view[:0]
+        offset = self._encode_publish_header(
+            buf, 0, topic_bytes, len(msg), retain, qos, pid, dup, alias
+        )
+        end = offset + len(msg)
+        if end > self._max_packet_size:
+            raise MMQTTException(
+                "Packet size %d larger than the broker's maximum of %d bytes."
+                % (end, self._max_packet_size)
             )
-        self._sock.send(pub_hdr_fixed)
-        self._sock.send(pub_hdr_var)
-        self._sock.send(msg)
-        if qos == 0 and self.on_publish is not None:
-            self.on_publish(self, self._user_data, topic, self._pid)
-        if qos == 1:
+        if end <= len(buf):
+            buf[offset:end] = msg
+        return offset
+
+    def _pub_slice(self, size):
+        """Returns a view of the first size bytes of the publish buffer.
+        The view is kept, as publishes of the same size are common."""
+        if len(self._pub_packet) != size:
+            self._pub_packet = self._pub_view[:size]
+        return self._pub_packet
+
+    def _spool_publish(self, topic_bytes, msg, retain, qos):
+        """Encodes a PUBLISH packet without a packet identifier, which is
+        assigned when the spool is sent, and appends it to the spool."""
+        offset = self._encode_publish(topic_bytes, msg, retain, qos, 0)
+        end = offset + len(msg)
+        if end <= len(self._pub_buf):
+            self._spool.append(self._pub_slice(end))
+        else:
+            self._spool.append(self._pub_slice(offset), msg)
+
+    def _flush_spool(self):
+        """Sends the messages stored in the spool while disconnected."""
+        if self._spool is None or not len(self._spool):
+            return
+        if self.logger:
+            self.logger.debug("Sending %d spooled bytes", len(self._spool))
+        self._spool.drain(self._send_spooled)
+
+    def _send_spooled(self, packets):
+        """Sends a batch of spooled PUBLISH packets with one socket send.
+        QoS 1 packets are given packet identifiers and added to the in-flight
+        messages first. Stops before a QoS 1 packet when the in-flight window
+        is full. Returns the number of bytes sent, the rest stays spooled.
+        :param memoryview packets: One or more complete PUBLISH packets.
+
+        """
+        offset = 0
+        now = time.monotonic_ns()
+        pids = []
+        while offset < len(packets):
+            header = packets[offset]
+            if header & 0x06 and self._window_full():
+                break
+            pos = offset + 1
+            length = 0
+            shift = 0
             while True:
-                op = self._wait_for_msg()
-                if op == 0x40:
-                    sz = self._sock_exact_recv(1)
-                    assert sz == b"\x02"
-                    rcv_pid = self._sock_exact_recv(2)
-                    rcv_pid = rcv_pid[0] << 0x08 | rcv_pid[1]
-                    if self._pid == rcv_pid:
-                        if self.on_publish is not None:
-                            self.on_publish(self, self._user_data, topic, rcv_pid)
-                        return
+                byte = packets[pos]
+                pos += 1
+                length |= (byte & 0x7F) << shift
+                if not byte & 0x80:
+                    break
+                shift += 7
+            end = pos + length
+            if header & 0x06:
+                pid_pos = pos + 2 + (packets[pos] << 8 | packets[pos + 1])
+                pid = self._next_pid()
+                packets[pid_pos] = pid >> 8
+                packets[pid_pos + 1] = pid & 0xFF
+                payload = pid_pos + 2
+                if self.protocol_version == MQTT_V5:
+                    # spooled packets have no properties
+                    payload += 1
+                self._inflight[pid] = (
+                    str(packets[pos + 2 : pid_pos], "utf-8"),
+                    bytes(packets[pos:pid_pos]),
+                    bytes(packets[payload:end]),
+                    header & 0x01,
+                    now,
+                )
+                pids.append(pid)
+            self.stats.sent(header, end - offset)
+            offset = end
+        if offset:
+            try:
+                self._sock_sendall(packets[:offset])
+            except (OSError, RuntimeError):
+                # the spool sends the batch again once reconnected
+                for pid in pids:
+                    self._inflight.pop(pid, None)
+                raise
+        return offset
+
+    def _sock_sendall(self, buf):
+        """Sends an entire buffer to the connected socket.
+        :param buf: Buffer to send.
+
+        """
+        sent = self._sock.send(buf)
+        self._last_send = time.monotonic()
+        # ESP32SPI sockets send the whole buffer and return None
+        if sent is None or sent == len(buf):
+            return
+        view = memoryview(buf)
+        while sent < len(buf):
+            sent += self._sock.send(view[sent:])
 
     def subscribe(self, topic, qos=0):
         """Subscribes to a topic on the MQTT Broker.
         This method can subscribe to one topics or multiple topics.
+        Multiple topics are packed into as few SUBSCRIBE packets as the
+        maximum packet size allows.
 
         :param str,tuple,list topic: Unique MQTT topic identifier string. If
                                      this is a `tuple`, then the tuple should
@@ -649,6 +1856,27 @@ class MQTT:
 
         """
         self.is_connected()
+        topics = self._sub_topics(topic, qos)
+        pids = []
+        for pid, batch in self._send_subscribe(topics):
+            self._subacks[pid] = batch
+            pids.append(pid)
+        self._wait_subacks(pids)
+
+    def _wait_subacks(self, pids):
+        """Waits until the SUBACKs of SUBSCRIBE packets in ``_subacks`` have
+        arrived. `_handle_packet()` handles every SUBACK in ``_subacks`` as
+        it arrives, such as those of the resubscribes sent with CONNECT when
+        `subscribe()` is called from `on_connect`.
+        :param list pids: Packet identifiers of the SUBSCRIBE packets.
+
+        """
+        while any(pid in self._subacks for pid in pids):
+            self._wait_for_msg()
+
+    def _sub_topics(self, topic, qos):
+        """Validates the arguments of `subscribe()` and returns
+        a list of (topic, qos) tuples."""
         topics = None
         if isinstance(topic, tuple):
             topic, qos = topic
@@ -664,41 +1892,105 @@ class MQTT:
                 self._valid_qos(q)
                 self._valid_topic(t)
                 topics.append((t, q))
-        # Assemble packet
-        packet_length = 2 + (2 * len(topics)) + (1 * len(topics))
-        packet_length += sum(len(topic) for topic, qos in topics)
-        packet_length_byte = packet_length.to_bytes(1, "big")
-        self._pid = self._pid + 1 if self._pid < 0xFFFF else 1
-        packet_id_bytes = self._pid.to_bytes(2, "big")
-        # Packet with variable and fixed headers
-        packet = MQTT_SUB + packet_length_byte + packet_id_bytes
-        # attaching topic and QOS level to the packet
+        return topics
+
+    def _send_subscribe(self, topics):
+        """Sends SUBSCRIBE packets for a list of topics.
+        Returns a list of (packet identifier, topics) tuples, one per packet.
+        :param list topics: List of (topic, qos) tuples.
+
+        """
+        entries = []
         for t, q in topics:
-            topic_size = len(t).to_bytes(2, "big")
-            qos_byte = q.to_bytes(1, "big")
-            packet += topic_size + t.encode() + qos_byte
-        if self.logger:
-            for t, q in topics:
+            encoded = t.encode("utf-8")
+            # length-prefixed topic, followed by the requested QoS byte
+            entries.append(
+                ((t, q), struct.pack("!H", len(encoded)) + encoded + bytes((q,)))
+            )
+            if self.logger:
                 self.logger.debug("SUBSCRIBING to topic %s with QoS %d", t, q)
-        self._sock.send(packet)
-        while True:
-            op = self._wait_for_msg()
-            if op == 0x90:
-                rc = self._sock_exact_recv(4)
-                assert rc[1] == packet[2] and rc[2] == packet[3]
-                if rc[3] == 0x80:
-                    raise MMQTTException("SUBACK Failure!")
-                for t, q in topics:
-                    if self.on_subscribe is not None:
-                        self.on_subscribe(self, self._user_data, t, q)
-                    self._subscribed_topics.append(t)
-                return
+        return self._send_topic_packets(MQTT_SUB[0], entries)
+
+    def _send_topic_packets(self, packet_type, entries):
+        """Sends SUBSCRIBE or UNSUBSCRIBE packets, packing as many topic
+        entries into each packet as the maximum packet size allows.
+        Returns a list of (packet identifier, topics) tuples, one per packet.
+        :param int packet_type: First byte of the fixed header.
+        :param list entries: List of (topic, encoded payload entry) tuples.
+
+        """
+        packets = []
+        # type byte and up to four remaining length bytes
+        limit = self._max_packet_size - 5
+        # packet identifier, and with MQTT 5 an empty property length
+        id_len = 3 if self.protocol_version == MQTT_V5 else 2
+        header = bytearray(8)
+        header[0] = packet_type
+        start = 0
+        while start < len(entries):
+            # at least one topic entry per packet
+            length = id_len + len(entries[start][1])
+            end = start + 1
+            while end < len(entries) and length + len(entries[end][1]) <= limit:
+                length += len(entries[end][1])
+                end += 1
+            pid = self._next_pid()
+            offset = self._encode_remaining_length(header, 1, length)
+            header[offset] = pid >> 8
+            header[offset + 1] = pid & 0xFF
+            header[offset + 2] = 0
+            batch = entries[start:end]
+            packet = header[: offset + id_len] + b"".join(entry for _, entry in batch)
+            self._sock_sendall(packet)
+            self.stats.sent(packet_type, len(packet))
+            packets.append((pid, [topic for topic, _ in batch]))
+            start = end
+        return packets
+
+    def _handle_suback(self, topics, pid, rc):
+        """Processes the variable header and payload of a SUBACK packet.
+        :param list topics: List of (topic, qos) tuples which were subscribed to.
+        :param int pid: Packet identifier of the SUBSCRIBE packet.
+        :param memoryview rc: Packet identifier and return codes.
+
+        """
+        assert rc[0] << 8 | rc[1] == pid
+        offset = 2
+        if self.protocol_version == MQTT_V5:
+            offset = self._decode_properties(rc, offset)[1]
+        failed = False
+        for i, (t, q) in enumerate(topics):
+            # one return code per topic, in the order they were sent [MQTT-3.9.3]
+            if rc[offset + i] >= 0x80:
+                failed = True
+                continue
+            self._subscribed_topics[t] = q
+            if self.on_subscribe is not None:
+                self.on_subscribe(self, self._user_data, t, q)
+        if failed:
+            raise MMQTTException("SUBACK Failure!")
 
     def unsubscribe(self, topic):
         """Unsubscribes from a MQTT topic.
+        Multiple topics are packed into as few UNSUBSCRIBE packets as the
+        maximum packet size allows.
         :param str,list topic: Unique MQTT topic identifier string or list.
 
         """
+        topics = self._unsub_topics(topic)
+        pending = dict(self._send_unsubscribe(topics))
+        if self.logger:
+            self.logger.debug("Waiting for UNSUBACK...")
+        while pending:
+            op = self._wait_for_msg()
+            if op == 176:
+                body = self._decoder.body
+                pid = body[0] << 8 | body[1]
+                if pid in pending:
+                    self._handle_unsuback(pending.pop(pid), pid, body)
+
+    def _unsub_topics(self, topic):
+        """Validates the argument of `unsubscribe()` and returns a list of topics."""
         topics = None
         if isinstance(topic, str):
             self._valid_topic(topic)
@@ -713,210 +2005,575 @@ class MQTT:
                 raise MMQTTException(
                     "Topic must be subscribed to before attempting unsubscribe."
                 )
-        # Assemble packet
-        packet_length = 2 + (2 * len(topics))
-        packet_length += sum(len(topic) for topic in topics)
-        packet_length_byte = packet_length.to_bytes(1, "big")
-        self._pid = self._pid + 1 if self._pid < 0xFFFF else 1
-        packet_id_bytes = self._pid.to_bytes(2, "big")
-        packet = MQTT_UNSUB + packet_length_byte + packet_id_bytes
+        return topics
+
+    def _send_unsubscribe(self, topics):
+        """Sends UNSUBSCRIBE packets for a list of topics.
+        Returns a list of (packet identifier, topics) tuples, one per packet.
+        :param list topics: List of topics.
+
+        """
+        entries = []
         for t in topics:
-            topic_size = len(t).to_bytes(2, "big")
-            packet += topic_size + t.encode()
-        if self.logger:
-            for t in topics:
+            encoded = t.encode("utf-8")
+            entries.append((t, struct.pack("!H", len(encoded)) + encoded))
+            if self.logger:
                 self.logger.debug("UNSUBSCRIBING from topic %s", t)
-        self._sock.send(packet)
-        if self.logger:
-            self.logger.debug("Waiting for UNSUBACK...")
-        while True:
-            op = self._wait_for_msg()
-            if op == 176:
-                rc = self._sock_exact_recv(3)
-                assert rc[0] == 0x02
-                # [MQTT-3.32]
-                assert rc[1] == packet_id_bytes[0] and rc[2] == packet_id_bytes[1]
-                for t in topics:
-                    if self.on_unsubscribe is not None:
-                        self.on_unsubscribe(self, self._user_data, t, self._pid)
-                    self._subscribed_topics.remove(t)
-                return
+        return self._send_topic_packets(MQTT_UNSUB[0], entries)
+
+    def _handle_unsuback(self, topics, pid, rc):
+        """Processes the variable header of an UNSUBACK packet.
+        :param list topics: List of topics which were unsubscribed from.
+        :param int pid: Packet identifier of the UNSUBSCRIBE packet.
+        :param memoryview rc: Packet identifier bytes, and with MQTT 5 the
+            properties and reason codes.
+
+        """
+        assert len(rc) == 0x02 or self.protocol_version == MQTT_V5
+        # [MQTT-3.32]
+        assert rc[0] << 8 | rc[1] == pid
+        for t in topics:
+            if self.on_unsubscribe is not None:
+                self.on_unsubscribe(self, self._user_data, t, pid)
+            self._subscribed_topics.pop(t, None)
 
     def reconnect(self, resub_topics=True):
         """Attempts to reconnect to the MQTT broker.
+        Previously subscribed topics are restored in as few SUBSCRIBE packets
+        as possible, unless the broker resumed a persistent session which
+        still holds them. Unacknowledged QoS 1 messages are sent again.
         :param bool resub_topics: Resubscribe to previously subscribed topics.
 
         """
         if self.logger:
             self.logger.debug("Attempting to reconnect with MQTT broker")
-        self.connect()
-        if self.logger:
-            self.logger.debug("Reconnected with broker")
-        if resub_topics:
+        start = time.monotonic_ns()
+        if (
+            self.fast_reconnect
+            and self.clean_session
+            and resub_topics
+            and self._subscribed_topics
+        ):
             if self.logger:
-                self.logger.debug(
-                    "Attempting to resubscribe to previously subscribed topics."
-                )
-            subscribed_topics = self._subscribed_topics.copy()
-            self._subscribed_topics = []
-            while subscribed_topics:
-                feed = subscribed_topics.pop()
-                self.subscribe(feed)
-
-    def loop(self, timeout=1):
+                self.logger.debug("Resubscribing to topics along with CONNECT")
+            topics = list(self._subscribed_topics.items())
+            self._subscribed_topics = {}
+            try:
+                self._connect(topics)
+            except (MMQTTException, OSError, RuntimeError):
+                # keep the topics for the next attempt
+                for topic, qos in topics:
+                    self._subscribed_topics.setdefault(topic, qos)
+                raise
+        else:
+            self.connect()
+            if self.logger:
+                self.logger.debug("Reconnected with broker")
+            if self.session_present:
+                if self.logger:
+                    self.logger.debug("Broker kept the session, not resubscribing")
+            elif resub_topics and self._subscribed_topics:
+                if self.logger:
+                    self.logger.debug(
+                        "Attempting to resubscribe to previously subscribed topics."
+                    )
+                topics = list(self._subscribed_topics.items())
+                self._subscribed_topics = {}
+                self.subscribe(topics)
+        self._resend_inflight()
+        self.stats.reconnects += 1
+        self.stats.reconnect_ns += time.monotonic_ns() - start
+
+    def loop(self, timeout=1, max_messages=None, budget_ms=None):
         """Non-blocking message loop. Use this method to
         check incoming subscription messages.
         Returns response codes of any messages received.
         :param int timeout: Socket timeout, in seconds.
+        :param int max_messages: Process up to this many packets which have
+            already arrived, instead of only one.
+        :param int budget_ms: Stop processing packets which have already arrived
+            once this many milliseconds have passed since loop() was called.
+
+        With ``timeout=0``, loop() checks whether any data is waiting and returns
+        None straight away when there is none, so it never blocks the caller.
+
+        With either ``max_messages`` or ``budget_ms`` set, loop() waits up to
+        ``timeout`` for the first packet, then keeps processing packets until
+        none are waiting or a limit is hit. The number of packets handled is
+        the length of the returned list.
+
+        Messages waiting in the ``rate_limiter`` are sent first, as far as the
+        rate limit and the in-flight window allow.
 
         """
-        if self._timestamp == 0:
-            self._timestamp = time.monotonic()
-        current_time = time.monotonic()
-        if current_time - self._timestamp >= self.keep_alive:
-            # Handle KeepAlive by expecting a PINGREQ/PINGRESP from the server
+        stamp = time.monotonic()
+        if self._ping_sent:
+            if stamp - self._ping_sent > self._ping_timeout():
+                raise MMQTTException("PINGRESP not returned from broker.")
+        elif self.keep_alive and stamp - self._last_send >= self.keep_alive:
+            # Only an idle connection needs a PINGREQ [MQTT-3.1.2-23]
             if self.logger is not None:
-                self.logger.debug(
-                    "KeepAlive period elapsed - requesting a PINGRESP from the server..."
-                )
-            rcs = self.ping()
-            self._timestamp = 0
-            return rcs
+                self.logger.debug("KeepAlive period elapsed - sending PINGREQ")
+            self._send_ping()
+        if self._stats_topic and stamp - self._stats_published >= self._stats_interval:
+            self.publish_stats()
+        if self.rate_limiter is not None and self._is_connected:
+            self.rate_limiter.flush()
+        if timeout == 0:
+            if self._sock_has_data() is False:
+                return None
+            # ESP32SPI sockets treat a zero timeout as blocking
+            timeout = MQTT_DRAIN_TIMEOUT
         self._sock.settimeout(timeout)
         rc = self._wait_for_msg()
-        return [rc] if rc else None
+        if max_messages is None and budget_ms is None:
+            return [rc] if rc else None
+        rcs = []
+        while rc:
+            rcs.append(rc)
+            if max_messages is not None and len(rcs) >= max_messages:
+                break
+            if budget_ms is not None:
+                if (time.monotonic() - stamp) * 1000 >= budget_ms:
+                    break
+            if self._sock_has_data() is False:
+                break
+            self._sock.settimeout(MQTT_DRAIN_TIMEOUT)
+            rc = self._wait_for_msg()
+        return rcs or None
+
+    def _next_timer(self):
+        """Returns the `time.monotonic()` value at which `loop()` next has a
+        PINGREQ, stats or rate limited message to send, or an overdue PINGRESP
+        to report, or None when it has none."""
+        deadline = None
+        if self._ping_sent:
+            deadline = self._ping_sent + self._ping_timeout()
+        elif self.keep_alive:
+            deadline = self._last_send + self.keep_alive
+        if self._stats_topic:
+            stats = self._stats_published + self._stats_interval
+            deadline = stats if deadline is None else min(deadline, stats)
+        if self.rate_limiter is not None:
+            wait = self.rate_limiter.next_send()
+            if wait is not None:
+                limited = time.monotonic() + wait
+                deadline = limited if deadline is None else min(deadline, limited)
+        return deadline
+
+    @staticmethod
+    def _get_poller(sock):
+        """Returns a `select.poll` object watching sock for received data,
+        or None if the socket can not be polled."""
+        if select is None or not hasattr(select, "poll"):
+            return None
+        poller = select.poll()
+        try:
+            poller.register(sock, select.POLLIN)
+        except (AttributeError, TypeError, ValueError, OSError):
+            # e.g. legacy ESP32SPI sockets, which have no file descriptor
+            return None
+        return poller
+
+    def _sock_has_data(self):
+        """Checks, without blocking, whether received data is waiting.
+        Returns None if the socket offers no way to tell.
+        """
+        if len(self._decoder):
+            return True
+        if hasattr(self._sock, "available"):  # ESP32SPI
+            return self._sock.available() > 0
+        if hasattr(self._sock, "pending") and self._sock.pending():
+            # bytes already decrypted by an SSL socket are invisible to poll
+            return True
+        if self._poller is not None:
+            return bool(self._poller.poll(0))
+        return None
 
     def _wait_for_msg(self, timeout=0.1):
-        """Reads and processes network events."""
-        # CPython socket module contains a timeout attribute
-        if hasattr(self._socket_pool, "timeout"):
-            try:
-                res = self._sock_exact_recv(1)
-            except self._socket_pool.timeout as error:
+        """Reads and processes network events.
+        Returns the packet type of the processed packet, or None if no complete
+        packet was received. The variable header of packets which are not
+        processed here is left in ``self._decoder.body``.
+        """
+        decoder = self._decoder
+        if decoder.remaining:
+            # continue with a message which is streamed
+            return self._recv_stream()
+        header = decoder.next_packet()
+        if header is None:
+            if not self._recv_some():
                 return None
-        else:  # socketpool, esp32spi
-            try:
-                res = self._sock_exact_recv(1)
-            except OSError as error:
-                if error.errno == errno.ETIMEDOUT:
-                    # raised by a socket timeout if 0 bytes were present
+            # Block while we receive the rest of the packet
+            self._sock.settimeout(timeout)
+            header = decoder.next_packet()
+            while header is None:
+                if not self._recv_some():
+                    # keep the partial packet buffered for the next call
                     return None
-                raise MMQTTException from error
+                header = decoder.next_packet()
+        if decoder.remaining:
+            self._start_stream(header, decoder.body)
+            return self._recv_stream()
+        return self._handle_packet(header, decoder.body)
+
+    def _recv_stream(self):
+        """Receives and processes the rest of a streamed PUBLISH payload.
+        Returns the packet type, or None if the socket timed out first.
+        """
+        header = self._stream_payload()
+        while header is None:
+            if not self._recv_some():
+                return None
+            header = self._stream_payload()
+        return header
 
-        # Block while we parse the rest of the response
-        self._sock.settimeout(timeout)
-        if res in [None, b""]:
-            # If we get here, it means that there is nothing to be received
-            return None
-        if res[0] == MQTT_PINGRESP:
+    def _handle_packet(self, header, body):
+        """Processes PINGRESP, PUBACK and PUBLISH packets, and the SUBACKs of
+        SUBSCRIBE packets in ``_subacks``. Returns the packet type.
+        :param int header: First byte of the fixed header.
+        :param memoryview body: Variable header and payload of the packet.
+
+        """
+        self.stats.received(header, len(body))
+        if header == MQTT_PINGRESP:
             if self.logger:
                 self.logger.debug("Got PINGRESP")
-            sz = self._sock_exact_recv(1)[0]
-            if sz != 0x00:
+            if body:
                 raise MMQTTException(
-                    "Unexpected PINGRESP returned from broker: {}.".format(sz)
+                    "Unexpected PINGRESP returned from broker: {}.".format(len(body))
                 )
+            if self._ping_sent:
+                self._update_rtt(time.monotonic() - self._ping_sent)
+                self._ping_sent = 0
             return MQTT_PINGRESP
-        if res[0] & 0xF0 != 0x30:
-            return res[0]
-        sz = self._recv_len()
+        if header == MQTT_PUBACK:
+            # MQTT 5 may add a reason code and properties
+            if len(body) != 0x02 and (
+                self.protocol_version != MQTT_V5 or len(body) < 0x02
+            ):
+                raise MMQTTException(
+                    "Unexpected PUBACK returned from broker: {}.".format(len(body))
+                )
+            self._handle_puback(
+                body[0] << 0x08 | body[1], body[2] if len(body) > 2 else 0
+            )
+            return MQTT_PUBACK
+        if header == 0x90 and self._subacks:
+            pid = body[0] << 8 | body[1]
+            batch = self._subacks.pop(pid, None)
+            if batch is not None:
+                self._handle_suback(batch, pid, body)
+            return header
+        if header == 0xE0:
+            # MQTT 5 brokers may disconnect the client [MQTT5 3.14]
+            self._is_connected = False
+            raise MMQTTException(
+                "Disconnected by broker, reason code 0x{:02X}.".format(
+                    body[0] if body else 0
+                )
+            )
+        if header & 0xF0 != 0x30:
+            return header
+        topic, pid, offset = self._decode_publish(header, body)
+        # message contents
+        payload = body[offset:]
+        if self._message_queue is not None:
+            # acknowledged on receipt, the callbacks run later
+            self._ack_publish(header, pid)
+            self._message_queue.put(topic, payload, self._deliver_message)
+            return header
+        self._deliver_message(topic, payload)
+        self._ack_publish(header, pid)
+        return header
+
+    def _deliver_message(self, topic, payload):
+        """Runs the callbacks of a received message.
+        :param str topic: Topic of the message.
+        :param payload: Payload of the message.
+
+        """
+        start = time.monotonic_ns()
+        target = self._stream_target(topic, len(payload))
+        if target is None:
+            self._handle_on_message(self, topic, payload)
+        else:
+            self._stream_piece(target, topic, payload, 0, len(payload))
+        elapsed = time.monotonic_ns() - start
+        self.stats.callbacks += 1
+        self.stats.callback_ns += elapsed
+        self.stats.callback_max_ns = max(self.stats.callback_max_ns, elapsed)
+
+    def process_messages(self, max_messages=None, budget_ms=None):
+        """Runs the callbacks of messages waiting in the ``message_queue``,
+        oldest first. Returns the number of messages handled.
+        :param int max_messages: Handle at most this many messages.
+        :param int budget_ms: Stop once this many milliseconds have passed.
+
+        """
+        if self._message_queue is None:
+            raise MMQTTException("No message queue was given to the client.")
+        return self._message_queue.process(
+            self._deliver_message, max_messages, budget_ms
+        )
+
+    def _decode_publish(self, header, body):
+        """Decodes the variable header of a PUBLISH packet.
+        Returns the topic, the packet identifier and the offset of the payload.
+        :param int header: First byte of the fixed header.
+        :param memoryview body: Variable header and payload of the packet.
+
+        """
         # topic length MSB & LSB
-        topic_len = self._sock_exact_recv(2)
-        topic_len = (topic_len[0] << 8) | topic_len[1]
-        topic = self._sock_exact_recv(topic_len)
-        topic = str(topic, "utf-8")
-        sz -= topic_len + 2
+        topic_len = (body[0] << 8) | body[1]
+        topic = str(body[2 : 2 + topic_len], "utf-8")
+        offset = 2 + topic_len
         pid = 0
-        if res[0] & 0x06:
-            pid = self._sock_exact_recv(2)
-            pid = pid[0] << 0x08 | pid[1]
-            sz -= 0x02
-        # read message contents
-        msg = self._sock_exact_recv(sz)
-        self._handle_on_message(self, topic, str(msg, "utf-8"))
-        if res[0] & 0x06 == 0x02:
+        if header & 0x06:
+            pid = body[offset] << 0x08 | body[offset + 1]
+            offset += 0x02
+        if self.protocol_version == MQTT_V5:
+            if body[offset]:
+                properties, offset = self._decode_properties(body, offset)
+                alias = properties.get(_PROP_TOPIC_ALIAS)
+                if alias is not None:
+                    topic = self._inbound_alias(topic, alias)
+            else:
+                offset += 1
+        return topic, pid, offset
+
+    def _ack_publish(self, header, pid):
+        """Sends the PUBACK for a received QoS 1 message.
+        :param int header: First byte of the fixed header of the PUBLISH packet.
+        :param int pid: Packet identifier of the PUBLISH packet.
+
+        """
+        if header & 0x06 == 0x02:
             pkt = bytearray(b"\x40\x02\0\0")
             struct.pack_into("!H", pkt, 2, pid)
-            self._sock.send(pkt)
-        elif res[0] & 6 == 4:
+            self._sock_sendall(pkt)
+            self.stats.sent(0x40, 4)
+        elif header & 6 == 4:
             assert 0
-        return res[0]
 
-    def _recv_len(self):
-        """Unpack MQTT message length."""
-        n = 0
-        sh = 0
-        b = bytearray(1)
+    def _stream_target(self, topic, size, streamed=False):
+        """Returns the (callback, buffer) tuple registered with
+        `add_topic_stream()` for a message, or None for messages which go to
+        the regular callbacks. Messages which can not be delivered because
+        they are too large get a (None, None) tuple, and are skipped.
+        :param str topic: Topic of the message.
+        :param int size: Size of the payload, in bytes.
+        :param bool streamed: Whether the message is too large to buffer whole.
+
+        """
+        target = None
+        for target in self._on_message_streams.iter_match(topic):
+            break
+        if target is None and not streamed and size <= self._msg_size_lim:
+            return None
+        if target is not None and (target[1] is None or size <= len(target[1])):
+            return target
+        if self.logger:
+            self.logger.warning("Skipping %d byte message on %s", size, topic)
+        self.stats.skipped += 1
+        return None, None
+
+    def _stream_piece(self, target, topic, piece, offset, size):
+        """Passes part of a payload to its `add_topic_stream()` callback,
+        or copies it into the buffer registered for the topic.
+        :param tuple target: (callback, buffer) tuple from `_stream_target`.
+        :param str topic: Topic of the message.
+        :param memoryview piece: Part of the payload.
+        :param int offset: Position of piece in the payload.
+        :param int size: Size of the whole payload, in bytes.
+
+        """
+        callback, buffer = target
+        if callback is None:
+            return
+        if buffer is None:
+            callback(self, topic, piece, offset, size)
+            return
+        buffer[offset : offset + len(piece)] = piece
+        if offset + len(piece) == size:
+            callback(self, topic, memoryview(buffer)[:size])
+
+    def _start_stream(self, header, body):
+        """Starts processing a PUBLISH packet too large to buffer whole.
+        The rest of its payload is read by `_stream_payload()`.
+        :param int header: First byte of the fixed header.
+        :param memoryview body: Start of the variable header and payload.
+
+        """
+        self.stats.received(header, len(body) + self._decoder.remaining)
+        if header & 0xF0 != 0x30:
+            raise MMQTTException(
+                "Packet 0x{:02X} larger than the receive limit.".format(header)
+            )
+        try:
+            topic, pid, offset = self._decode_publish(header, body)
+        except IndexError:
+            raise MMQTTException(
+                "PUBLISH header larger than the receive buffer."
+            ) from None
+        size = len(body) - offset + self._decoder.remaining
+        target = self._stream_target(topic, size, True)
+        self._stream = [header, topic, pid, target, len(body) - offset, size]
+        self._stream_piece(target, topic, body[offset:], 0, size)
+
+    def _stream_payload(self):
+        """Processes the buffered part of a streamed PUBLISH payload.
+        Returns the packet type once the whole payload has been processed,
+        or None when more bytes have to be received.
+
+        """
+        header, topic, pid, target, offset, size = self._stream
+        decoder = self._decoder
+        while decoder.remaining:
+            piece = decoder.stream()
+            if not piece:
+                self._stream[4] = offset
+                return None
+            self._stream_piece(target, topic, piece, offset, size)
+            offset += len(piece)
+        self._stream = None
+        self._ack_publish(header, pid)
+        return header
+
+    def _inbound_alias(self, topic, alias):
+        """Records or resolves a topic alias set by the broker.
+        Returns the topic of the message.
+        :param str topic: Topic of the received message, empty if it only has an alias.
+        :param int alias: Topic alias of the received message.
+
+        """
+        if topic:
+            self._inbound_aliases[alias] = topic
+            return topic
+        if alias not in self._inbound_aliases:
+            raise MMQTTException("Unknown topic alias {}.".format(alias))
+        return self._inbound_aliases[alias]
+
+    @staticmethod
+    def _decode_varint(buf, offset):
+        """Decodes a Variable Byte Integer [MQTT5 1.5.5].
+        Returns the value and the offset of the byte after it.
+        :param buf: Buffer holding the integer.
+        :param int offset: Position of the first byte in buf.
+
+        """
+        value = 0
+        shift = 0
         while True:
-            b = self._sock_exact_recv(1)[0]
-            n |= (b & 0x7F) << sh
-            if not b & 0x80:
-                return n
-            sh += 7
+            byte = buf[offset]
+            offset += 1
+            value |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return value, offset
+            shift += 7
+
+    def _decode_properties(self, buf, offset):
+        """Decodes MQTT 5 properties [MQTT5 2.2.2].
+        Returns a dict of property identifier to value, and the offset of the
+        byte after the properties. User properties are a list of (name, value).
+        :param buf: Buffer holding the properties.
+        :param int offset: Position of the property length in buf.
+
+        """
+        length, offset = self._decode_varint(buf, offset)
+        end = offset + length
+        properties = {}
+        while offset < end:
+            prop = buf[offset]
+            offset += 1
+            if prop in _PROP_BYTE:
+                value = buf[offset]
+                offset += 1
+            elif prop in _PROP_INT16:
+                value = buf[offset] << 8 | buf[offset + 1]
+                offset += 2
+            elif prop in _PROP_INT32:
+                value = struct.unpack_from("!I", buf, offset)[0]
+                offset += 4
+            elif prop == _PROP_SUBSCRIPTION_ID:
+                value, offset = self._decode_varint(buf, offset)
+            elif prop == _PROP_USER_PROPERTY:
+                name, offset = self._decode_str(buf, offset)
+                value, offset = self._decode_str(buf, offset)
+                properties.setdefault(prop, []).append((name, value))
+                continue
+            elif prop in _PROP_STRING:
+                value, offset = self._decode_str(buf, offset)
+            elif prop in _PROP_BINARY:
+                size = buf[offset] << 8 | buf[offset + 1]
+                value = bytes(buf[offset + 2 : offset + 2 + size])
+                offset += 2 + size
+            else:
+                raise MMQTTException("Unknown property 0x{:02X}.".format(prop))
+            properties[prop] = value
+        return properties, end
+
+    @staticmethod
+    def _decode_str(buf, offset):
+        """Decodes a length-prefixed UTF-8 string.
+        Returns the string and the offset of the byte after it."""
+        size = buf[offset] << 8 | buf[offset + 1]
+        return str(buf[offset + 2 : offset + 2 + size], "utf-8"), offset + 2 + size
+
+    def _recv_some(self):
+        """Receives whatever the socket has waiting into the decoder buffer.
+        Returns the number of bytes received, or zero if the socket timed out.
+
+        """
+        view = self._decoder.free()
+        # CPython socket module contains a timeout attribute
+        if hasattr(self._socket_pool, "timeout"):
+            try:
+                size = self._recv_into(view)
+            except self._socket_pool.timeout:
+                return 0
+        else:  # socketpool, esp32spi
+            try:
+                size = self._recv_into(view)
+            except OSError as error:
+                if error.errno == errno.ETIMEDOUT:
+                    # raised by a socket timeout if 0 bytes were present
+                    return 0
+                raise MMQTTException from error
+        if size == 0:
+            if self._backwards_compatible_sock:
+                # ESP32SPI sockets return no bytes on timeout
+                return 0
+            raise MMQTTException("Connection closed by broker.")
+        self._decoder.commit(size)
+        self.stats.recv_buffer_high = max(
+            self.stats.recv_buffer_high, len(self._decoder)
+        )
+        return size
 
     def _recv_into(self, buf, size=0):
         """Backwards-compatible _recv_into implementation."""
         if self._backwards_compatible_sock:
             size = len(buf) if size == 0 else size
+            if hasattr(self._sock, "available"):
+                # ESP32SPI recv waits for all size bytes, only ask for what is waiting
+                size = max(1, min(size, self._sock.available()))
             b = self._sock.recv(size)
             read_size = len(b)
             buf[:read_size] = b
             return read_size
         return self._sock.recv_into(buf, size)
 
-    def _sock_exact_recv(self, bufsize):
-        """Reads _exact_ number of bytes from the connected socket. Will only return
-        string with the exact number of bytes requested.
-
-        The semantics of native socket receive is that it returns no more than the
-        specified number of bytes (i.e. max size). However, it makes no guarantees in
-        terms of the minimum size of the buffer, which could be 1 byte. This is a
-        wrapper for socket recv() to ensure that no less than the expected number of
-        bytes is returned or trigger a timeout exception.
-        :param int bufsize: number of bytes to receive
-
-        """
-        if not self._backwards_compatible_sock:
-            # CPython/Socketpool Impl.
-            rc = bytearray(bufsize)
-            self._sock.recv_into(rc, bufsize)
-        else:  # ESP32SPI Impl.
-            stamp = time.monotonic()
-            read_timeout = self.keep_alive
-            # This will timeout with socket timeout (not keepalive timeout)
-            rc = self._sock.recv(bufsize)
-            if not rc:
-                if self.logger:
-                    self.logger.debug("_sock_exact_recv timeout")
-                # If no bytes waiting, raise same exception as socketpool
-                raise OSError(errno.ETIMEDOUT)
-            # If any bytes waiting, try to read them all,
-            # or raise exception if wait longer than read_timeout
-            to_read = bufsize - len(rc)
-            assert to_read >= 0
-            read_timeout = self.keep_alive
-            while to_read > 0:
-                recv = self._sock.recv(to_read)
-                to_read -= len(recv)
-                rc += recv
-                if time.monotonic() - stamp > read_timeout:
-                    raise MMQTTException(
-                        "Unable to receive {} bytes within {} seconds.".format(
-                            to_read, read_timeout
-                        )
-                    )
-        return rc
-
-    def _send_str(self, string):
-        """Encodes a string and sends it to a socket.
-        :param str string: String to write to the socket.
+    @staticmethod
+    def _encode_str(string):
+        """Returns a string or bytes, prefixed with its length.
+        :param str string: String to encode.
 
         """
-        self._sock.send(struct.pack("!H", len(string)))
+        prefix = struct.pack("!H", len(string))
         if isinstance(string, str):
-            self._sock.send(str.encode(string, "utf-8"))
-        else:
-            self._sock.send(string)
+            return prefix + str.encode(string, "utf-8")
+        return prefix + string
 
     @staticmethod
     def _valid_topic(topic):
@@ -968,3 +2625,33 @@ class MQTT:
         if not self.logger:
             raise MMQTTException("Can not disable logger, no logger found.")
         self.logger = None
+
+    def enable_stats_publishing(self, topic, interval=60):
+        """Publishes `stats` as a JSON object from `loop()` every interval
+        seconds, for a dashboard or logger to collect.
+        :param str topic: Topic to publish the stats to. Topics starting with
+            ``$SYS`` are reserved for brokers, use a topic or feed of your own.
+        :param float interval: Time between stats messages, in seconds.
+
+        """
+        self._topic_bytes(topic)
+        self._stats_topic = topic
+        self._stats_interval = interval
+        self._stats_published = time.monotonic()
+
+    def disable_stats_publishing(self):
+        """Stops publishing stats from `loop()`."""
+        self._stats_topic = None
+
+    def publish_stats(self, topic=None):
+        """Publishes `stats` as a JSON object.
+        :param str topic: Topic to publish to, defaults to the topic set with
+            `enable_stats_publishing()`.
+
+        """
+        self.publish(topic or self._stats_topic, self._stats_message())
+
+    def _stats_message(self):
+        """Returns `stats` encoded as JSON, and restarts the stats interval."""
+        self._stats_published = time.monotonic()
+        return json.dumps(self.stats.as_dict())
@@ -0,0 +1,504 @@
+# SPDX-FileCopyrightText: 2021 ErogigGit
+#
+# SPDX-License-Identifier: MIT
+
+"""
+`adafruit_minimqtt_async`
+================================================================================
+
+An asyncio MQTT client built on the MiniMQTT protocol code.
+
+Implementation Notes
+--------------------
+
+`AsyncMQTT` reuses the packet encoders and callback routing of
+`adafruit_minimqtt.MQTT`. Packets are written to an asyncio stream and a
+background task reads and dispatches everything the broker sends, so waiting
+for the network never blocks other tasks on the event loop.
+
+**Software and Dependencies:**
+
+* CPython 3.7+ or CircuitPython with the asyncio library:
+  https://github.com/adafruit/Adafruit_CircuitPython_asyncio
+
+"""
+import asyncio
+import time
+from micropython import const
+from adafruit_minimqtt import (
+    MQTT,
+    MMQTTException,
+    MQTT_DISCONNECT,
+    MQTT_PINGRESP,
+    MQTT_RECV_BUF_SZ,
+    MQTT_TLS_PORT,
+)
+
+# Packet types waited on by the client
+_CONNACK = const(0x20)
+_SUBACK = const(0x90)
+_UNSUBACK = const(0xB0)
+
+
+class _StreamSocket:
+    """Socket-like wrapper which writes sends into an asyncio stream."""
+
+    def __init__(self, writer):
+        self._writer = writer
+
+    def send(self, buf):
+        """Queues buf on the stream. The buffer is copied, since the
+        client reuses its publish buffer for the next packet."""
+        self._writer.write(bytes(buf))
+        return len(buf)
+
+    def close(self):
+        """Closes the stream."""
+        self._writer.close()
+
+
+class AsyncMQTT(MQTT):
+    """asyncio MQTT Client. Accepts the same arguments as `adafruit_minimqtt.MQTT`.
+
+    `connect()`, `publish()`, `subscribe()`, `unsubscribe()` and `disconnect()`
+    are coroutines. Once connected, a background task receives messages and
+    dispatches them to the topic callbacks and `on_message`. Received messages
+    are also available from the client as an async iterator:
+
+    .. code-block:: python
+
+        await client.connect()
+        await client.subscribe("sensors/#")
+        async for topic, message in client:
+            print(topic, message)
+
+    Messages are decoded as by the callbacks. Payloads which can not be
+    decoded, such as binary payloads of topics with raw callbacks, are
+    queued as bytes.
+
+    Iteration ends when the client disconnects. When the connection is lost
+    or a callback raises, the reader task stops, the client is disconnected
+    and the iterator raises the error once the queued messages are read: a
+    `MMQTTException` when the connection was lost.
+
+    :param int message_queue_size: Number of received messages kept for the
+        async iterator. The oldest message is dropped when the queue is full.
+
+    """
+
+    def __init__(self, broker, *, message_queue_size=10, **kwargs):
+        super().__init__(broker, **kwargs)
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        # Error which stopped the reader task, for the async iterator
+        self._reader_error = None
+        # Pending acknowledgements, keyed by (packet type, packet identifier)
+        self._waiters = {}
+        self._acked = asyncio.Event()
+        self._message_queue_size = message_queue_size
+        self._messages = []
+        self._message_event = asyncio.Event()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exception_type, exception_value, traceback):
+        await self.disconnect()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._messages:
+            if self._reader_task is None:
+                error, self._reader_error = self._reader_error, None
+                if error is not None:
+                    raise error
+                raise StopAsyncIteration
+            self._message_event.clear()
+            await self._message_event.wait()
+        return self._messages.pop(0)
+
+    def _expect(self, packet_type, pid=0):
+        """Registers a waiter for an acknowledgement packet. Must be called
+        before the request is sent, so that the reader task cannot miss it."""
+        self._waiters[(packet_type, pid)] = [asyncio.Event(), None]
+
+    async def _wait(self, packet_type, pid=0):
+        """Waits for an acknowledgement registered with `_expect()` and
+        returns its remaining length and variable header."""
+        waiter = self._waiters[(packet_type, pid)]
+        try:
+            # a keep alive of zero waits without a timeout
+            await asyncio.wait_for(waiter[0].wait(), self.keep_alive or None)
+        except asyncio.TimeoutError:
+            raise MMQTTException(
+                "No response from broker within {} seconds.".format(self.keep_alive)
+            ) from None
+        finally:
+            self._waiters.pop((packet_type, pid), None)
+        if isinstance(waiter[1], Exception):
+            raise waiter[1]
+        return waiter[1]
+
+    def _resolve(self, packet_type, pid, result):
+        waiter = self._waiters.get((packet_type, pid))
+        if waiter is not None:
+            waiter[1] = result
+            waiter[0].set()
+
+    async def _drain(self):
+        await self._writer.drain()
+
+    # pylint: disable=invalid-overridden-method, arguments-differ
+    async def connect(self, clean_session=None, host=None, port=None, keep_alive=None):
+        """Initiates connection with the MQTT Broker and starts the reader task.
+        Returns the session present flag of the CONNACK.
+        :param bool clean_session: Start a new session instead of resuming the
+            one kept by the broker. Defaults to the ``clean_session`` given to
+            the constructor, and is kept for later reconnects.
+        :param str host: Hostname or IP address of the remote broker.
+        :param int port: Network port of the remote broker.
+        :param int keep_alive: Maximum period allowed for communication, in seconds.
+
+        """
+        if host:
+            self.broker = host
+        if port:
+            self.port = port
+        if keep_alive:
+            self.keep_alive = keep_alive
+        if clean_session is not None:
+            self.clean_session = clean_session
+        return await self._connect()
+
+    async def _connect(self, topics=None):
+        """Opens a connection, sends CONNECT and waits for the CONNACK.
+        Topics given are subscribed to in the same write as CONNECT."""
+        if self._reader_task is not None:
+            await self._close()
+
+        ssl_context = None
+        if self.port == MQTT_TLS_PORT:
+            if not self._ssl_context:
+                raise RuntimeError(
+                    "ssl_context must be set before using adafruit_mqtt for secure MQTT."
+                )
+            ssl_context = self._ssl_context
+        if self.logger:
+            self.logger.debug("Attempting to establish MQTT connection...")
+        stamp = time.monotonic_ns()
+        self._reader, self._writer = await asyncio.open_connection(
+            self.broker, self.port, ssl=ssl_context
+        )
+        if ssl_context is not None:
+            # asyncio can not offer a saved TLS session, only count handshakes
+            self.stats.tls_handshake(time.monotonic_ns() - stamp)
+        self._sock = _StreamSocket(self._writer)
+        self._decoder.reset()
+        self._reader_error = None
+        self._expect(_CONNACK)
+        self._send_connect(self.clean_session)
+        packets = self._send_subscribe(topics) if topics else []
+        for pid, _ in packets:
+            self._expect(_SUBACK, pid)
+        await self._drain()
+        self._reader_task = asyncio.create_task(self._read_loop())
+        try:
+            result = self._handle_connack(await self._wait(_CONNACK))
+            self._flush_spool()
+            await self._drain()
+            for pid, batch in packets:
+                self._handle_suback(batch, pid, await self._wait(_SUBACK, pid))
+        except (Exception, asyncio.CancelledError):
+            # a refused or timed out connection keeps no reader task
+            await self._close()
+            raise
+        return result
+
+    async def disconnect(self):
+        """Disconnects the MiniMQTT client from the MQTT broker."""
+        self.is_connected()
+        if self.logger is not None:
+            self.logger.debug("Sending DISCONNECT packet to broker")
+        try:
+            self._sock.send(MQTT_DISCONNECT)
+            self.stats.sent(0xE0, 2)
+            await self._drain()
+        except OSError as e:
+            if self.logger:
+                self.logger.warning("Unable to send DISCONNECT packet: {}".format(e))
+        await self._close()
+        if self.clean_session:
+            self._subscribed_topics = {}
+        if self.on_disconnect is not None:
+            self.on_disconnect(self, self._user_data, 0)
+
+    async def _close(self):
+        """Stops the reader task and closes the stream."""
+        task, self._reader_task = self._reader_task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._is_connected = False
+        self._writer.close()
+        self._fail_waiters(MMQTTException("MiniMQTT is not connected."))
+
+    def _fail_waiters(self, error):
+        for waiter in self._waiters.values():
+            waiter[1] = error
+            waiter[0].set()
+        self._acked.set()
+        self._message_event.set()
+
+    async def ping(self):
+        """Pings the MQTT Broker and waits for its PINGRESP."""
+        self.is_connected()
+        self._expect(MQTT_PINGRESP)
+        self._send_ping()
+        await self._drain()
+        await self._wait(MQTT_PINGRESP)
+
+    async def publish(self, topic, msg, retain=False, qos=0):
+        """Publishes a message to a topic provided.
+        :param str topic: Unique topic identifier.
+        :param str,int,float msg: Data to send to the broker.
+        :param bool retain: Whether the message is saved by the broker.
+        :param int qos: Quality of Service level for the message, defaults to zero.
+
+        QoS 1 publishes wait for their PUBACK unless ``max_inflight`` is set,
+        in which case they only wait for a free slot in the in-flight window.
+
+        """
+        if qos > 0 and self._is_connected:
+            while self._window_full():
+                await self._wait_for_puback()
+        pid = self._send_publish_msg(topic, msg, retain, qos)
+        if not pid and self._spool is not None and not self._is_connected:
+            return
+        await self._drain()
+        if qos == 1 and not self.max_inflight:
+            while pid in self._inflight:
+                await self._wait_for_puback()
+
+    async def publish_many(self, messages):
+        """Publishes several messages with as few writes as possible.
+        Accepts the same messages as `adafruit_minimqtt.MQTT.publish_many`.
+
+        """
+        entries = self._publish_entries(messages)
+        if self._spool is not None and not self._is_connected:
+            for _, topic_bytes, msg, qos, retain in entries:
+                self._spool_publish(topic_bytes, msg, retain, qos)
+            return
+        pids = []
+        start = 0
+        while start < len(entries):
+            end = self._batch_end(entries, start)
+            if end == start:
+                await self._wait_for_puback()
+                continue
+            pids.extend(self._send_publish_batch(entries[start:end]))
+            await self._drain()
+            start = end
+        if not self.max_inflight:
+            for pid in pids:
+                while pid in self._inflight:
+                    await self._wait_for_puback()
+
+    async def _wait_for_puback(self):
+        self.is_connected()
+        self._acked.clear()
+        await self._acked.wait()
+        self.is_connected()
+
+    def _handle_puback(self, pid, reason_code=0):
+        super()._handle_puback(pid, reason_code)
+        self._acked.set()
+
+    async def subscribe(self, topic, qos=0):
+        """Subscribes to a topic on the MQTT Broker.
+        Accepts the same topic formats as `adafruit_minimqtt.MQTT.subscribe`.
+
+        """
+        self.is_connected()
+        topics = self._sub_topics(topic, qos)
+        packets = self._send_subscribe(topics)
+        for pid, _ in packets:
+            self._expect(_SUBACK, pid)
+        await self._drain()
+        for pid, batch in packets:
+            self._handle_suback(batch, pid, await self._wait(_SUBACK, pid))
+
+    async def unsubscribe(self, topic):
+        """Unsubscribes from a MQTT topic.
+        :param str,list topic: Unique MQTT topic identifier string or list.
+
+        """
+        topics = self._unsub_topics(topic)
+        packets = self._send_unsubscribe(topics)
+        for pid, _ in packets:
+            self._expect(_UNSUBACK, pid)
+        await self._drain()
+        for pid, batch in packets:
+            self._handle_unsuback(batch, pid, await self._wait(_UNSUBACK, pid))
+
+    async def reconnect(self, resub_topics=True):
+        """Attempts to reconnect to the MQTT broker.
+        Topics are not resubscribed when the broker resumed a persistent
+        session. Unacknowledged QoS 1 messages are sent again once reconnected.
+        :param bool resub_topics: Resubscribe to previously subscribed topics.
+
+        """
+        start = time.monotonic_ns()
+        topics = list(self._subscribed_topics.items()) if resub_topics else []
+        if topics and self.fast_reconnect and self.clean_session:
+            # resubscribe in the same write as CONNECT
+            self._subscribed_topics = {}
+            try:
+                await self._connect(topics)
+            except (MMQTTException, OSError, RuntimeError):
+                for topic, qos in topics:
+                    self._subscribed_topics.setdefault(topic, qos)
+                raise
+        else:
+            await self.connect()
+            if topics and not self.session_present:
+                self._subscribed_topics = {}
+                await self.subscribe(topics)
+        self._resend_inflight()
+        await self._drain()
+        self.stats.reconnects += 1
+        self.stats.reconnect_ns += time.monotonic_ns() - start
+
+    async def publish_stats(self, topic=None):
+        """Publishes `stats` as a JSON object.
+        :param str topic: Topic to publish to, defaults to the topic set with
+            `enable_stats_publishing()`.
+
+        """
+        await self.publish(topic or self._stats_topic, self._stats_message())
+
+    def loop(self, timeout=1):
+        """Not used by AsyncMQTT, the reader task processes messages."""
+        raise MMQTTException("AsyncMQTT receives messages in a background task.")
+
+    async def _read_loop(self):
+        """Reads packets from the broker until the connection is closed."""
+        decoder = self._decoder
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(
+                        self._reader.read(MQTT_RECV_BUF_SZ), self._read_timeout()
+                    )
+                except asyncio.TimeoutError:
+                    if self._ping_sent:
+                        raise EOFError("PINGRESP not returned from broker.") from None
+                    if self.logger is not None:
+                        self.logger.debug("KeepAlive period elapsed - sending PINGREQ")
+                    self._send_ping()
+                    await self._drain()
+                    continue
+                if not data:
+                    raise EOFError("Connection closed by broker.")
+                decoder.feed(data)
+                self.stats.recv_buffer_high = max(
+                    self.stats.recv_buffer_high, len(decoder)
+                )
+                while not decoder.remaining or self._stream_payload() is not None:
+                    header = decoder.next_packet()
+                    if header is None:
+                        break
+                    if decoder.remaining:
+                        # too large to buffer, the payload is streamed
+                        self._start_stream(header, decoder.body)
+                    else:
+                        self._dispatch(header, decoder.body)
+                if (
+                    self._stats_topic
+                    and time.monotonic() - self._stats_published
+                    >= self._stats_interval
+                ):
+                    # sent when a packet arrives, once the interval has passed
+                    self._send_publish_msg(
+                        self._stats_topic, self._stats_message(), False, 0
+                    )
+                    await self._drain()
+        except (OSError, EOFError) as error:
+            # raised as by the other clients, which callers and
+            # MQTTSupervisor handle as a lost connection
+            self._reader_stopped(
+                error, MMQTTException("Connection to broker lost: {}".format(error))
+            )
+        except Exception as error:  # pylint: disable=broad-except
+            # a DISCONNECT from the broker, a protocol error, or a callback
+            # which raised: waiters and the iterator get the error itself
+            self._reader_stopped(error, error)
+
+    def _reader_stopped(self, error, raised):
+        """Closes the connection once the reader task stops on an error.
+        :param Exception error: Error which stopped the reader task.
+        :param Exception raised: Error raised to the tasks waiting for an
+            acknowledgement, and by the async iterator once the queued
+            messages are read.
+
+        """
+        if self.logger:
+            self.logger.warning("Connection lost: {}".format(error))
+        self._reader_task = None
+        self._reader_error = raised
+        self._is_connected = False
+        self._writer.close()
+        self._fail_waiters(raised)
+        if self.on_disconnect is not None:
+            self.on_disconnect(self, self._user_data, 1)
+
+    def _read_timeout(self):
+        """Returns how long the reader task may wait for data before the
+        outstanding PINGRESP is overdue, or a PINGREQ is due because nothing
+        has been sent for a keep alive period."""
+        if not self.keep_alive:
+            return None
+        if self._ping_sent:
+            deadline = self._ping_sent + self._ping_timeout()
+        else:
+            deadline = self._last_send + self.keep_alive
+        return max(0, deadline - time.monotonic())
+
+    def _dispatch(self, header, body):
+        """Processes a packet and wakes the task waiting for it, if any.
+        :param int header: First byte of the fixed header.
+        :param memoryview body: Variable header and payload of the packet.
+
+        """
+        packet_type = self._handle_packet(header, body) & 0xF0
+        # the decoder reuses its buffer, so waiters get a copy of the body
+        if packet_type in (_SUBACK, _UNSUBACK):
+            self._resolve(packet_type, body[0] << 8 | body[1], bytes(body))
+        elif packet_type in (_CONNACK, MQTT_PINGRESP):
+            self._resolve(packet_type, 0, bytes(body))
+
+    def _handle_on_message(self, client, topic, payload):
+        super()._handle_on_message(client, topic, payload)
+        if self._message_queue_size:
+            # payload points into the receive buffer, queue a copy
+            message = bytes(payload)
+            if not self.raw_payloads:
+                try:
+                    message = self._decode_message(topic, message)
+                except ValueError as error:
+                    # binary payloads, which raw callbacks may handle, are
+                    # queued as bytes
+                    if self.logger:
+                        self.logger.debug(
+                            "Queueing message on %s as bytes: %s", topic, error
+                        )
+            if len(self._messages) >= self._message_queue_size:
+                self._messages.pop(0)
+            self._messages.append((topic, message))
+            self._message_event.set()
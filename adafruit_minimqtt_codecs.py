@@ -0,0 +1,433 @@
+# SPDX-FileCopyrightText: 2021 ErogigGit
+#
+# SPDX-License-Identifier: MIT
+
+"""
+`adafruit_minimqtt_codecs`
+================================================================================
+
+Compact binary payload codecs for MiniMQTT, chosen per topic with
+`adafruit_minimqtt.MQTT.add_topic_codec`.
+
+Implementation Notes
+--------------------
+
+Without a codec, numbers are published as decimal strings and callbacks get
+str payloads, which are parsed back into numbers. A codec instead packs the
+values of a message into a few bytes, and callbacks get the values back
+without parsing any text:
+
+* `StructCodec`: fixed records packed with the `struct` module, such as
+  ``"<fff"`` for three single precision floats.
+* `CBORCodec`: CBOR (RFC 8949) encoding of numbers, strings, byte strings,
+  lists and dicts, for messages without a fixed layout. Decimal readings
+  such as 21.3 have no exact binary form and take 9 bytes each, more than
+  their text, unless ``float_precision`` allows them to be rounded.
+* `DeltaCodec`: arrays of numbers, stored as the differences between
+  neighbouring values in fixed point, in as few bytes as each needs.
+
+A codec has an ``encode(value)`` method, which returns a memoryview of the
+encoded payload, and a ``decode(payload)`` method, which returns the value.
+Codecs encode into a buffer they reuse, so the memoryview is only valid
+until the next message is encoded. Decoding reads the received payload in
+place: byte strings decoded by `CBORCodec` are memoryviews of the payload,
+only valid until the callback returns.
+
+Codecs only suit brokers and subscribers which expect binary payloads:
+the Adafruit IO broker only accepts text.
+
+"""
+import math
+import struct
+from micropython import const
+
+FLOAT_HALF = const(16)
+FLOAT_SINGLE = const(32)
+
+_CBOR_UINT = 0x00
+_CBOR_NINT = 0x20
+_CBOR_BYTES = 0x40
+_CBOR_TEXT = 0x60
+_CBOR_ARRAY = 0x80
+_CBOR_MAP = 0xA0
+_CBOR_FALSE = 0xF4
+_CBOR_TRUE = 0xF5
+_CBOR_NULL = 0xF6
+
+# Largest half precision float
+_HALF_MAX = 65504.0
+
+
+class _Encoder:
+    """Base class of codecs which encode into a reusable, growing buffer."""
+
+    def __init__(self, size=64):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._end = 0
+
+    def _reserve(self, size):
+        """Grows the buffer to hold size more bytes, and returns the offset
+        to write them at."""
+        offset = self._end
+        self._end += size
+        if self._end > len(self._buf):
+            buf = bytearray(max(self._end, 2 * len(self._buf)))
+            buf[:offset] = self._view[:offset]
+            self._buf = buf
+            self._view = memoryview(buf)
+        return offset
+
+    def _append(self, data):
+        offset = self._reserve(len(data))
+        self._buf[offset : self._end] = data
+
+    def _append_byte(self, byte):
+        offset = self._reserve(1)
+        self._buf[offset] = byte
+
+    def _pack(self, fmt, *values):
+        offset = self._reserve(struct.calcsize(fmt))
+        struct.pack_into(fmt, self._buf, offset, *values)
+
+    def _write_varint(self, value):
+        """Writes an unsigned integer, 7 bits per byte."""
+        while value > 0x7F:
+            self._append_byte(value & 0x7F | 0x80)
+            value >>= 7
+        self._append_byte(value)
+
+
+class StructCodec:
+    """Codec for fixed records packed with the `struct` module.
+
+    .. code-block:: python
+
+        # temperature, humidity and pressure in 12 bytes
+        mqtt_client.add_topic_codec("sensors/+/climate", StructCodec("<fff"))
+        mqtt_client.publish("sensors/kitchen/climate", (21.5, 40.2, 1013.1))
+
+    :param str fmt: Format of a record, see `struct.pack`.
+
+    """
+
+    def __init__(self, fmt):
+        self.fmt = fmt
+        self._buf = bytearray(struct.calcsize(fmt))
+        self._view = memoryview(self._buf)
+        # a record with a single field is passed as a plain value
+        self._single = len(struct.unpack_from(fmt, self._buf)) == 1
+
+    def encode(self, value):
+        """Packs a record, a tuple of its fields, into the buffer and returns
+        a memoryview of it.
+        :param tuple value: Fields of the record, or a single value when the
+            record has one field.
+
+        """
+        if self._single:
+            struct.pack_into(self.fmt, self._buf, 0, value)
+        else:
+            struct.pack_into(self.fmt, self._buf, 0, *value)
+        return self._view
+
+    def decode(self, payload):
+        """Unpacks a record, returning a tuple of its fields, or a single
+        value when the record has one field.
+        :param memoryview payload: Received payload.
+
+        """
+        if len(payload) != len(self._buf):
+            raise ValueError("Payload is not a {} record.".format(self.fmt))
+        fields = struct.unpack_from(self.fmt, payload)
+        return fields[0] if self._single else fields
+
+
+class CBORCodec(_Encoder):
+    """Codec for CBOR, a binary counterpart of JSON.
+
+    Encodes None, bools, ints, floats, str, bytes, lists, tuples and dicts.
+    Floats are sent in 4 bytes when that keeps their value, and in 8
+    otherwise. Indefinite lengths are not supported, tags are ignored.
+
+    .. code-block:: python
+
+        # temperatures rounded to 3 significant digits, in 3 bytes each
+        mqtt_client.add_topic_codec(
+            "devices/+/status", CBORCodec(float_precision=FLOAT_HALF)
+        )
+        mqtt_client.publish("devices/pyportal/status", {"t": 21.3, "up": 3600})
+
+    :param int float_precision: Rounds floats to half precision
+        (`FLOAT_HALF`, 3 bytes, about 3 significant digits, up to 65504) or
+        single precision (`FLOAT_SINGLE`, 5 bytes, about 7 digits) when
+        they can not be sent exactly in fewer bytes. Floats outside the
+        range of the precision are sent as they would be without it. By
+        default floats are never rounded.
+
+    """
+
+    def __init__(self, float_precision=None):
+        if float_precision not in (None, FLOAT_HALF, FLOAT_SINGLE):
+            raise ValueError("float_precision must be FLOAT_HALF or FLOAT_SINGLE.")
+        super().__init__()
+        self.float_precision = float_precision
+
+    def encode(self, value):
+        """Encodes a value and returns a memoryview of the encoded payload.
+        :param value: Value to encode.
+
+        """
+        self._end = 0
+        self._write(value)
+        return self._view[: self._end]
+
+    def _write_head(self, major, value):
+        """Writes the initial byte of a data item and its argument."""
+        if value < 24:
+            self._append_byte(major | value)
+        elif value <= 0xFF:
+            self._pack(">BB", major | 24, value)
+        elif value <= 0xFFFF:
+            self._pack(">BH", major | 25, value)
+        elif value <= 0xFFFFFFFF:
+            self._pack(">BI", major | 26, value)
+        else:
+            self._pack(">BQ", major | 27, value)
+
+    # pylint: disable=too-many-branches
+    def _write(self, value):
+        if value is None:
+            self._append_byte(_CBOR_NULL)
+        elif value is True:
+            self._append_byte(_CBOR_TRUE)
+        elif value is False:
+            self._append_byte(_CBOR_FALSE)
+        elif isinstance(value, int):
+            if value >= 0:
+                self._write_head(_CBOR_UINT, value)
+            else:
+                self._write_head(_CBOR_NINT, -1 - value)
+        elif isinstance(value, float):
+            if self.float_precision == FLOAT_HALF and -_HALF_MAX <= value <= _HALF_MAX:
+                self._pack(">BH", 0xF9, _to_half(value))
+                return
+            try:
+                single = struct.pack(">f", value)
+            except OverflowError:
+                # too large for single precision
+                single = None
+            if single is not None and (
+                self.float_precision is not None
+                or struct.unpack(">f", single)[0] == value
+                or value != value
+            ):
+                self._append_byte(0xFA)
+                self._append(single)
+            else:
+                self._pack(">Bd", 0xFB, value)
+        elif isinstance(value, str):
+            encoded = value.encode("utf-8")
+            self._write_head(_CBOR_TEXT, len(encoded))
+            self._append(encoded)
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            self._write_head(_CBOR_BYTES, len(value))
+            self._append(value)
+        elif isinstance(value, (list, tuple)):
+            self._write_head(_CBOR_ARRAY, len(value))
+            for item in value:
+                self._write(item)
+        elif isinstance(value, dict):
+            self._write_head(_CBOR_MAP, len(value))
+            for key, item in value.items():
+                self._write(key)
+                self._write(item)
+        else:
+            raise TypeError("Can not encode {} as CBOR.".format(type(value)))
+
+    def decode(self, payload):
+        """Decodes a CBOR payload. Byte strings are returned as memoryviews
+        of the payload. Raises ValueError for malformed payloads.
+        :param memoryview payload: Received payload.
+
+        """
+        if not isinstance(payload, memoryview):
+            payload = memoryview(payload)
+        value, offset = self._read(payload, 0)
+        if offset != len(payload):
+            raise ValueError("Unexpected bytes after the CBOR data item.")
+        return value
+
+    @staticmethod
+    def _read_head(buf, offset):
+        """Returns the major type, argument and offset after the head of
+        the data item at offset."""
+        initial = buf[offset]
+        info = initial & 0x1F
+        offset += 1
+        if info < 24:
+            return initial & 0xE0, info, offset
+        if info > 27:
+            raise ValueError("Indefinite length CBOR is not supported.")
+        size = 1 << (info - 24)
+        _check_length(buf, offset + size)
+        value = 0
+        for byte in buf[offset : offset + size]:
+            value = value << 8 | byte
+        return initial & 0xE0, value, offset + size
+
+    # pylint: disable=too-many-return-statements
+    def _read(self, buf, offset):
+        """Returns the data item at offset and the offset after it."""
+        _check_length(buf, offset + 1)
+        initial = buf[offset]
+        if initial == 0xF9:
+            _check_length(buf, offset + 3)
+            return _half_float(buf[offset + 1] << 8 | buf[offset + 2]), offset + 3
+        if initial == 0xFA:
+            _check_length(buf, offset + 5)
+            return struct.unpack_from(">f", buf, offset + 1)[0], offset + 5
+        if initial == 0xFB:
+            _check_length(buf, offset + 9)
+            return struct.unpack_from(">d", buf, offset + 1)[0], offset + 9
+        if initial >= 0xE0:
+            if not _CBOR_FALSE <= initial <= _CBOR_NULL:
+                raise ValueError("Unsupported CBOR simple value 0x%02x." % initial)
+            simple = {_CBOR_FALSE: False, _CBOR_TRUE: True, _CBOR_NULL: None}
+            return simple[initial], offset + 1
+        major, value, offset = self._read_head(buf, offset)
+        if major == _CBOR_UINT:
+            return value, offset
+        if major == _CBOR_NINT:
+            return -1 - value, offset
+        if major in (_CBOR_BYTES, _CBOR_TEXT):
+            _check_length(buf, offset + value)
+            data = buf[offset : offset + value]
+            if major == _CBOR_TEXT:
+                data = str(data, "utf-8")
+            return data, offset + value
+        if major == _CBOR_ARRAY:
+            items = []
+            for _ in range(value):
+                item, offset = self._read(buf, offset)
+                items.append(item)
+            return items, offset
+        if major == _CBOR_MAP:
+            items = {}
+            for _ in range(value):
+                key, offset = self._read(buf, offset)
+                if isinstance(key, memoryview):
+                    key = bytes(key)
+                elif isinstance(key, (list, dict)):
+                    raise ValueError("CBOR map keys must be hashable.")
+                items[key], offset = self._read(buf, offset)
+            return items, offset
+        # a tag, which only annotates the data item after it
+        return self._read(buf, offset)
+
+
+def _check_length(buf, end):
+    """Raises ValueError when a payload ends before end."""
+    if end > len(buf):
+        raise ValueError("Payload ends in the middle of a value.")
+
+
+def _to_half(value):
+    """Returns value rounded to an IEEE 754 half precision float, as an int.
+    value must be within the half precision range."""
+    sign = 0x8000 if math.copysign(1.0, value) < 0 else 0
+    value = abs(value)
+    if value < 2.0 ** -14:
+        # subnormal, the rounding may carry into the smallest normal value
+        return sign | round(value * 2.0 ** 24)
+    mantissa, exponent = math.frexp(value)
+    fraction = round((mantissa * 2 - 1) * 1024)
+    exponent += 14
+    if fraction == 1024:
+        fraction = 0
+        exponent += 1
+    return sign | exponent << 10 | fraction
+
+
+def _half_float(half):
+    """Returns the value of an IEEE 754 half precision float."""
+    exponent = half >> 10 & 0x1F
+    fraction = half & 0x3FF
+    if exponent == 0:
+        value = fraction * 2.0 ** -24
+    elif exponent == 0x1F:
+        value = float("nan") if fraction else float("inf")
+    else:
+        value = (fraction + 1024) * 2.0 ** (exponent - 25)
+    return -value if half & 0x8000 else value
+
+
+class DeltaCodec(_Encoder):
+    """Codec for arrays of numbers, such as a series of sensor readings.
+
+    Values are rounded to ``1 / scale`` and each value after the first is
+    stored as its difference from the one before, so slowly changing values
+    take a byte or two each.
+
+    .. code-block:: python
+
+        # readings to two decimal places
+        mqtt_client.add_topic_codec("sensors/+/history", DeltaCodec(scale=100))
+        mqtt_client.publish("sensors/kitchen/history", [21.5, 21.52, 21.49])
+
+    :param int scale: Values are stored as multiples of ``1 / scale``. With a
+        scale of 1, values are decoded as ints, otherwise as floats.
+
+    """
+
+    def __init__(self, scale=100):
+        super().__init__()
+        self.scale = scale
+
+    def encode(self, value):
+        """Encodes a sequence of numbers and returns a memoryview of the
+        encoded payload.
+        :param list value: Numbers to encode.
+
+        """
+        self._end = 0
+        self._write_varint(len(value))
+        previous = 0
+        for number in value:
+            fixed = round(number * self.scale)
+            delta = fixed - previous
+            previous = fixed
+            # zigzag: small negative and positive deltas both stay small
+            self._write_varint(delta << 1 if delta >= 0 else (-delta << 1) - 1)
+        return self._view[: self._end]
+
+    def decode(self, payload):
+        """Decodes a payload into a list of numbers. Raises ValueError for
+        malformed payloads.
+        :param memoryview payload: Received payload.
+
+        """
+        count, offset = _read_varint(payload, 0)
+        values = []
+        fixed = 0
+        for _ in range(count):
+            zigzag, offset = _read_varint(payload, offset)
+            fixed += -(zigzag + 1 >> 1) if zigzag & 1 else zigzag >> 1
+            values.append(fixed if self.scale == 1 else fixed / self.scale)
+        if offset != len(payload):
+            raise ValueError("Unexpected bytes after the delta encoded array.")
+        return values
+
+
+def _read_varint(buf, offset):
+    """Reads an unsigned integer written 7 bits per byte, returning it and
+    the offset after it."""
+    value = shift = 0
+    while True:
+        _check_length(buf, offset + 1)
+        byte = buf[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
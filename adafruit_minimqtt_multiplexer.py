@@ -0,0 +1,368 @@
+# SPDX-FileCopyrightText: 2021 ErogigGit
+#
+# SPDX-License-Identifier: MIT
+
+"""
+`adafruit_minimqtt_multiplexer`
+================================================================================
+
+Runs many MiniMQTT clients from a single loop.
+
+Implementation Notes
+--------------------
+
+`MQTTMultiplexer` watches the sockets of all its clients with the
+`selectors` module and only runs `adafruit_minimqtt.MQTT.loop` for the
+clients which received data, so one process can host thousands of clients,
+such as simulated devices for load testing a broker or gateway. Once a
+``check_interval`` every client is checked for keep alive pings which are
+due, and disconnected clients are reconnected once the backoff of their
+`adafruit_minimqtt_supervisor.MQTTSupervisor` allows.
+
+Reconnects never block the loop: the TCP connect, the TLS handshake and the
+wait for the CONNACK run on non-blocking sockets watched by the same
+selector, each attempt with a deadline of ``connect_timeout`` seconds, so a
+broker which is down or slow only delays its own clients. Resubscribes are
+sent once the CONNACK arrived, and their SUBACKs handled as they arrive.
+Only the ``reset_network`` function of a supervisor, and the address lookup
+the client caches for ``addr_cache_ttl`` seconds, run inline.
+
+**Software and Dependencies:**
+
+* CPython 3.7+, with sockets from the socket module
+
+"""
+import errno
+import os
+import selectors
+import socket
+import ssl
+import time
+from adafruit_minimqtt import MQTT_TLS_PORT
+from adafruit_minimqtt_supervisor import MQTTSupervisor, _CONNECTION_ERRORS
+
+# Steps of a connection attempt
+_TCP = 0
+_TLS = 1
+_CONNACK = 2
+
+
+class MQTTMultiplexer:
+    """Drives the network loop of many MiniMQTT clients.
+
+    .. code-block:: python
+
+        multiplexer = MQTTMultiplexer()
+        for i in range(1000):
+            client = MQTT.MQTT(broker, client_id="device-%d" % i, socket_pool=socket)
+            client.on_connect = subscribe_commands
+            multiplexer.add(client)
+        while True:
+            multiplexer.loop()
+
+    Clients do not need to be connected before they are added: the first call
+    to `loop()` connects them, one after another.
+
+    :param int max_messages: Number of packets processed per client in one
+        pass, so that a busy client can not starve the others.
+    :param float check_interval: Time between keep alive and reconnect
+        checks of all clients, in seconds.
+    :param float connect_timeout: Longest time a connection attempt may take,
+        from the TCP connect to the CONNACK, in seconds.
+
+    """
+
+    def __init__(self, max_messages=20, check_interval=1, connect_timeout=10):
+        self.max_messages = max_messages
+        self.check_interval = check_interval
+        self.connect_timeout = connect_timeout
+        self._selector = selectors.DefaultSelector()
+        self._supervisors = {}
+        # Socket registered with the selector for each client
+        self._socks = {}
+        # Connection attempts in progress, by client
+        self._attempts = {}
+        # Clients which may have more data waiting than they processed
+        self._backlog = set()
+        self._next_check = 0
+
+    def __len__(self):
+        """Number of clients."""
+        return len(self._supervisors)
+
+    @property
+    def connected(self):
+        """Number of connected clients."""
+        # pylint: disable=protected-access
+        return sum(
+            supervisor.connected and client._is_connected
+            for client, supervisor in self._supervisors.items()
+        )
+
+    def add(self, client, supervisor=None):
+        """Adds a client, which is connected by the next call to `loop()`
+        if it is not connected yet.
+        :param MQTT client: MiniMQTT client.
+        :param MQTTSupervisor supervisor: Supervisor which reconnects the
+            client. Defaults to a new `MQTTSupervisor` for the client.
+
+        """
+        if supervisor is None:
+            supervisor = MQTTSupervisor(client)
+        self._supervisors[client] = supervisor
+        self._register(client)
+        # check the new client straight away
+        self._next_check = 0
+
+    def remove(self, client):
+        """Removes a client, without disconnecting it.
+        :param MQTT client: MiniMQTT client added with `add()`.
+
+        """
+        del self._supervisors[client]
+        self._backlog.discard(client)
+        self._unregister(client)
+        attempt = self._attempts.pop(client, None)
+        if attempt is not None:
+            self._selector.unregister(attempt.sock)
+            attempt.sock.close()
+
+    def loop(self, timeout=1):
+        """Waits up to timeout seconds for data on any client socket and
+        processes it. Pings and reconnects clients once they are due.
+        Returns the number of clients which processed data.
+        :param float timeout: Longest time to wait, in seconds.
+
+        """
+        now = time.monotonic()
+        deadline = self._next_check
+        for attempt in self._attempts.values():
+            deadline = min(deadline, attempt.deadline)
+        wait = 0 if self._backlog else max(0, min(timeout, deadline - now))
+        ready = self._backlog
+        self._backlog = set()
+        if self._socks or self._attempts:
+            for key, _ in self._selector.select(wait):
+                ready.add(key.data)
+        elif wait:
+            time.sleep(wait)
+        for client in ready:
+            if client in self._attempts:
+                self._advance(client)
+            elif client in self._supervisors:
+                self._service(client)
+        now = time.monotonic()
+        for client, attempt in list(self._attempts.items()):
+            if now >= attempt.deadline:
+                self._attempt_failed(
+                    client, OSError(errno.ETIMEDOUT, "Connection attempt timed out")
+                )
+        if now >= self._next_check:
+            self._next_check = now + self.check_interval
+            for client, supervisor in list(self._supervisors.items()):
+                if client in ready or client in self._attempts:
+                    continue
+                # pylint: disable=protected-access
+                deadline = client._next_timer()
+                if not supervisor.connected:
+                    self._start_attempt(client)
+                elif not client._is_connected or (
+                    deadline is not None and deadline <= now
+                ):
+                    self._service(client)
+        return len(ready)
+
+    def _service(self, client):
+        """Runs the loop of a connected client once, and follows its socket.
+        A client which lost its connection starts a connection attempt."""
+        # pylint: disable=protected-access
+        supervisor = self._supervisors[client]
+        rcs = supervisor._process(0, self.max_messages, None)
+        if not supervisor.connected:
+            self._start_attempt(client)
+            return
+        self._register(client)
+        # pylint: disable=protected-access
+        sock = client._sock
+        if client._is_connected and (
+            (rcs and len(rcs) >= self.max_messages)
+            # bytes already decrypted by an SSL socket are invisible to select
+            or (hasattr(sock, "pending") and sock.pending())
+        ):
+            self._backlog.add(client)
+
+    def _start_attempt(self, client):
+        """Starts a non-blocking connection attempt of a disconnected client,
+        once the backoff of its supervisor allows one."""
+        # pylint: disable=protected-access
+        supervisor = self._supervisors[client]
+        if time.monotonic() < supervisor._next_attempt:
+            return
+        self._unregister(client)
+        if client._sock is not None:
+            client._sock.close()
+            client._sock = None
+        client._is_connected = False
+        # keep the topics of resubscribes which were not acknowledged
+        for batch in client._subacks.values():
+            for topic, qos in batch:
+                client._subscribed_topics.setdefault(topic, qos)
+        client._subacks = {}
+        sock = None
+        try:
+            supervisor._begin_attempt()
+            addr_info = client._get_addr_info(client.broker, client.port)
+            sock = client._socket_pool.socket(addr_info[0], addr_info[1], addr_info[2])
+            sock.setblocking(False)
+            error = sock.connect_ex(addr_info[-1])
+            if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                raise OSError(error, os.strerror(error))
+        except _CONNECTION_ERRORS as error:
+            if sock is not None:
+                sock.close()
+            supervisor._attempt_failed(error)
+            return
+        self._attempts[client] = _Attempt(
+            sock, time.monotonic() + self.connect_timeout
+        )
+        self._selector.register(sock, selectors.EVENT_WRITE, client)
+
+    def _advance(self, client):
+        """Takes the next step of the connection attempt of a client whose
+        socket is ready."""
+        attempt = self._attempts[client]
+        try:
+            if attempt.step == _TCP:
+                self._connected_tcp(client, attempt)
+            elif attempt.step == _TLS:
+                self._handshake(client, attempt)
+            else:
+                self._receive_connack(client, attempt)
+        except _CONNECTION_ERRORS as error:
+            self._attempt_failed(client, error)
+
+    def _connected_tcp(self, client, attempt):
+        """Checks the result of the TCP connect, and starts the TLS handshake
+        or sends CONNECT."""
+        sock = attempt.sock
+        error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            raise OSError(error, os.strerror(error))
+        if client.port != MQTT_TLS_PORT:
+            self._send_connect(client, attempt)
+            return
+        # wrapping replaces the socket object, which the selector must forget
+        self._selector.unregister(sock)
+        # pylint: disable=protected-access
+        attempt.sock = client._wrap_socket(
+            sock, client.broker, client.port, do_handshake_on_connect=False
+        )
+        attempt.step = _TLS
+        attempt.handshake_start = time.monotonic_ns()
+        self._selector.register(attempt.sock, selectors.EVENT_WRITE, client)
+        self._handshake(client, attempt)
+
+    def _handshake(self, client, attempt):
+        """Continues the TLS handshake as far as the socket allows."""
+        try:
+            attempt.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self._selector.modify(attempt.sock, selectors.EVENT_READ, client)
+            return
+        except ssl.SSLWantWriteError:
+            self._selector.modify(attempt.sock, selectors.EVENT_WRITE, client)
+            return
+        client.stats.tls_handshake(
+            time.monotonic_ns() - attempt.handshake_start,
+            getattr(attempt.sock, "session_reused", False),
+        )
+        self._send_connect(client, attempt)
+
+    def _send_connect(self, client, attempt):
+        """Hands the connected socket to the client and sends CONNECT."""
+        # pylint: disable=protected-access
+        sock = attempt.sock
+        sock.settimeout(1)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
+        client._backwards_compatible_sock = False
+        client._sock = sock
+        client._start_connect()
+        attempt.step = _CONNACK
+        self._selector.modify(sock, selectors.EVENT_READ, client)
+
+    def _receive_connack(self, client, attempt):
+        """Processes the CONNACK once it arrived, then resubscribes without
+        waiting for the SUBACKs and resends unacknowledged messages."""
+        # pylint: disable=protected-access
+        if client._wait_for_msg() != 0x20:
+            return
+        client._connack_received([])
+        if not client.session_present and client._subscribed_topics:
+            topics = list(client._subscribed_topics.items())
+            client._subscribed_topics = {}
+            for pid, batch in client._send_subscribe(topics):
+                client._subacks[pid] = batch
+        client._resend_inflight()
+        client.stats.reconnects += 1
+        client.stats.reconnect_ns += time.monotonic_ns() - attempt.start
+        del self._attempts[client]
+        self._socks[client] = attempt.sock
+        self._supervisors[client]._attempt_succeeded()
+        if client._sock_has_data():
+            # packets which arrived along with the CONNACK
+            self._backlog.add(client)
+
+    def _attempt_failed(self, client, error):
+        """Closes the socket of a failed connection attempt and lets the
+        supervisor schedule the next one."""
+        # pylint: disable=protected-access
+        attempt = self._attempts.pop(client)
+        try:
+            self._selector.unregister(attempt.sock)
+        except (KeyError, ValueError):
+            pass
+        attempt.sock.close()
+        if client._sock is attempt.sock:
+            client._sock = None
+        client._is_connected = False
+        if attempt.step == _TLS:
+            # the broker may have refused to resume the TLS session
+            client._tls_session = None
+        self._supervisors[client]._attempt_failed(error)
+
+    def _register(self, client):
+        """Registers the current socket of a client with the selector,
+        replacing the socket it had before it reconnected."""
+        # pylint: disable=protected-access
+        sock = client._sock if client._is_connected else None
+        if self._socks.get(client) is sock:
+            return
+        self._unregister(client)
+        if sock is not None:
+            self._selector.register(sock, selectors.EVENT_READ, client)
+            self._socks[client] = sock
+
+    def _unregister(self, client):
+        sock = self._socks.pop(client, None)
+        if sock is None:
+            return
+        try:
+            self._selector.unregister(sock)
+        except (KeyError, ValueError):
+            # the socket was closed and can not be found any more
+            pass
+
+
+class _Attempt:
+    """Connection attempt of a client in progress."""
+
+    # pylint: disable=too-few-public-methods
+    def __init__(self, sock, deadline):
+        self.sock = sock
+        self.deadline = deadline
+        self.step = _TCP
+        self.start = time.monotonic_ns()
+        self.handshake_start = 0
@@ -0,0 +1,170 @@
+# SPDX-FileCopyrightText: 2021 ErogigGit
+#
+# SPDX-License-Identifier: MIT
+
+"""
+`adafruit_minimqtt_queue`
+================================================================================
+
+Bounded queue of received MQTT messages, between the packet parser and the
+message callbacks.
+
+Implementation Notes
+--------------------
+
+With a queue, `adafruit_minimqtt.MQTT.loop` only receives messages: each
+message is acknowledged on receipt, copied into the queue, and its callbacks
+run later, when the main loop calls
+`adafruit_minimqtt.MQTT.process_messages`. A slow callback, such as one
+which redraws the display, then no longer delays PUBACKs or keep alive
+pings.
+
+On CPython the callbacks can instead run on an executor, such as a
+`concurrent.futures.ThreadPoolExecutor`. Messages on the same topic are
+still handled one at a time, in the order they arrived.
+
+A full queue applies its overflow policy:
+
+* ``OVERFLOW_BLOCK``: wait until there is room. Without an executor, the
+  oldest message is handled first, so the network waits for the callbacks.
+* ``OVERFLOW_DROP_OLDEST``: drop the oldest waiting message.
+* ``OVERFLOW_DROP_NEWEST``: drop the message which just arrived.
+
+"""
+import time
+from micropython import const
+
+try:
+    import threading
+except ImportError:
+    threading = None
+
+OVERFLOW_BLOCK = const(0)
+OVERFLOW_DROP_OLDEST = const(1)
+OVERFLOW_DROP_NEWEST = const(2)
+
+
+class MQTTMessageQueue:
+    """Queue of received messages waiting for their callbacks.
+
+    .. code-block:: python
+
+        mqtt_client = MQTT.MQTT(..., message_queue=MQTTMessageQueue(16))
+        while True:
+            mqtt_client.loop(timeout=0)
+            mqtt_client.process_messages(budget_ms=20)
+
+    :param int size: Most messages waiting at once.
+    :param int overflow: What to do when a message arrives while the queue
+        is full: `OVERFLOW_BLOCK`, `OVERFLOW_DROP_OLDEST` or
+        `OVERFLOW_DROP_NEWEST`.
+    :param executor: Optional `concurrent.futures.Executor`, or any object
+        with a ``submit(function, *args)`` method, to run callbacks on.
+
+    """
+
+    def __init__(self, size=16, overflow=OVERFLOW_DROP_OLDEST, executor=None):
+        if executor is not None and threading is None:
+            raise RuntimeError("An executor needs the threading module.")
+        self.size = size
+        self.overflow = overflow
+        self._executor = executor
+        # (topic, payload) tuples, oldest first
+        self._waiting = []
+        # Topics with a callback running on the executor
+        self._running = set()
+        self._changed = threading.Condition() if executor is not None else None
+        # Messages dropped by the overflow policy, and most messages waiting
+        self.dropped = 0
+        self.high_water = 0
+
+    def __len__(self):
+        """Number of messages waiting, or running on the executor."""
+        return len(self._waiting) + len(self._running)
+
+    def put(self, topic, payload, handler):
+        """Adds a received message to the queue.
+        :param str topic: Topic of the message.
+        :param payload: Payload of the message, which is copied.
+        :param handler: Function which runs the callbacks, called with
+            the topic and payload.
+
+        """
+        if self._executor is None:
+            if len(self._waiting) >= self.size:
+                if self.overflow == OVERFLOW_BLOCK:
+                    self.process(handler, 1)
+                elif not self._drop():
+                    return
+            self._append(topic, payload)
+            return
+        with self._changed:
+            while len(self) >= self.size:
+                if self.overflow == OVERFLOW_BLOCK:
+                    self._changed.wait()
+                elif not self._drop():
+                    return
+            self._append(topic, payload)
+            self._submit(handler)
+
+    def _append(self, topic, payload):
+        self._waiting.append((topic, bytes(payload)))
+        self.high_water = max(self.high_water, len(self))
+
+    def _drop(self):
+        """Applies a dropping overflow policy. Returns True when the new
+        message should still be queued."""
+        self.dropped += 1
+        # messages already running on the executor can not be dropped
+        if self.overflow == OVERFLOW_DROP_NEWEST or not self._waiting:
+            return False
+        self._waiting.pop(0)
+        return True
+
+    def process(self, handler, max_messages=None, budget_ms=None):
+        """Runs the callbacks of waiting messages, oldest first.
+        Returns the number of messages handled.
+        Messages are handled by the executor instead, when there is one.
+        :param handler: Function which runs the callbacks, called with
+            the topic and payload.
+        :param int max_messages: Handle at most this many messages.
+        :param int budget_ms: Stop once this many milliseconds have passed.
+
+        """
+        if self._executor is not None:
+            return 0
+        stamp = time.monotonic()
+        count = 0
+        while self._waiting:
+            if max_messages is not None and count >= max_messages:
+                break
+            if budget_ms is not None and (time.monotonic() - stamp) * 1000 >= budget_ms:
+                break
+            topic, payload = self._waiting.pop(0)
+            handler(topic, payload)
+            count += 1
+        return count
+
+    def _submit(self, handler):
+        """Submits the oldest waiting message of every topic which has no
+        callback running. Must be called with the lock held."""
+        index = 0
+        while index < len(self._waiting):
+            topic, payload = self._waiting[index]
+            if topic in self._running:
+                index += 1
+                continue
+            del self._waiting[index]
+            self._running.add(topic)
+            self._executor.submit(self._run, handler, topic, payload)
+
+    def _run(self, handler, topic, payload):
+        """Executor task: runs the callbacks of a message, then submits the
+        next message on the same topic."""
+        try:
+            handler(topic, payload)
+        finally:
+            with self._changed:
+                self._running.discard(topic)
+                self._submit(handler)
+                self._changed.notify_all()
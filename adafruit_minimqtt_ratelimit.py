@@ -0,0 +1,145 @@
+# SPDX-FileCopyrightText: 2021 ErogigGit
+#
+# SPDX-License-Identifier: MIT
+
+"""
+`adafruit_minimqtt_ratelimit`
+================================================================================
+
+Keeps a MiniMQTT client under a broker's publish rate limit without sleeping.
+
+Implementation Notes
+--------------------
+
+`MQTTRateLimiter` queues messages and sends them with a token bucket: tokens
+are added at ``per_minute`` tokens a minute, up to ``burst`` tokens, and each
+message sent takes one. Brokers such as Adafruit IO disconnect or throttle
+clients which publish faster than their limit.
+
+Messages are sent with `adafruit_minimqtt.MQTT.publish_many` without waiting
+for their PUBACKs, and only while the in-flight window has room, so flushing
+never blocks. Set the limiter as the ``rate_limiter`` of the client, and
+`adafruit_minimqtt.MQTT.loop` flushes it, also when an
+`adafruit_minimqtt_supervisor.MQTTSupervisor` or
+`adafruit_minimqtt_multiplexer.MQTTMultiplexer` runs the loop.
+
+Only the latest value of a topic is kept: a message published to a topic
+which already has a message waiting replaces it, and keeps its place in the
+queue. Sensor readings which could not be sent in time are therefore
+replaced by newer readings, instead of being sent late.
+
+"""
+import time
+
+
+class MQTTRateLimiter:
+    """Sends messages through a MiniMQTT client at a limited rate.
+
+    .. code-block:: python
+
+        limiter = MQTTRateLimiter(mqtt_client, per_minute=30)
+        mqtt_client.rate_limiter = limiter
+        while True:
+            limiter.publish(temperature_topic, read_temperature())
+            mqtt_client.loop(timeout=0)
+
+    :param MQTT client: MiniMQTT client to publish with.
+    :param float per_minute: Messages sent per minute, on average.
+    :param int burst: Most messages sent at once, after an idle period.
+    :param int max_queue: Most topics with a message waiting. When the queue
+        is full, the oldest message is dropped.
+
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, client, per_minute=30, burst=1, max_queue=32):
+        self._client = client
+        self.per_minute = per_minute
+        self.burst = burst
+        self.max_queue = max_queue
+        self._tokens = burst
+        self._refilled = time.monotonic()
+        # Topics in the order their messages were queued, and their messages
+        self._order = []
+        self._queue = {}
+        # Send times within the last minute, for `rate`
+        self._sent_times = []
+        # Number of messages sent, replaced by a newer value, and dropped
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def __len__(self):
+        """Number of messages waiting to be sent."""
+        return len(self._order)
+
+    @property
+    def rate(self):
+        """Messages sent during the last minute."""
+        self._forget(time.monotonic())
+        return len(self._sent_times)
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        """Queues a message, replacing any message waiting for the same topic,
+        and sends it at once if the rate allows. Accepts the same arguments
+        as `adafruit_minimqtt.MQTT.publish`.
+
+        """
+        if topic in self._queue:
+            self.coalesced += 1
+        else:
+            if len(self._order) >= self.max_queue:
+                del self._queue[self._order.pop(0)]
+                self.dropped += 1
+            self._order.append(topic)
+        self._queue[topic] = (msg, retain, qos)
+        self.flush()
+
+    def flush(self):
+        """Sends waiting messages while the rate and the in-flight window
+        allow. It never waits, `adafruit_minimqtt.MQTT.loop` calls it for the
+        client's ``rate_limiter``. Returns the number of messages sent.
+        If publishing fails, the messages stay in the queue.
+        """
+        now = time.monotonic()
+        self._refill(now)
+        messages = []
+        for topic in self._order[: int(self._tokens)]:
+            msg, retain, qos = self._queue[topic]
+            messages.append((topic, msg, qos, retain))
+        count = 0
+        if messages:
+            count = self._client.publish_many(messages, wait=False)
+        for topic in self._order[:count]:
+            del self._queue[topic]
+        del self._order[:count]
+        self._tokens -= count
+        self._sent_times.extend([now] * count)
+        self.sent += count
+        self._forget(now)
+        return count
+
+    def next_send(self):
+        """Returns the number of seconds until the next message can be sent,
+        zero if one can be sent now, or None when none is waiting."""
+        if not self._order:
+            return None
+        self._refill(time.monotonic())
+        return max(0, (1 - self._tokens) * 60 / self.per_minute)
+
+    def clear(self):
+        """Drops every waiting message."""
+        self.dropped += len(self._order)
+        self._order = []
+        self._queue = {}
+
+    def _refill(self, now):
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._refilled) * self.per_minute / 60
+        )
+        self._refilled = now
+
+    def _forget(self, now):
+        """Drops send times older than a minute."""
+        while self._sent_times and now - self._sent_times[0] > 60:
+            self._sent_times.pop(0)
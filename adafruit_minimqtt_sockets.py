@@ -0,0 +1,269 @@
+# SPDX-FileCopyrightText: 2021 ErogigGit
+#
+# SPDX-License-Identifier: MIT
+
+"""
+`adafruit_minimqtt_sockets`
+================================================================================
+
+Shares the few sockets of an ESP32SPI co-processor between MiniMQTT, HTTP
+requests and anything else which talks to the network.
+
+Implementation Notes
+--------------------
+
+The ESP32 co-processor of boards such as the PyPortal can only have a small
+number of sockets open at once. When MQTT, `adafruit_io.IO_HTTP` and other
+HTTP requests each open sockets of their own, the radio runs out and socket
+creation fails with ``RuntimeError`` until one is closed.
+
+`SocketBudget` hands out the sockets instead. Every user gets a
+`BudgetPool`, which stands in for the socket module as the ``socket_pool``
+of `adafruit_minimqtt.MQTT` or an ``adafruit_requests.Session``. A pool may
+reserve sockets which no other pool can take, so an HTTP fetch can never
+use the socket MQTT needs to reconnect. When no socket is left, the budget
+asks the pools to close idle sockets, such as connections an HTTP session
+keeps open for reuse. If that fails, the request waits up to ``wait``
+seconds for a socket to be closed, then fails with ``OSError(ENOMEM)``, as
+a failed ESP32SPI connection does. Where there are threads, another thread
+may close a socket while a request waits. Without threads, as on
+CircuitPython, nothing else runs while a request waits, so the budget calls
+its ``idle`` function instead, such as the ``loop()`` of an MQTT client
+whose callbacks close sockets, and asks the pools again. Without an
+``idle`` function, requests are refused at once there.
+
+.. code-block:: python
+
+    budget = SocketBudget(socket, esp, max_sockets=4)
+    MQTT.set_socket(budget.pool("mqtt", reserved=1), esp)
+    io_http = IO_HTTP(aio_username, aio_key, adafruit_requests,
+                      socket_budget=budget)
+    print(budget.occupancy())
+
+**Software and Dependencies:**
+
+* Adafruit ESP32SPI, or any socket module
+
+"""
+import errno
+import time
+from adafruit_minimqtt import _FakeSSLContext
+
+try:
+    import threading
+except ImportError:
+    threading = None
+
+# Time between idle calls while a request waits without threads, in seconds
+_IDLE_INTERVAL = 0.05
+
+
+class SocketBudget:
+    """Limits the number of sockets open at once, shared between pools.
+
+    :param socket_module: Socket module to create sockets with, such as
+        ``adafruit_esp32spi.adafruit_esp32spi_socket``.
+    :param iface: Optional ESP32SPI interface, set as the interface of the
+        socket module and used by `ssl_context`.
+    :param int max_sockets: Most sockets open at once, across all pools.
+        Keep it below the number the co-processor supports when other code
+        opens sockets without the budget.
+    :param float wait: Longest time to wait for a socket to be closed, in
+        seconds. Zero refuses at once.
+    :param idle: Function called while a request waits without threads, as
+        on CircuitPython, before the pools are asked to close idle sockets
+        again. Without threads and without it, requests are refused at once.
+
+    """
+
+    # pylint: disable=too-many-instance-attributes, too-many-arguments
+    def __init__(self, socket_module, iface=None, max_sockets=4, wait=5, idle=None):
+        self._socket_module = socket_module
+        self._iface = iface
+        if iface is not None:
+            socket_module.set_interface(iface)
+        self.max_sockets = max_sockets
+        self.wait = wait
+        self.idle = idle
+        self._pools = []
+        self._released = threading.Condition() if threading else None
+        # Sockets open at once at most, requests which had to wait or
+        # reclaim idle sockets, and requests which got no socket
+        self.high_water = 0
+        self.waits = 0
+        self.reclaims = 0
+        self.refused = 0
+
+    @property
+    def in_use(self):
+        """Number of sockets open, in all pools."""
+        return sum(pool.in_use for pool in self._pools)
+
+    @property
+    def ssl_context(self):
+        """SSL context for the ESP32SPI interface, which wraps the sockets of
+        any pool. Only available when an interface was given."""
+        if self._iface is None:
+            return None
+        return _FakeSSLContext(self._iface)
+
+    def pool(self, name, reserved=0):
+        """Returns a new pool, to use as a socket module.
+        :param str name: Name of the pool in `occupancy()`.
+        :param int reserved: Sockets kept free for this pool, which other
+            pools can not use.
+
+        """
+        pool = BudgetPool(self, name, reserved)
+        self._pools.append(pool)
+        return pool
+
+    def occupancy(self):
+        """Returns the number of open sockets of each pool, by name."""
+        counts = {}
+        for pool in self._pools:
+            counts[pool.name] = counts.get(pool.name, 0) + pool.in_use
+        return counts
+
+    def as_dict(self):
+        """Returns the occupancy and counters as a dict."""
+        return {
+            "max_sockets": self.max_sockets,
+            "in_use": self.in_use,
+            "pools": self.occupancy(),
+            "high_water": self.high_water,
+            "waits": self.waits,
+            "reclaims": self.reclaims,
+            "refused": self.refused,
+        }
+
+    def _has_room(self, pool):
+        """Returns True when pool may open a socket now."""
+        # reservations of other pools which they are not using
+        reserved = 0
+        for other in self._pools:
+            if other is not pool:
+                reserved += max(0, other.reserved - other.in_use)
+        return self.in_use + reserved < self.max_sockets
+
+    def _reclaim(self):
+        """Asks the pools to close their idle sockets, other pools first.
+        Returns True when any socket was closed."""
+        in_use = self.in_use
+        for pool in self._pools:
+            if pool.reclaim is not None and pool.in_use:
+                pool.reclaim()
+                if self.in_use < in_use:
+                    self.reclaims += 1
+                    return True
+        return False
+
+    def _acquire(self, pool):
+        """Takes a socket from the budget for pool, reclaiming idle sockets
+        or waiting when there is none."""
+        if self._released is None:
+            self._take(pool)
+            return
+        with self._released:
+            self._take(pool)
+
+    def _take(self, pool):
+        deadline = time.monotonic() + self.wait
+        while not self._has_room(pool):
+            if self._reclaim():
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or (self._released is None and self.idle is None):
+                self.refused += 1
+                raise OSError(errno.ENOMEM)
+            self.waits += 1
+            if self._released is not None:
+                self._released.wait(remaining)
+            else:
+                self.idle()
+                time.sleep(min(remaining, _IDLE_INTERVAL))
+        pool.in_use += 1
+        self.high_water = max(self.high_water, self.in_use)
+
+    def _release(self, pool):
+        if self._released is None:
+            pool.in_use -= 1
+            return
+        with self._released:
+            pool.in_use -= 1
+            self._released.notify_all()
+
+
+class BudgetPool:
+    """Socket module stand-in which opens its sockets through a
+    `SocketBudget`. Everything but `socket()` is passed on to the socket
+    module, so it can be used as the ``socket_pool`` of a client, or with
+    `adafruit_minimqtt.set_socket`.
+
+    """
+
+    def __init__(self, budget, name, reserved=0):
+        self._budget = budget
+        self.name = name
+        self.reserved = reserved
+        self.in_use = 0
+        # Open sockets of the pool, for close_all()
+        self._sockets = []
+        # Function which closes the idle sockets of the pool's user
+        self.reclaim = None
+
+    def __getattr__(self, name):
+        # pylint: disable=protected-access
+        return getattr(self._budget._socket_module, name)
+
+    def socket(self, *args, **kwargs):
+        """Opens a socket once the budget allows it. Accepts the same
+        arguments as the ``socket`` function of the socket module."""
+        # pylint: disable=protected-access
+        self._budget._acquire(self)
+        sock = None
+        try:
+            sock = self._budget._socket_module.socket(*args, **kwargs)
+        except RuntimeError as error:
+            # the co-processor ran out of sockets itself
+            self._budget.refused += 1
+            raise OSError(errno.ENOMEM) from error
+        finally:
+            if sock is None:
+                self._budget._release(self)
+        sock = _BudgetSocket(sock, self)
+        self._sockets.append(sock)
+        return sock
+
+    def close_all(self):
+        """Closes every open socket of the pool. For a ``reclaim`` function
+        whose user keeps sockets open only while it is idle, such as an HTTP
+        session between requests. Returns the number of sockets closed."""
+        sockets = self._sockets
+        self._sockets = []
+        for sock in sockets:
+            sock.close()
+        return len(sockets)
+
+
+class _BudgetSocket:
+    """Socket which returns its place in the budget when it is closed."""
+
+    def __init__(self, sock, pool):
+        self._socket = sock
+        self._pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self._socket, name)
+
+    def close(self):
+        """Closes the socket and releases it from the budget."""
+        try:
+            self._socket.close()
+        finally:
+            if self._pool is not None:
+                # pylint: disable=protected-access
+                if self in self._pool._sockets:
+                    self._pool._sockets.remove(self)
+                self._pool._budget._release(self._pool)
+                self._pool = None
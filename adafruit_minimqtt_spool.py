@@ -0,0 +1,165 @@
+# SPDX-FileCopyrightText: 2021 ErogigGit
+#
+# SPDX-License-Identifier: MIT
+
+"""
+`adafruit_minimqtt_spool`
+================================================================================
+
+Disk-backed spool for MQTT messages published while offline.
+
+Implementation Notes
+--------------------
+
+Spooled messages are stored as complete MQTT PUBLISH packets, which are
+already framed by their fixed header and remaining length. The spool is split
+into numbered segment files next to ``path``, so the oldest messages can be
+dropped by deleting a whole segment once the spool reaches its size cap.
+Segments survive a reset and are sent on the next connection.
+
+Sending stops when the client can not take more packets, such as when its
+in-flight window is full, and resumes from the same packet on the next
+drain: the spool keeps the offset of the bytes sent from each segment. The
+offsets are kept in memory, so after a reset a partly sent segment is sent
+again from its start.
+
+The filesystem must be writable from CircuitPython, for example an SD card
+mounted with `storage.mount`, or flash remounted with `storage.remount`.
+
+"""
+import os
+
+
+class MQTTSpool:
+    """Spool of unsent PUBLISH packets on flash or SD.
+
+    :param str path: Path prefix of the segment files, such as ``/sd/mqtt``.
+    :param int max_bytes: Maximum size of the spool. When it is exceeded, the
+        oldest segment is deleted.
+    :param int segments: Number of segments the spool is split into.
+    :param int buffer_size: Size of the buffer used to send spooled packets,
+        which is the size of each batched socket write.
+
+    """
+
+    def __init__(self, path, max_bytes=65536, segments=4, buffer_size=1024):
+        self._path = path
+        self._segment_size = max(1, max_bytes // segments)
+        self.max_bytes = max_bytes
+        self._buf = bytearray(buffer_size)
+        self.dropped_bytes = 0
+        # segment number -> size in bytes, for segments on disk
+        self._segments = {}
+        # segment number -> bytes already sent, for partly sent segments
+        self._sent = {}
+        directory, sep, prefix = path.rpartition("/")
+        prefix += "."
+        for name in os.listdir(directory or sep or "."):
+            if name.startswith(prefix) and name[len(prefix) :].isdigit():
+                number = int(name[len(prefix) :])
+                self._segments[number] = os.stat(self._segment_path(number))[6]
+
+    def __len__(self):
+        """Number of bytes in the spool which are still to be sent."""
+        return sum(self._segments.values()) - sum(self._sent.values())
+
+    def _segment_path(self, number):
+        return "{0}.{1}".format(self._path, number)
+
+    def append(self, *parts):
+        """Appends one packet to the spool.
+        :param parts: Buffers which together make up the packet.
+
+        """
+        size = sum(len(part) for part in parts)
+        number = max(self._segments) if self._segments else 0
+        if number not in self._segments or (
+            self._segments[number] + size > self._segment_size
+            and self._segments[number]
+        ):
+            number += 1
+            self._segments[number] = 0
+        with open(self._segment_path(number), "ab") as segment:
+            for part in parts:
+                segment.write(part)
+        self._segments[number] += size
+        while len(self) > self.max_bytes and len(self._segments) > 1:
+            oldest = min(self._segments)
+            self.dropped_bytes += self._segments.pop(oldest)
+            self.dropped_bytes -= self._sent.pop(oldest, 0)
+            os.remove(self._segment_path(oldest))
+
+    def drain(self, send):
+        """Passes spooled packets to send, oldest first, and removes each
+        segment once it has been sent.
+        :param send: Called with a memoryview holding one or more complete
+            packets, at most ``buffer_size`` bytes unless a single packet is
+            larger than that. Returns the number of bytes it sent, which
+            ends with a complete packet, or None when it sent them all.
+            Draining stops when it sends less than it was given, or raises.
+
+        """
+        while self._segments:
+            number = min(self._segments)
+            with open(self._segment_path(number), "rb") as segment:
+                segment.seek(self._sent.get(number, 0))
+                if not self._drain_segment(number, segment, send):
+                    return
+            del self._segments[number]
+            self._sent.pop(number, None)
+            os.remove(self._segment_path(number))
+
+    def _drain_segment(self, number, segment, send):
+        """Sends the rest of a segment. Returns False when send stopped
+        before the end of the segment."""
+        buf = self._buf
+        view = memoryview(buf)
+        end = 0
+        while True:
+            size = segment.readinto(view[end:])
+            if not size and end < len(buf):
+                return True
+            end += size
+            frames_end = _complete_frames(buf, end)
+            if frames_end == 0:
+                if end == len(buf):
+                    # the next packet does not fit the buffer
+                    buf = bytearray(max(_frame_size(buf, 0, end), 2 * len(buf)))
+                    buf[:end] = view[:end]
+                    view = memoryview(buf)
+                continue
+            sent = send(view[:frames_end])
+            if sent is None:
+                sent = frames_end
+            self._sent[number] = self._sent.get(number, 0) + sent
+            if sent < frames_end:
+                return False
+            view[: end - frames_end] = view[frames_end:end]
+            end -= frames_end
+
+
+def _frame_size(buf, offset, end):
+    """Returns the size of the packet starting at offset, or 0 when its
+    remaining length is not complete yet."""
+    length = 0
+    shift = 0
+    pos = offset + 1
+    while pos < end:
+        byte = buf[pos]
+        pos += 1
+        length |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return pos - offset + length
+        shift += 7
+    return 0
+
+
+def _complete_frames(buf, end):
+    """Returns the offset just past the last complete packet in buf[:end]."""
+    offset = 0
+    while offset < end:
+        size = _frame_size(buf, offset, end)
+        if size == 0 or offset + size > end:
+            break
+        offset += size
+    return offset
@@ -0,0 +1,196 @@
+# SPDX-FileCopyrightText: 2021 ErogigGit
+#
+# SPDX-License-Identifier: MIT
+
+"""
+`adafruit_minimqtt_supervisor`
+================================================================================
+
+Keeps a MiniMQTT client connected to its broker.
+
+Implementation Notes
+--------------------
+
+`MQTTSupervisor` runs the message loop of the client and, when the connection
+fails, steps through a reconnect state machine. It never sleeps, so the main
+loop of the program keeps running while the client is offline.
+
+* ``STATE_CONNECTED``: messages are processed with `adafruit_minimqtt.MQTT.loop`.
+* ``STATE_BACKOFF``: waiting for the next attempt. The delay doubles after
+  every failed attempt up to ``max_delay``, and is randomised so that devices
+  which lost the broker together do not all reconnect at the same moment.
+* ``STATE_RESET_NETWORK``: the network is reset with the ``reset_network``
+  callback, once every ``reset_network_after`` failed attempts.
+* ``STATE_RECONNECT``: the client connects and resubscribes with
+  `adafruit_minimqtt.MQTT.reconnect`.
+* ``STATE_OPEN``: after ``failure_threshold`` failed attempts in a row the
+  circuit breaker opens, and no attempt is made for ``open_time`` seconds.
+  A single attempt is then made, which closes the breaker if it succeeds.
+
+"""
+import time
+from random import uniform
+from micropython import const
+from adafruit_minimqtt import MMQTTException
+
+STATE_CONNECTED = const(0)
+STATE_BACKOFF = const(1)
+STATE_RESET_NETWORK = const(2)
+STATE_RECONNECT = const(3)
+STATE_OPEN = const(4)
+
+# Errors raised by the client, the socket or ESP32SPI (RuntimeError) when the
+# connection is lost. Other errors, such as a ValueError from a callback or a
+# payload codec, are raised to the caller: reconnecting would only have the
+# broker deliver the same message again.
+_CONNECTION_ERRORS = (MMQTTException, OSError, RuntimeError)
+
+
+class MQTTSupervisor:
+    """Reconnects a MiniMQTT client with exponential backoff.
+
+    .. code-block:: python
+
+        def reset_wifi():
+            esp.reset()
+            wifi.connect()
+
+        mqtt_supervisor = MQTTSupervisor(mqtt_client, reset_network=reset_wifi)
+        while True:
+            mqtt_supervisor.loop(timeout=0)
+            # update the display, read sensors...
+
+    The client does not need to be connected first, the supervisor connects it
+    when the first call to `loop()` finds it disconnected.
+
+    :param MQTT client: MiniMQTT client to keep connected.
+    :param reset_network: Optional function which resets and reconnects the
+        network interface, such as the WiFi co-processor.
+    :param int reset_network_after: Number of failed attempts after which the
+        network is reset before the next attempt.
+    :param float min_delay: Delay after the first failed attempt, in seconds.
+    :param float max_delay: Longest delay between attempts, in seconds.
+    :param int failure_threshold: Number of failed attempts in a row which open
+        the circuit breaker.
+    :param float open_time: Time the circuit breaker stays open, in seconds.
+
+    """
+
+    # pylint: disable=too-many-arguments, too-many-instance-attributes
+    def __init__(
+        self,
+        client,
+        reset_network=None,
+        reset_network_after=2,
+        min_delay=1,
+        max_delay=60,
+        failure_threshold=8,
+        open_time=300,
+    ):
+        self._client = client
+        self.reset_network = reset_network
+        self.reset_network_after = reset_network_after
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.open_time = open_time
+        self.state = STATE_CONNECTED
+        # Number of failed attempts since the connection was lost
+        self.failures = 0
+        # Number of successful reconnects
+        self.reconnects = 0
+        # Time from losing the connection to reconnecting, in seconds
+        self.last_reconnect_time = None
+        self._lost_at = time.monotonic()
+        self._next_attempt = self._lost_at
+
+    @property
+    def connected(self):
+        """True when the client is connected to the broker."""
+        return self.state == STATE_CONNECTED
+
+    def loop(self, timeout=1, max_messages=None, budget_ms=None):
+        """Processes messages while connected, otherwise makes the next
+        reconnect attempt once it is due. Returns the response codes from
+        `adafruit_minimqtt.MQTT.loop`, or None while disconnected.
+        Accepts the same arguments as `adafruit_minimqtt.MQTT.loop`.
+
+        """
+        if self.state == STATE_CONNECTED:
+            rcs = self._process(timeout, max_messages, budget_ms)
+            if self.state == STATE_CONNECTED:
+                return rcs
+        if time.monotonic() >= self._next_attempt:
+            self._attempt()
+        return None
+
+    def _process(self, timeout, max_messages, budget_ms):
+        """Runs the loop of the connected client, and moves to
+        ``STATE_BACKOFF`` when the connection is lost."""
+        try:
+            self._client.is_connected()
+            return self._client.loop(timeout, max_messages, budget_ms)
+        except _CONNECTION_ERRORS as error:
+            self._connection_lost(error)
+        return None
+
+    def _connection_lost(self, error):
+        if self._client.logger:
+            self._client.logger.warning("Connection lost: {}".format(error))
+        self.failures = 0
+        self._lost_at = time.monotonic()
+        # the first attempt is made at once
+        self._next_attempt = self._lost_at
+        self.state = STATE_BACKOFF
+
+    def _attempt(self):
+        """Resets the network when it is due, then reconnects the client."""
+        try:
+            self._begin_attempt()
+            self._client.reconnect()
+        except _CONNECTION_ERRORS as error:
+            self._attempt_failed(error)
+            return
+        self._attempt_succeeded()
+
+    def _begin_attempt(self):
+        """Resets the network when it is due, and moves to
+        ``STATE_RECONNECT``."""
+        if (
+            self.reset_network is not None
+            and self.failures
+            and self.failures % self.reset_network_after == 0
+        ):
+            self.state = STATE_RESET_NETWORK
+            self.reset_network()
+        self.state = STATE_RECONNECT
+
+    def _attempt_succeeded(self):
+        self.last_reconnect_time = time.monotonic() - self._lost_at
+        self.failures = 0
+        self.reconnects += 1
+        self.state = STATE_CONNECTED
+        if self._client.logger:
+            self._client.logger.info(
+                "Reconnected in {:.2f} seconds".format(self.last_reconnect_time)
+            )
+
+    def _attempt_failed(self, error):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            delay = self.open_time
+            next_state = STATE_OPEN
+        else:
+            delay = min(self.max_delay, self.min_delay * 2 ** (self.failures - 1))
+            # keep at least half of the delay, randomise the rest
+            delay = uniform(delay / 2, delay)
+            next_state = STATE_BACKOFF
+        if self._client.logger:
+            self._client.logger.warning(
+                "Reconnect attempt {} failed in state {}: {}, "
+                "retrying in {:.1f} seconds".format(
+                    self.failures, self.state, error, delay
+                )
+            )
+        self.state = next_state
+        self._next_attempt = time.monotonic() + delay
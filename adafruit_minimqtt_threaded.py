@@ -0,0 +1,269 @@
+# SPDX-FileCopyrightText: 2021 ErogigGit
+#
+# SPDX-License-Identifier: MIT
+
+"""
+`adafruit_minimqtt_threaded`
+================================================================================
+
+A MiniMQTT client which runs its network loop in a background thread.
+
+Implementation Notes
+--------------------
+
+`ThreadedMQTT` is `adafruit_minimqtt.MQTT` with `loop_start()` and
+`loop_stop()`. While the network thread runs, it is the only thread which
+reads from the socket: it processes every packet the broker sends and keeps
+the client connected with an `adafruit_minimqtt_supervisor.MQTTSupervisor`.
+Other threads may publish, subscribe and unsubscribe at any time. Writes to
+the socket hold a lock, so packets sent from different threads are never
+interleaved, and calls which wait for an acknowledgement are woken by the
+network thread once it arrives.
+
+**Software and Dependencies:**
+
+* CPython 3.7+, or any port with the threading module
+
+"""
+import threading
+import time
+from adafruit_minimqtt import MQTT, MMQTTException
+from adafruit_minimqtt_supervisor import MQTTSupervisor
+
+# Packet types waited on by other threads
+_SUBACK = 0x90
+_UNSUBACK = 0xB0
+
+
+class ThreadedMQTT(MQTT):
+    """MQTT Client with a background network thread. Accepts the same
+    arguments as `adafruit_minimqtt.MQTT`.
+
+    .. code-block:: python
+
+        client = ThreadedMQTT(broker, socket_pool=socket, executor=executor)
+        client.connect()
+        client.loop_start()
+        client.subscribe("sensors/#")
+        # publish from any thread...
+        client.loop_stop()
+        client.disconnect()
+
+    Message callbacks run on the network thread, or on the executor when
+    one is given, so that slow callbacks do not hold up the network. Payloads
+    passed to callbacks on an executor are copied to bytes first. Stream
+    callbacks added with `add_topic_stream()` and the other callbacks, such
+    as `on_publish`, always run on the network thread.
+
+    :param executor: Optional `concurrent.futures.Executor`, or any object
+        with a ``submit(function, *args)`` method, to run message callbacks on.
+
+    """
+
+    def __init__(self, broker, *, executor=None, **kwargs):
+        super().__init__(broker, **kwargs)
+        self.executor = executor
+        self._write_lock = threading.RLock()
+        self._thread = None
+        self._running = False
+        # Notified by the network thread after every packet it processes
+        self._received = threading.Condition()
+        # Acknowledgements awaited by other threads, keyed by
+        # (packet type, packet identifier), None until they arrive
+        self._acks = {}
+
+    def loop_start(self, timeout=0.1, supervisor=None):
+        """Starts the network thread. The client must be connected.
+        :param float timeout: Time the network thread waits for a packet
+            before it checks whether it was stopped, in seconds.
+        :param MQTTSupervisor supervisor: Supervisor which reconnects the
+            client when the connection is lost. Defaults to a new
+            `adafruit_minimqtt_supervisor.MQTTSupervisor` for the client.
+
+        """
+        if self._thread is not None:
+            raise MMQTTException("The network thread is already running.")
+        self.is_connected()
+        if supervisor is None:
+            supervisor = MQTTSupervisor(self)
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, args=(supervisor, timeout), daemon=True
+        )
+        self._thread.start()
+
+    def loop_stop(self):
+        """Stops the network thread, and waits for it to finish unless it is
+        called from the network thread."""
+        thread = self._thread
+        if thread is None:
+            return
+        self._running = False
+        if thread is not threading.current_thread():
+            thread.join()
+            self._thread = None
+        with self._received:
+            self._received.notify_all()
+
+    def _run(self, supervisor, timeout):
+        """Network thread: processes packets and reconnects until stopped."""
+        try:
+            while self._running:
+                supervisor.loop(timeout, max_messages=20)
+                if not supervisor.connected:
+                    # the supervisor does not wait between attempts
+                    time.sleep(timeout)
+        finally:
+            # loop_stop() only clears the thread when it waits for it
+            if self._thread is threading.current_thread():
+                self._thread = None
+
+    def _in_background(self):
+        """Returns True when called while the network thread reads from the
+        socket, from any other thread."""
+        thread = self._thread
+        return thread is not None and thread is not threading.current_thread()
+
+    def loop(self, timeout=1, max_messages=None, budget_ms=None):
+        if self._in_background():
+            raise MMQTTException("The network loop runs in a background thread.")
+        return super().loop(timeout, max_messages, budget_ms)
+
+    def reconnect(self, resub_topics=True):
+        if self._thread is not None and not self._running:
+            # disconnect() was called from a callback on the network thread
+            raise MMQTTException("The network thread was stopped.")
+        super().reconnect(resub_topics)
+
+    def disconnect(self):
+        """Stops the network thread and disconnects from the MQTT broker."""
+        self.loop_stop()
+        with self._write_lock:
+            super().disconnect()
+
+    def _wait_for_msg(self, timeout=0.1):
+        if not self._in_background():
+            return super()._wait_for_msg(timeout)
+        # the network thread reads the packet, wait until it was processed
+        with self._received:
+            self._received.wait(timeout)
+        return None
+
+    def _handle_packet(self, header, body):
+        result = super()._handle_packet(header, body)
+        packet_type = header & 0xF0
+        with self._received:
+            if packet_type in (_SUBACK, _UNSUBACK):
+                key = (packet_type, body[0] << 8 | body[1])
+                if key in self._acks:
+                    # the decoder reuses its buffer, keep a copy of the body
+                    self._acks[key] = bytes(body)
+            self._received.notify_all()
+        return result
+
+    def _wait_ack(self, packet_type, pid):
+        """Waits for an acknowledgement registered in ``_acks`` and
+        returns its variable header."""
+        key = (packet_type, pid)
+        deadline = time.monotonic() + self.keep_alive
+        with self._received:
+            try:
+                while self._acks[key] is None:
+                    if not self._in_background():
+                        raise MMQTTException("The network thread was stopped.")
+                    remaining = deadline - time.monotonic()
+                    if self.keep_alive and remaining <= 0:
+                        raise MMQTTException(
+                            "No response from broker within {} seconds.".format(
+                                self.keep_alive
+                            )
+                        )
+                    self._received.wait(remaining if self.keep_alive else None)
+                return self._acks[key]
+            finally:
+                del self._acks[key]
+
+    def subscribe(self, topic, qos=0):
+        if not self._in_background():
+            super().subscribe(topic, qos)
+            return
+        self.is_connected()
+        topics = self._sub_topics(topic, qos)
+        # hold the lock until the SUBACKs are expected, so that the network
+        # thread can not process them first
+        with self._received:
+            packets = self._send_subscribe(topics)
+            for pid, _ in packets:
+                self._acks[(_SUBACK, pid)] = None
+        for pid, batch in packets:
+            self._handle_suback(batch, pid, self._wait_ack(_SUBACK, pid))
+
+    def unsubscribe(self, topic):
+        if not self._in_background():
+            super().unsubscribe(topic)
+            return
+        topics = self._unsub_topics(topic)
+        with self._received:
+            packets = self._send_unsubscribe(topics)
+            for pid, _ in packets:
+                self._acks[(_UNSUBACK, pid)] = None
+        for pid, batch in packets:
+            self._handle_unsuback(batch, pid, self._wait_ack(_UNSUBACK, pid))
+
+    def _handle_on_message(self, client, topic, payload):
+        if self.executor is None:
+            super()._handle_on_message(client, topic, payload)
+            return
+        # payload points into the receive buffer, which the network thread
+        # reuses before the executor runs the callbacks
+        self.executor.submit(super()._handle_on_message, client, topic, bytes(payload))
+
+    # Everything which allocates packet identifiers or writes to the socket
+    # holds the write lock.
+
+    def _connect(self, topics=None):
+        # other threads see the client disconnected from before the socket
+        # is replaced until the CONNACK, so nothing is written before CONNECT
+        with self._write_lock:
+            self._is_connected = False
+        return super()._connect(topics)
+
+    def _send_connect(self, clean_session):
+        with self._write_lock:
+            super()._send_connect(clean_session)
+
+    def _send_publish_msg(self, topic, msg, retain, qos):
+        with self._write_lock:
+            return super()._send_publish_msg(topic, msg, retain, qos)
+
+    def _send_publish_batch(self, entries):
+        with self._write_lock:
+            # the network thread may have reconnected since the check
+            self.is_connected()
+            return super()._send_publish_batch(entries)
+
+    def _publish_entries(self, messages):
+        # payload codecs encode into a buffer shared by all threads
+        with self._write_lock:
+            return super()._publish_entries(messages)
+
+    # pylint: disable=too-many-arguments
+    def _send_publish(self, topic_bytes, msg, retain, qos, pid, dup=False):
+        with self._write_lock:
+            super()._send_publish(topic_bytes, msg, retain, qos, pid, dup)
+
+    def _resend_inflight(self):
+        with self._write_lock:
+            super()._resend_inflight()
+
+    def _send_spooled(self, packets):
+        with self._write_lock:
+            return super()._send_spooled(packets)
+
+    def _send_topic_packets(self, packet_type, entries):
+        with self._write_lock:
+            return super()._send_topic_packets(packet_type, entries)
+
+    def _sock_sendall(self, buf):
+        with self._write_lock:
+            super()._sock_sendall(buf)
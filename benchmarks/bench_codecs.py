@@ -0,0 +1,99 @@
+# SPDX-FileCopyrightText: 2021 ErogigGit
+#
+# SPDX-License-Identifier: MIT
+
+"""
+`bench_codecs`
+================================================================================
+
+Microbenchmark for the payload codecs of `adafruit_minimqtt_codecs`.
+
+Encodes and decodes multi-value sensor frames with each codec, and with the
+comma separated decimal strings published without a codec, and reports the
+payload size and round trips/sec of each. Without ``float_precision``, CBOR
+sends decimal readings as 8-byte doubles, larger than their text. Run on
+CPython (Adafruit-Blinka provides the ``micropython`` module):
+
+.. code-block:: shell
+
+    python benchmarks/bench_codecs.py
+
+"""
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from adafruit_minimqtt_codecs import (
+    FLOAT_HALF,
+    FLOAT_SINGLE,
+    CBORCodec,
+    DeltaCodec,
+    StructCodec,
+)
+
+FRAMES = 2000
+VALUES = 8
+
+
+class _TextCodec:
+    """Payloads as sent without a codec, parsed back into floats."""
+
+    @staticmethod
+    def encode(value):
+        return ",".join(str(number) for number in value).encode("ascii")
+
+    @staticmethod
+    def decode(payload):
+        return [float(number) for number in str(payload, "utf-8").split(",")]
+
+
+def _frames():
+    """Returns frames of slowly changing readings, to two decimal places."""
+    return [
+        [round(20 + 5 * math.sin((frame + i) / 50) + i, 2) for i in range(VALUES)]
+        for frame in range(FRAMES)
+    ]
+
+
+def _round_trips(codec, frames):
+    """Encodes and decodes every frame, returning the average payload size."""
+    size = 0
+    for frame in frames:
+        payload = codec.encode(frame)
+        size += len(payload)
+        codec.decode(bytes(payload))
+    return size / len(frames)
+
+
+def main():
+    """Runs the benchmark and prints the results."""
+    frames = _frames()
+    codecs = (
+        ("text", _TextCodec()),
+        ("struct", StructCodec("<{}f".format(VALUES))),
+        ("cbor", CBORCodec()),
+        ("cbor-single", CBORCodec(float_precision=FLOAT_SINGLE)),
+        ("cbor-half", CBORCodec(float_precision=FLOAT_HALF)),
+        ("delta", DeltaCodec(scale=100)),
+    )
+    text_size = None
+    for name, codec in codecs:
+        _round_trips(codec, frames)  # warm up
+        start = time.monotonic()
+        size = _round_trips(codec, frames)
+        elapsed = time.monotonic() - start
+        if text_size is None:
+            text_size = size
+        print(
+            "{:11} {:5.1f} B/frame ({:.1f}x smaller), {:.0f} round trips/s".format(
+                name, size, text_size / size, FRAMES / elapsed
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# SPDX-FileCopyrightText: 2021 ErogigGit
+#
+# SPDX-License-Identifier: MIT
+
+"""
+`bench_decoder`
+================================================================================
+
+Microbenchmark for `adafruit_minimqtt.MQTTDecoder`.
+
+Decodes a stream of small PUBLISH and PUBACK packets delivered in reads of
+`READ_SIZE` bytes, and reports packets/sec and heap bytes allocated per packet.
+Run on CPython (Adafruit-Blinka provides the ``micropython`` module):
+
+.. code-block:: shell
+
+    python benchmarks/bench_decoder.py
+
+"""
+import os
+import struct
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from adafruit_minimqtt import MQTTDecoder
+
+PACKETS = 20000
+READ_SIZE = 512
+
+
+def _packets():
+    """Returns a stream of alternating PUBLISH and PUBACK packets."""
+    stream = bytearray()
+    for i in range(PACKETS // 2):
+        topic = b"adafruit/f/temperature"
+        payload = str(20 + i % 10).encode()
+        stream += bytes((0x30, 2 + len(topic) + len(payload)))
+        stream += struct.pack("!H", len(topic)) + topic + payload
+        stream += struct.pack("!BBH", 0x40, 0x02, i & 0xFFFF)
+    return memoryview(bytes(stream))
+
+
+def _decode(decoder, stream, measure=False):
+    """Feeds stream to the decoder in READ_SIZE reads and decodes every packet.
+    With measure set, returns the heap bytes allocated by the decoder."""
+    allocated = 0
+    for offset in range(0, len(stream), READ_SIZE):
+        if measure:
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+        view = decoder.free()
+        size = min(len(view), len(stream) - offset)
+        view[:size] = stream[offset : offset + size]
+        decoder.commit(size)
+        header = decoder.next_packet()
+        while header is not None:
+            header = decoder.next_packet()
+        if measure:
+            allocated += tracemalloc.get_traced_memory()[1] - current
+    return allocated
+
+
+def main():
+    """Runs the benchmark and prints the results."""
+    stream = _packets()
+    decoder = MQTTDecoder()
+    _decode(decoder, stream)  # warm up
+
+    start = time.monotonic()
+    _decode(decoder, stream)
+    elapsed = time.monotonic() - start
+
+    tracemalloc.start()
+    allocated = _decode(decoder, stream, measure=True)
+    tracemalloc.stop()
+    print(
+        "{:.0f} packets/s, {:.1f} B allocated per packet "
+        "({} B reads)".format(PACKETS / elapsed, allocated / PACKETS, READ_SIZE)
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+# SPDX-FileCopyrightText: 2021 ErogigGit
+#
+# SPDX-License-Identifier: MIT
+
+"""
+`bench_fleet`
+================================================================================
+
+Simulates a fleet of devices with `adafruit_minimqtt_multiplexer.MQTTMultiplexer`
+and reports how long they take to connect and how many messages the broker
+passes on. Every device publishes telemetry at a fixed interval, and one
+monitor client subscribes to all of it. Runs against
+`loopback_broker.LoopbackBroker` by default, or against another broker:
+
+.. code-block:: shell
+
+    python benchmarks/bench_fleet.py --clients 500 --interval 5 --duration 60
+
+Each device uses a socket, so large fleets may need a higher open file limit
+(``ulimit -n``).
+
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+import adafruit_minimqtt as MQTT
+from adafruit_minimqtt_multiplexer import MQTTMultiplexer
+from loopback_broker import LoopbackBroker
+
+
+def run(host, port, args):
+    """Connects the fleet, publishes for the given duration and returns
+    the results."""
+    received = [0]
+
+    def on_telemetry(client, topic, message):
+        # pylint: disable=unused-argument
+        received[0] += 1
+
+    def client(client_id):
+        return MQTT.MQTT(
+            host,
+            port=port,
+            client_id=client_id,
+            is_ssl=False,
+            socket_pool=socket,
+            keep_alive=args.keep_alive,
+        )
+
+    monitor = client("fleet-monitor")
+    monitor.on_message = on_telemetry
+    monitor.connect()
+    monitor.subscribe("fleet/+/telemetry")
+    multiplexer = MQTTMultiplexer()
+    multiplexer.add(monitor)
+    devices = [client("fleet-{}".format(i)) for i in range(args.clients)]
+    start = time.monotonic()
+    for device in devices:
+        multiplexer.add(device)
+    # the multiplexer connects the devices without blocking its loop
+    deadline = start + multiplexer.connect_timeout
+    while multiplexer.connected < len(devices) + 1 and time.monotonic() < deadline:
+        multiplexer.loop(timeout=0.01)
+    connected = time.monotonic()
+
+    # spread the first messages over one interval
+    next_publish = [
+        connected + args.interval * i / args.clients for i in range(args.clients)
+    ]
+    sent = passes = failed = 0
+    end = connected + args.duration
+    while time.monotonic() < end:
+        multiplexer.loop(timeout=0.01)
+        passes += 1
+        now = time.monotonic()
+        for i, device in enumerate(devices):
+            if next_publish[i] <= now:
+                next_publish[i] += args.interval
+                try:
+                    device.publish("fleet/{}/telemetry".format(i), sent)
+                    sent += 1
+                except (MQTT.MMQTTException, OSError):
+                    # offline until the multiplexer reconnects it
+                    failed += 1
+    settle = time.monotonic() + 1
+    while received[0] < sent and time.monotonic() < settle:
+        multiplexer.loop(timeout=0.05)
+    # not counting the monitor
+    still_connected = multiplexer.connected - 1
+    for device in devices + [monitor]:
+        multiplexer.remove(device)
+        try:
+            device.disconnect()
+        except (MQTT.MMQTTException, OSError):
+            pass
+    return {
+        "clients": args.clients,
+        "connected": still_connected,
+        "connect_s": connected - start,
+        "sent": sent,
+        "failed": failed,
+        "received": received[0],
+        "msgs_per_sec": received[0] / args.duration,
+        "loop_passes_per_sec": passes / args.duration,
+    }
+
+
+def main():
+    """Runs the fleet simulation and prints the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=1, help="in seconds")
+    parser.add_argument("--duration", type=float, default=10, help="in seconds")
+    parser.add_argument("--keep-alive", type=int, default=60, help="in seconds")
+    parser.add_argument("--broker", help="host:port, defaults to a loopback broker")
+    args = parser.parse_args()
+
+    if args.broker:
+        host, _, port = args.broker.partition(":")
+        result = run(host, int(port or 1883), args)
+    else:
+        with LoopbackBroker() as broker:
+            result = run("127.0.0.1", broker.port, args)
+    report = {
+        "version": MQTT.__version__,
+        "python": sys.version.split()[0],
+        "timestamp": time.time(),
+        "results": [dict(name="fleet", **result)],
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+# SPDX-FileCopyrightText: 2021 ErogigGit
+#
+# SPDX-License-Identifier: MIT
+
+"""
+`bench_loopback`
+================================================================================
+
+End-to-end benchmarks of `adafruit_minimqtt.MQTT` and `adafruit_io.IO_MQTT`
+against `loopback_broker.LoopbackBroker`, over CPython sockets.
+
+Reports messages/sec for QoS 0 and QoS 1 publishing, publish-to-callback
+latency percentiles and reconnect time, as a JSON document so that results
+can be stored and compared between releases. Run on CPython
+(Adafruit-Blinka provides the ``micropython`` module):
+
+.. code-block:: shell
+
+    python benchmarks/bench_loopback.py --latency 20 --loss 0.01 -o results.json
+
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+import adafruit_minimqtt as MQTT
+from adafruit_minimqtt_supervisor import MQTTSupervisor
+from adafruit_io.adafruit_io import IO_MQTT
+from loopback_broker import LoopbackBroker
+
+# Time to wait for messages which are still in flight, in seconds
+SETTLE_TIME = 2
+
+
+def _client(broker, protocol_version, **kwargs):
+    client = MQTT.MQTT(
+        "127.0.0.1",
+        port=broker.port,
+        username="bench",
+        password="bench",
+        is_ssl=False,
+        socket_pool=socket,
+        protocol_version=protocol_version,
+        **kwargs
+    )
+    client.connect()
+    return client
+
+
+def _receive(client, received, expected, deadline):
+    """Processes messages until expected have arrived or deadline passes."""
+    while received[0] < expected and time.monotonic() < deadline:
+        client.loop(timeout=0.05, max_messages=100)
+
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def bench_throughput(broker, args, qos, max_inflight=0, batch=0):
+    """Publishes to a topic the client is subscribed to, and measures the
+    publish rate and the rate at which messages arrive back. With a batch
+    size, messages are published that many at a time with `publish_many`."""
+    client = _client(broker, args.protocol, max_inflight=max_inflight)
+    # number of messages received, and when the last one arrived
+    received = [0, 0]
+
+    def on_message(client, topic, message):
+        # pylint: disable=unused-argument
+        received[0] += 1
+        received[1] = time.monotonic()
+
+    client.on_message = on_message
+    client.subscribe("bench/throughput", qos)
+    start = time.monotonic()
+    if batch:
+        for i in range(0, args.messages, batch):
+            count = min(batch, args.messages - i)
+            client.publish_many([("bench/throughput", i, qos)] * count)
+            client.loop(timeout=0)
+    else:
+        for i in range(args.messages):
+            client.publish("bench/throughput", i, qos=qos)
+            if i % 32 == 0:
+                client.loop(timeout=0)
+    published = time.monotonic()
+    while client._inflight:  # pylint: disable=protected-access
+        client.loop(timeout=0.05)
+    _receive(client, received, args.messages, published + SETTLE_TIME + args.latency)
+    client.disconnect()
+    return {
+        "name": "throughput_qos{}{}{}".format(
+            qos,
+            "_window{}".format(max_inflight) if max_inflight else "",
+            "_batch{}".format(batch) if batch else "",
+        ),
+        "messages": args.messages,
+        "publish_msgs_per_sec": args.messages / (published - start),
+        "delivered": received[0],
+        "delivered_msgs_per_sec": received[0] / (received[1] - start),
+    }
+
+
+def bench_latency(broker, args):
+    """Publishes one message at a time and measures the time until its
+    callback runs."""
+    client = _client(broker, args.protocol)
+    samples = []
+    arrived = [None]
+
+    def on_message(client, topic, message):
+        # pylint: disable=unused-argument
+        arrived[0] = time.monotonic()
+
+    client.on_message = on_message
+    client.subscribe("bench/latency")
+    lost = 0
+    for i in range(args.samples):
+        arrived[0] = None
+        sent = time.monotonic()
+        client.publish("bench/latency", i)
+        deadline = sent + 1 + 2 * args.latency
+        while arrived[0] is None and time.monotonic() < deadline:
+            client.loop(timeout=0.05)
+        if arrived[0] is None:
+            lost += 1
+        else:
+            samples.append((arrived[0] - sent) * 1000)
+    client.disconnect()
+    samples.sort()
+    result = {"name": "latency", "samples": len(samples), "lost": lost}
+    if samples:
+        result.update(
+            {
+                "p50_ms": _percentile(samples, 0.5),
+                "p90_ms": _percentile(samples, 0.9),
+                "p99_ms": _percentile(samples, 0.99),
+                "max_ms": samples[-1],
+            }
+        )
+    return result
+
+
+def bench_reconnect(broker, args, fast=False):
+    """Drops the connection and measures how long `MQTTSupervisor` takes to
+    reconnect and resubscribe, optionally with ``fast_reconnect``."""
+    client = _client(broker, args.protocol, fast_reconnect=fast)
+    topics = [("bench/reconnect/{}".format(i), 0) for i in range(args.topics)]
+    client.subscribe(topics)
+    supervisor = MQTTSupervisor(client, min_delay=0.01)
+    times = []
+    for _ in range(args.reconnects):
+        start = time.monotonic()
+        broker.drop_connections()
+        supervisor.loop(timeout=0.05)
+        while not supervisor.connected:
+            supervisor.loop(timeout=0.05)
+        times.append((time.monotonic() - start) * 1000)
+    client.disconnect()
+    times.sort()
+    return {
+        "name": "reconnect_fast" if fast else "reconnect",
+        "topics": args.topics,
+        "reconnects": len(times),
+        "median_ms": _percentile(times, 0.5),
+        "max_ms": times[-1],
+    }
+
+
+def bench_io_mqtt(broker, args):
+    """Publishes to an Adafruit IO feed through `IO_MQTT` and measures the
+    rate at which feed callbacks run."""
+    client = MQTT.MQTT(
+        "127.0.0.1",
+        port=broker.port,
+        username="bench",
+        password="bench",
+        is_ssl=False,
+        socket_pool=socket,
+    )
+    io = IO_MQTT(client)
+    received = [0, 0]
+
+    def on_feed(client, topic, message):
+        # pylint: disable=unused-argument
+        received[0] += 1
+        received[1] = time.monotonic()
+
+    io.connect()
+    io.add_feed_callback("temperature", on_feed)
+    io.subscribe("temperature")
+    start = time.monotonic()
+    for i in range(args.messages):
+        io.publish("temperature", 20 + i % 10)
+        if i % 32 == 0:
+            io.loop(timeout=0)
+    published = time.monotonic()
+    _receive(client, received, args.messages, published + SETTLE_TIME + args.latency)
+    io.disconnect()
+    return {
+        "name": "io_mqtt",
+        "messages": args.messages,
+        "publish_msgs_per_sec": args.messages / (published - start),
+        "delivered": received[0],
+        "delivered_msgs_per_sec": received[0] / (received[1] - start),
+    }
+
+
+def main():
+    """Runs every benchmark and prints the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--samples", type=int, default=200)
+    parser.add_argument("--topics", type=int, default=20)
+    parser.add_argument("--reconnects", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0, help="injected, in ms")
+    parser.add_argument("--loss", type=float, default=0, help="loss probability")
+    parser.add_argument("--protocol", type=int, default=MQTT.MQTT_V311, choices=(4, 5))
+    parser.add_argument("-o", "--output", help="also write the results to a file")
+    args = parser.parse_args()
+    args.latency /= 1000
+
+    with LoopbackBroker(latency=args.latency, loss=args.loss) as broker:
+        results = [
+            bench_throughput(broker, args, 0),
+            bench_throughput(broker, args, 1),
+            bench_throughput(broker, args, 1, max_inflight=16),
+            bench_throughput(broker, args, 1, batch=60),
+            bench_latency(broker, args),
+            bench_reconnect(broker, args),
+            bench_reconnect(broker, args, fast=True),
+            bench_io_mqtt(broker, args),
+        ]
+    report = {
+        "version": MQTT.__version__,
+        "python": sys.version.split()[0],
+        "timestamp": time.time(),
+        "parameters": {
+            "messages": args.messages,
+            "latency_ms": args.latency * 1000,
+            "loss": args.loss,
+            "protocol": args.protocol,
+        },
+        "results": results,
+    }
+    document = json.dumps(report, indent=2)
+    print(document)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(document + "\n")
+
+
+if __name__ == "__main__":
+    main()
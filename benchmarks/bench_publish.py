@@ -0,0 +1,139 @@
+# SPDX-FileCopyrightText: 2021 ErogigGit
+#
+# SPDX-License-Identifier: MIT
+
+"""
+`bench_publish`
+================================================================================
+
+Compares the single-buffer PUBLISH encoder in `adafruit_minimqtt.MQTT` with the
+previous three-send encoder over a local loopback socket pair.
+
+Reports socket sends, peak heap growth and throughput per publish. The heap
+figure is measured with `tracemalloc`. Once its buffers are warmed up, the
+single-buffer encoder allocates little beyond the encoded payload; the legacy
+encoder also allocates three header buffers. Run on CPython (Adafruit-Blinka
+provides the ``micropython`` module):
+
+.. code-block:: shell
+
+    python benchmarks/bench_publish.py
+
+"""
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+import adafruit_minimqtt as MQTT
+
+TOPIC = "adafruit/f/temperature"
+MESSAGES = 2000
+
+
+class CountingSocket:
+    """Loopback socket which counts the number of send calls."""
+
+    def __init__(self, sock):
+        self._sock = sock
+        self.sends = 0
+        self.recv_into = sock.recv_into
+
+    def send(self, buf):
+        """Sends buf and counts the call."""
+        self.sends += 1
+        return self._sock.send(buf)
+
+    def close(self):
+        """Closes the socket."""
+        self._sock.close()
+
+
+def _drain(sock):
+    """Discards everything written to the other end of the socket pair."""
+    buf = bytearray(4096)
+    while sock.recv_into(buf):
+        pass
+
+
+def legacy_publish(client, topic, msg, retain=False, qos=0):
+    """The publish encoder this benchmark compares against."""
+    msg = str(msg).encode("ascii")
+    pub_hdr_fixed = bytearray([0x30 | retain | qos << 1])
+    pub_hdr_var = bytearray(struct.pack(">H", len(topic)))
+    pub_hdr_var.extend(topic.encode("utf-8"))
+    remaining_length = 2 + len(msg) + len(topic)
+    if remaining_length > 0x7F:
+        while remaining_length > 0:
+            encoded_byte = remaining_length % 0x80
+            remaining_length = remaining_length // 0x80
+            if remaining_length > 0:
+                encoded_byte |= 0x80
+            pub_hdr_fixed.append(encoded_byte)
+    else:
+        pub_hdr_fixed.append(remaining_length)
+    client._sock.send(pub_hdr_fixed)  # pylint: disable=protected-access
+    client._sock.send(pub_hdr_var)  # pylint: disable=protected-access
+    client._sock.send(msg)  # pylint: disable=protected-access
+
+
+def run(name, publish):
+    """Publishes MESSAGES messages with publish and returns the measurements."""
+    local, remote = socket.socketpair()
+    reader = threading.Thread(target=_drain, args=(remote,), daemon=True)
+    reader.start()
+    client = MQTT.MQTT("localhost", is_ssl=False)
+    # pylint: disable=protected-access
+    client._sock = CountingSocket(local)
+    client._is_connected = True
+    publish(client, TOPIC, 21.5)  # warm up buffers and caches
+
+    client._sock.sends = 0
+    start = time.monotonic()
+    for i in range(MESSAGES):
+        publish(client, TOPIC, 20 + i % 10)
+    elapsed = time.monotonic() - start
+    sends = client._sock.sends
+
+    # peak heap growth during each publish approximates its allocations
+    allocated = 0
+    tracemalloc.start()
+    for i in range(MESSAGES):
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        publish(client, TOPIC, 20 + i % 10)
+        allocated += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+
+    local.close()
+    reader.join()
+    remote.close()
+    return {
+        "encoder": name,
+        "sends_per_publish": sends / MESSAGES,
+        "peak_bytes_per_publish": allocated / MESSAGES,
+        "publishes_per_sec": MESSAGES / elapsed,
+    }
+
+
+def main():
+    """Runs both encoders and prints the results."""
+    for result in (
+        run("legacy", legacy_publish),
+        run("single-buffer", lambda client, *args: client.publish(*args)),
+    ):
+        print(
+            "{encoder:>14}: {sends_per_publish:.1f} sends, "
+            "{peak_bytes_per_publish:.0f} B peak heap, "
+            "{publishes_per_sec:.0f} msg/s".format(**result)
+        )
+
+
+if __name__ == "__main__":
+    main()
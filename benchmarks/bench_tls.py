@@ -0,0 +1,139 @@
+# SPDX-FileCopyrightText: 2021 ErogigGit
+#
+# SPDX-License-Identifier: MIT
+
+"""
+`bench_tls`
+================================================================================
+
+Measures secure reconnects of `adafruit_minimqtt.MQTT` against a TLS
+`loopback_broker.LoopbackBroker`, with and without TLS session resumption.
+A self-signed certificate for ``localhost`` is made with the ``openssl``
+command, unless one is given:
+
+.. code-block:: shell
+
+    python benchmarks/bench_tls.py --reconnects 50
+
+The client only uses TLS on port 8883, so the broker listens on that port
+of the loopback interface, which must be free.
+
+"""
+import argparse
+import json
+import os
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+import adafruit_minimqtt as MQTT
+from loopback_broker import LoopbackBroker
+
+
+def make_certificate(directory):
+    """Writes a self-signed certificate and key for localhost, and returns
+    their paths."""
+    certfile = os.path.join(directory, "localhost.pem")
+    keyfile = os.path.join(directory, "localhost.key")
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "ec",
+            "-pkeyopt",
+            "ec_paramgen_curve:prime256v1",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN=localhost",
+            "-addext",
+            "subjectAltName=DNS:localhost",
+            "-keyout",
+            keyfile,
+            "-out",
+            certfile,
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return certfile, keyfile
+
+
+def bench_reconnect(certfile, args, resume):
+    """Reconnects repeatedly and returns reconnect and handshake times."""
+    ssl_context = ssl.create_default_context(cafile=certfile)
+    client = MQTT.MQTT(
+        "localhost",
+        port=MQTT.MQTT_TLS_PORT,
+        username="bench",
+        password="bench",
+        socket_pool=socket,
+        ssl_context=ssl_context,
+    )
+    client.connect()
+    client.stats.reset()
+    times = []
+    cpu = time.process_time()
+    for _ in range(args.reconnects):
+        if not resume:
+            # pylint: disable=protected-access
+            client._tls_session = None
+        start = time.monotonic()
+        client.reconnect(resub_topics=False)
+        times.append((time.monotonic() - start) * 1000)
+    cpu = time.process_time() - cpu
+    stats = client.stats.as_dict()
+    client.disconnect()
+    times.sort()
+    return {
+        "name": "tls_reconnect_resumed" if resume else "tls_reconnect_full",
+        "reconnects": len(times),
+        "resumed": stats["tls_resumed"],
+        "median_ms": times[len(times) // 2],
+        "max_ms": times[-1],
+        "handshake_avg_ms": stats["tls_handshake_avg_ms"],
+        # client and broker together, as they share the process
+        "cpu_ms_per_reconnect": cpu * 1000 / len(times),
+    }
+
+
+def main():
+    """Runs the benchmark and prints the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--reconnects", type=int, default=20)
+    parser.add_argument("--certfile", help="defaults to a new self-signed one")
+    parser.add_argument("--keyfile")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        certfile, keyfile = args.certfile, args.keyfile
+        if certfile is None:
+            certfile, keyfile = make_certificate(directory)
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(certfile, keyfile)
+        with LoopbackBroker(port=MQTT.MQTT_TLS_PORT, ssl_context=server_context):
+            results = [
+                bench_reconnect(certfile, args, resume=False),
+                bench_reconnect(certfile, args, resume=True),
+            ]
+    report = {
+        "version": MQTT.__version__,
+        "python": sys.version.split()[0],
+        "ssl": ssl.OPENSSL_VERSION,
+        "timestamp": time.time(),
+        "results": results,
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
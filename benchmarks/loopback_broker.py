@@ -0,0 +1,418 @@
+# SPDX-FileCopyrightText: 2021 ErogigGit
+#
+# SPDX-License-Identifier: MIT
+
+"""
+`loopback_broker`
+================================================================================
+
+A small MQTT broker which runs in threads on CPython, so that MiniMQTT can be
+measured without a network or io.adafruit.com.
+
+It accepts MQTT 3.1.1 and MQTT 5 clients and supports CONNECT, SUBSCRIBE and
+UNSUBSCRIBE with wildcards, PUBLISH at QoS 0 and 1, retained messages and
+PINGREQ. Inbound MQTT 5 topic aliases are resolved, and the topics of
+messages delivered to MQTT 5 clients are replaced by topic aliases, up to the
+Topic Alias Maximum in their CONNECT. Sessions, QoS 2, will messages and
+other MQTT 5 properties are not supported.
+
+Latency and message loss can be injected into everything the broker sends:
+
+.. code-block:: python
+
+    with LoopbackBroker(latency=0.02, loss=0.01) as broker:
+        client = MQTT.MQTT("127.0.0.1", port=broker.port, is_ssl=False,
+                           socket_pool=socket)
+
+"""
+import os
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from adafruit_minimqtt import MQTTDecoder, MQTT_V5
+from matcher import MQTTMatcher
+
+
+def _remaining_length(length):
+    """Returns the encoded Remaining Length of a packet."""
+    encoded = bytearray()
+    while True:
+        byte = length & 0x7F
+        length >>= 7
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def _packet(header, body):
+    """Returns a packet with its fixed header."""
+    return bytes((header,)) + _remaining_length(len(body)) + body
+
+
+# Sizes of the fixed size CONNECT properties: Session Expiry Interval,
+# Receive Maximum, Topic Alias Maximum, Maximum Packet Size and the
+# request flags
+_PROPERTY_SIZES = {0x11: 4, 0x21: 2, 0x22: 2, 0x27: 4, 0x17: 1, 0x19: 1}
+
+
+def _varint(buf, offset):
+    """Decodes a Variable Byte Integer, returning it and the next offset."""
+    value = shift = 0
+    while True:
+        byte = buf[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+class _Connection:
+    """A client connection, with a sender thread which applies the latency."""
+
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.version = 4
+        self.aliases = {}
+        # Topic Alias Maximum of the client, and the aliases assigned to
+        # the topics delivered to it
+        self.alias_maximum = 0
+        self.outbound_aliases = {}
+        self._deliver_lock = threading.Lock()
+        self.pid = 0
+        self._outbox = []
+        self._outbox_ready = threading.Condition()
+        self.closed = False
+
+    def send(self, packet):
+        """Queues a packet, to be sent once the injected latency has passed."""
+        with self._outbox_ready:
+            self._outbox.append((time.monotonic() + self.broker.latency, packet))
+            self._outbox_ready.notify()
+
+    def sender(self):
+        """Sends queued packets in order once they are due."""
+        while True:
+            with self._outbox_ready:
+                while not self._outbox and not self.closed:
+                    self._outbox_ready.wait()
+                if self.closed:
+                    return
+                due, packet = self._outbox.pop(0)
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self.sock.sendall(packet)
+            except OSError:
+                self.close()
+                return
+
+    def close(self):
+        """Closes the connection and stops the sender thread."""
+        with self._outbox_ready:
+            self.closed = True
+            self._outbox_ready.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def deliver(self, topic, payload, qos, retain=False):
+        """Sends a PUBLISH to this client, with a topic alias when the
+        client accepts them."""
+        if self.broker.loss and random.random() < self.broker.loss:
+            # lost before an alias is assigned, as the client must see the
+            # topic of an alias
+            self.broker.dropped += 1
+            return
+        # packets which assign an alias are queued before those using it
+        with self._deliver_lock:
+            properties = b"\x00"
+            alias = self.outbound_aliases.get(topic)
+            if alias is not None:
+                topic = ""
+            elif len(self.outbound_aliases) < self.alias_maximum:
+                alias = len(self.outbound_aliases) + 1
+                self.outbound_aliases[topic] = alias
+            if alias is not None:
+                properties = struct.pack("!BBH", 3, 0x23, alias)
+            encoded = topic.encode("utf-8")
+            body = struct.pack("!H", len(encoded)) + encoded
+            if qos:
+                self.pid = self.pid % 0xFFFF + 1
+                body += struct.pack("!H", self.pid)
+            if self.version == MQTT_V5:
+                body += properties
+            header = 0x30 | qos << 1 | retain
+            self.send(_packet(header, body + payload))
+
+
+class LoopbackBroker:
+    """MQTT broker stand-in listening on the loopback interface.
+
+    :param str host: Address to listen on.
+    :param int port: Port to listen on, or zero for any free port.
+    :param float latency: Delay added to every packet the broker sends, in seconds.
+    :param float loss: Probability that a PUBLISH sent to a subscriber is lost.
+    :param dict connack_properties: Encoded MQTT 5 properties added to the
+        CONNACK sent to MQTT 5 clients, keyed by property identifier.
+    :param ssl_context: Optional server side `ssl.SSLContext`, with its
+        certificate loaded, to accept TLS connections only.
+
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        latency=0,
+        loss=0,
+        connack_properties=None,
+        ssl_context=None,
+    ):
+        self.latency = latency
+        self.loss = loss
+        self.connack_properties = connack_properties or {}
+        self.ssl_context = ssl_context
+        # topic filter -> {connection: qos}
+        self._subscriptions = MQTTMatcher()
+        self._filters = {}
+        self.retained = {}
+        self.received = 0
+        self.dropped = 0
+        self._connections = []
+        self._lock = threading.Lock()
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((host, port))
+        # clients of a multiplexer connect all at once
+        self._server.listen(socket.SOMAXCONN)
+        self.port = self._server.getsockname()[1]
+        self._running = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.stop()
+
+    def start(self):
+        """Starts accepting connections."""
+        self._running = True
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def stop(self):
+        """Closes the listening socket and every connection."""
+        self._running = False
+        self._server.close()
+        self.drop_connections()
+
+    def drop_connections(self):
+        """Closes every client connection, as a broker restart or network
+        failure would. Subscriptions are forgotten."""
+        with self._lock:
+            connections, self._connections = self._connections, []
+            for connection in connections:
+                self._unsubscribe_all(connection)
+        for connection in connections:
+            connection.close()
+
+    def _accept(self):
+        while self._running:
+            try:
+                sock, _ = self._server.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.ssl_context is not None:
+                # the handshake runs on the connection's own thread
+                sock = self.ssl_context.wrap_socket(
+                    sock, server_side=True, do_handshake_on_connect=False
+                )
+            connection = _Connection(self, sock)
+            with self._lock:
+                self._connections.append(connection)
+            threading.Thread(target=connection.sender, daemon=True).start()
+            threading.Thread(
+                target=self._serve, args=(connection,), daemon=True
+            ).start()
+
+    def _serve(self, connection):
+        """Reads and handles packets from one client."""
+        decoder = MQTTDecoder()
+        try:
+            if self.ssl_context is not None:
+                connection.sock.do_handshake()
+            while not connection.closed:
+                view = decoder.free()
+                size = connection.sock.recv_into(view, len(view))
+                if not size:
+                    break
+                decoder.commit(size)
+                header = decoder.next_packet()
+                while header is not None:
+                    if not self._handle(connection, header, decoder.body):
+                        return
+                    header = decoder.next_packet()
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                if connection in self._connections:
+                    self._connections.remove(connection)
+                self._unsubscribe_all(connection)
+            connection.close()
+
+    # pylint: disable=too-many-branches
+    def _handle(self, connection, header, body):
+        """Handles one packet. Returns False when the client disconnected."""
+        packet_type = header & 0xF0
+        if packet_type == 0x10:
+            self._connect(connection, body)
+        elif packet_type == 0x30:
+            self._publish(connection, header, body)
+        elif packet_type == 0x80:
+            self._subscribe(connection, body)
+        elif packet_type == 0xA0:
+            self._unsubscribe(connection, body)
+        elif packet_type == 0xC0:
+            connection.send(b"\xd0\x00")
+        elif packet_type == 0xE0:
+            return False
+        return True
+
+    def _properties_end(self, connection, body, offset):
+        """Skips MQTT 5 properties, returning the offset after them."""
+        if connection.version != MQTT_V5:
+            return offset
+        length, offset = _varint(body, offset)
+        return offset + length
+
+    def _connect(self, connection, body):
+        connection.version = body[6]
+        if connection.version != MQTT_V5:
+            connection.send(b"\x20\x02\x00\x00")
+            return
+        # properties follow the flags and keep alive
+        length, offset = _varint(body, 10)
+        end = offset + length
+        while offset < end:
+            prop = body[offset]
+            size = _PROPERTY_SIZES.get(prop)
+            if size is None:
+                # MiniMQTT only sends fixed size properties
+                break
+            if prop == 0x22:
+                connection.alias_maximum = body[offset + 1] << 8 | body[offset + 2]
+            offset += 1 + size
+        properties = b"".join(
+            bytes((prop,)) + value for prop, value in self.connack_properties.items()
+        )
+        connection.send(
+            _packet(0x20, b"\x00\x00" + _remaining_length(len(properties)) + properties)
+        )
+
+    def _publish(self, connection, header, body):
+        self.received += 1
+        qos = header >> 1 & 0x03
+        topic_len = body[0] << 8 | body[1]
+        topic = str(body[2 : 2 + topic_len], "utf-8")
+        offset = 2 + topic_len
+        pid = None
+        if qos:
+            pid = bytes(body[offset : offset + 2])
+            offset += 2
+        if connection.version == MQTT_V5:
+            length, start = _varint(body, offset)
+            offset = start + length
+            # the topic alias is the only PUBLISH property MiniMQTT sends
+            if length and body[start] == 0x23:
+                alias = body[start + 1] << 8 | body[start + 2]
+                if topic:
+                    connection.aliases[alias] = topic
+                else:
+                    topic = connection.aliases[alias]
+        payload = bytes(body[offset:])
+        if qos:
+            connection.send(b"\x40\x02" + pid)
+        if header & 0x01:
+            if payload:
+                self.retained[topic] = (payload, qos)
+            else:
+                self.retained.pop(topic, None)
+        with self._lock:
+            subscribers = {}
+            for filter_subscribers in self._subscriptions.iter_match(topic):
+                for subscriber, sub_qos in filter_subscribers.items():
+                    subscribers[subscriber] = max(
+                        subscribers.get(subscriber, 0), sub_qos
+                    )
+        for subscriber, sub_qos in subscribers.items():
+            subscriber.deliver(topic, payload, min(qos, sub_qos))
+
+    def _subscribe(self, connection, body):
+        pid = bytes(body[:2])
+        offset = self._properties_end(connection, body, 2)
+        granted = bytearray()
+        new_filters = []
+        while offset < len(body):
+            length = body[offset] << 8 | body[offset + 1]
+            topic_filter = str(body[offset + 2 : offset + 2 + length], "utf-8")
+            qos = min(body[offset + 2 + length] & 0x03, 1)
+            offset += 3 + length
+            with self._lock:
+                if topic_filter not in self._filters:
+                    self._filters[topic_filter] = {}
+                    self._subscriptions[topic_filter] = self._filters[topic_filter]
+                self._filters[topic_filter][connection] = qos
+            granted.append(qos)
+            new_filters.append((topic_filter, qos))
+        properties = b"\x00" if connection.version == MQTT_V5 else b""
+        connection.send(_packet(0x90, pid + properties + granted))
+        for topic_filter, qos in new_filters:
+            matcher = MQTTMatcher()
+            matcher[topic_filter] = True
+            for topic, (payload, retained_qos) in list(self.retained.items()):
+                if any(matcher.iter_match(topic)):
+                    connection.deliver(topic, payload, min(qos, retained_qos), True)
+
+    def _unsubscribe(self, connection, body):
+        pid = bytes(body[:2])
+        offset = self._properties_end(connection, body, 2)
+        count = 0
+        while offset < len(body):
+            length = body[offset] << 8 | body[offset + 1]
+            topic_filter = str(body[offset + 2 : offset + 2 + length], "utf-8")
+            offset += 2 + length
+            count += 1
+            with self._lock:
+                self._remove_subscriber(topic_filter, connection)
+        reasons = b""
+        if connection.version == MQTT_V5:
+            reasons = b"\x00" + bytes(count)
+        connection.send(_packet(0xB0, pid + reasons))
+
+    def _remove_subscriber(self, topic_filter, connection):
+        subscribers = self._filters.get(topic_filter)
+        if subscribers is None:
+            return
+        subscribers.pop(connection, None)
+        if not subscribers:
+            del self._filters[topic_filter]
+            del self._subscriptions[topic_filter]
+
+    def _unsubscribe_all(self, connection):
+        for topic_filter in list(self._filters):
+            self._remove_subscriber(topic_filter, connection)
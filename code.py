@@ -21,6 +21,7 @@ from adafruit_esp32spi import adafruit_esp32spi
 from adafruit_esp32spi import adafruit_esp32spi_wifimanager
 import adafruit_esp32spi.adafruit_esp32spi_socket as socket
 import adafruit_minimqtt as MQTT
+from adafruit_minimqtt_supervisor import MQTTSupervisor
 from adafruit_io.adafruit_io import IO_MQTT
 
 from adafruit_display_shapes.sparkline import Sparkline
@@ -139,6 +140,14 @@ mqtt_client = MQTT.MQTT(
 # Initialize an Adafruit IO MQTT Client
 io = IO_MQTT(mqtt_client)
 
+# Resets the ESP32 and joins the WiFi network again, used by the MQTT supervisor
+def reset_wifi():
+    pyportal.network._wifi.esp.reset()
+    pyportal.network.connect()
+
+# Keeps the MQTT client connected, reconnecting with backoff when the link drops
+mqtt_supervisor = MQTTSupervisor(mqtt_client, reset_network=reset_wifi)
+
 # Connect the callback methods defined above to Adafruit IO
 
 
@@ -445,13 +454,8 @@ board.DISPLAY.show(splash)
 # ------------- Code Loop ------------- #
 while True:
 
-    try:
-        io.loop() #makes the buttons act slow
-    except (ValueError, RuntimeError) as e:
-        print("Failed to get data, retrying\n", e)
-        wifi.reset()
-        io.reconnect()
-        continue
+    # reconnects with backoff, resetting the WiFi if needed, without blocking
+    mqtt_supervisor.loop(timeout=0, max_messages=20, budget_ms=50)
 
     with open("/sd/temperature.txt", "a") as f:
         #led.value = True  # turn on LED to indicate we're writing to the file
@@ -18,6 +18,7 @@ from adafruit_esp32spi import adafruit_esp32spi
 from adafruit_esp32spi import adafruit_esp32spi_wifimanager
 import adafruit_esp32spi.adafruit_esp32spi_socket as socket
 import adafruit_minimqtt as MQTT
+from adafruit_minimqtt_supervisor import MQTTSupervisor
 from adafruit_io.adafruit_io import IO_MQTT
 
 # ------------- Inputs and Outputs Setup ------------- #
@@ -114,6 +115,14 @@ mqtt_client = MQTT.MQTT(
 # Initialize an Adafruit IO MQTT Client
 io = IO_MQTT(mqtt_client)
 
+# Resets the ESP32 and joins the WiFi network again, used by the MQTT supervisor
+def reset_wifi():
+    wifi.reset()
+    wifi.connect()
+
+# Keeps the MQTT client connected, reconnecting with backoff when the link drops
+mqtt_supervisor = MQTTSupervisor(mqtt_client, reset_network=reset_wifi)
+
 # Connect the callback methods defined above to Adafruit IO
 io.on_connect = connected
 io.on_disconnect = disconnected
@@ -338,13 +347,8 @@ board.DISPLAY.show(splash)
 # ------------- Code Loop ------------- #
 while True:
 
-    try:
-        io.loop()
-    except (ValueError, RuntimeError) as e:
-        print("Failed to get data, retrying\n", e)
-        wifi.reset()
-        io.reconnect()
-        continue
+    # reconnects with backoff, resetting the WiFi if needed, without blocking
+    mqtt_supervisor.loop(timeout=0, max_messages=20, budget_ms=50)
     time.sleep(0.5)
 
     touch = ts.touch_point